@@ -1,46 +1,219 @@
 from __future__ import print_function
-from collections import namedtuple
+from collections import deque, namedtuple
 import numpy as np
 import tensorflow as tf
-from model import LSTMPolicy, MetaPolicy
+from model import LSTMPolicy, MetaPolicy, QuantizedActor
+from inference import InferenceError
+from intrinsic import INTRINSIC_REWARDS, make_intrinsic
 import six.moves.queue as queue
 import scipy.signal
+import sys
 import threading
+import time
+import six
 import distutils.version
 use_tf12_api = distutils.version.LooseVersion(tf.VERSION) >= distutils.version.LooseVersion('0.12.0')
-import cv2
 
 
 def discount(x, gamma):
     return scipy.signal.lfilter([1], [1, -gamma], x[::-1], axis=0)[::-1]
 
+
+def make_optimizer(mode, name, learning_rate=1e-4):
+    """
+    Optimizer for the global variables. "adam" gives every actor its own Adam; the shared modes
+    use a fixed `name`, so every actor in the cluster (thread or process) resolves the same slot
+    variables on the parameter server, as with the shared RMSProp of the A3C paper.
+    """
+    if mode == 'adam':
+        return tf.train.AdamOptimizer(learning_rate)
+    elif mode == 'shared-adam':
+        return tf.train.AdamOptimizer(learning_rate, name=name + "Adam")
+    elif mode == 'shared-rmsprop':
+        return tf.train.RMSPropOptimizer(learning_rate, decay=0.99, epsilon=0.1, name=name + "RMSProp")
+    raise ValueError("Unknown optimizer: {}".format(mode))
+
+
+def compress_gradients(grads_and_vars, mode, scope, topk_ratio=0.01):
+    """
+    Compresses gradients where they are computed and decompresses them on the device of their
+    variable, so that only the compressed form is sent to the parameter server.
+
+    fp16: cast to half precision.
+    topk: send the `topk_ratio` largest entries of each tensor as (value, index) pairs.
+    int8: linear 8 bit quantization with one float scale per tensor.
+    topk and int8 carry what was not sent over to the next update (error feedback); the residuals
+    are local variables created under `scope`.
+
+    Returns the new grads_and_vars and the number of bytes sent per update.
+    """
+    if mode == 'none':
+        return grads_and_vars, sum(4 * v.get_shape().num_elements() for g, v in grads_and_vars if g is not None)
+    compressed = []
+    num_bytes = 0
+    for grad, var in grads_and_vars:
+        if grad is None:
+            compressed.append((grad, var))
+            continue
+        shape = var.get_shape()
+        size = shape.num_elements()
+        if mode == 'fp16':
+            sent = tf.cast(grad, tf.float16)
+            with tf.device(var.device):
+                grad = tf.cast(sent, tf.float32)
+            num_bytes += 2 * size
+            compressed.append((grad, var))
+            continue
+
+        with tf.variable_scope(scope):
+            residual = tf.get_variable(var.op.name + "/residual", shape, tf.float32, tf.zeros_initializer(),
+                                       trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        acc = grad + residual
+        if mode == 'topk':
+            k = max(1, int(size * topk_ratio))
+            flat = tf.reshape(acc, [-1])
+            _, indices = tf.nn.top_k(tf.abs(flat), k, sorted=False)
+            indices = tf.expand_dims(indices, 1)
+            values = tf.gather_nd(flat, indices)
+            decompressed = tf.reshape(tf.scatter_nd(indices, values, [size]), shape)
+            with tf.control_dependencies([residual.assign(acc - decompressed)]):
+                sent = [tf.identity(values), tf.identity(indices)]
+            with tf.device(var.device):
+                grad = tf.reshape(tf.scatter_nd(sent[1], sent[0], [size]), shape)
+            num_bytes += 8 * k
+        elif mode == 'int8':
+            scale = tf.reduce_max(tf.abs(acc)) / 127.0 + 1e-12
+            quantized = tf.cast(tf.round(acc / scale), tf.int8)
+            with tf.control_dependencies([residual.assign(acc - tf.cast(quantized, tf.float32) * scale)]):
+                sent = [tf.identity(quantized), tf.identity(scale)]
+            with tf.device(var.device):
+                grad = tf.cast(sent[0], tf.float32) * sent[1]
+            num_bytes += size + 4
+        else:
+            raise ValueError("Unknown gradient compression: {}".format(mode))
+        compressed.append((grad, var))
+    return compressed, num_bytes
+
+
+class RolloutScheduler(object):
+    """
+    Picks the length of the next actor rollout from measured latencies.
+
+    Each rollout costs `n * (env + act) + update` seconds. A rollout is at least
+    `frames_per_update` frames long, and is stretched so that this actor does not push more than
+    `updates_per_sec` updates to the parameter server. Latencies are exponential moving averages.
+    """
+    def __init__(self, frames_per_update=20, updates_per_sec=None, min_steps=5, max_steps=100, decay=0.9):
+        self.frames_per_update = frames_per_update
+        self.updates_per_sec = updates_per_sec
+        self.min_steps = min_steps
+        self.max_steps = max_steps
+        self.decay = decay
+        self.latency = {'env': 0.0, 'act': 0.0, 'update': 0.0}
+
+    def record(self, name, seconds):
+        self.latency[name] = self.decay * self.latency[name] + (1.0 - self.decay) * seconds
+
+    def num_local_steps(self):
+        n = self.frames_per_update
+        step_time = self.latency['env'] + self.latency['act']
+        if self.updates_per_sec and step_time > 0:
+            n = max(n, (1.0 / self.updates_per_sec - self.latency['update']) / step_time)
+        return int(min(self.max_steps, max(self.min_steps, n)))
+
 class A3C(object):
-    def __init__(self, env, task, visualise, test=False):
+    def __init__(self, env, task, visualise, test=False, thread=0, shared=None,
+                 num_meta_steps=20, num_actor_rollouts=5, num_local_steps=20, scheduler=None,
+                 optimizer='adam', store=None, grad_compression='none', topk_ratio=0.01, fused_lstm=False,
+                 quantized_acting=False, image_summary_every=0, image_summary_secs=600, image_summary_max=3,
+                 image_summary_size=42, intrinsic='feature', meta_cached_features=False, beta=0.75,
+                 intrinsic_scale=0.05, learning_rate=1e-4, entropy_bonus=0.01):
         """
 An implementation of the A3C algorithm that is reasonably well-tuned for the VNC environments.
 Below, we will have a modest amount of complexity due to the way TensorFlow handles data parallelism.
 But overall, we'll define the model, specify its inputs, and describe how the policy gradients step
 should be computed.
+
+Several actors can live in one worker process: pass the first A3C as `shared` and a distinct
+`thread` index, and the new actor reuses its global networks and only builds its own local copy.
+
+One meta-step runs `num_actor_rollouts` actor rollouts of `num_local_steps` env steps each, and the
+meta-controller is updated every `num_meta_steps` meta-steps. With a RolloutScheduler the actor
+rollout length is chosen at run time instead.
+
+`optimizer` is one of "adam" (per-actor Adam statistics, listed in `actor_optimizer_variables`;
+worker.py keeps those of the extra actor threads out of checkpoints), "shared-adam" or
+"shared-rmsprop" (one set of statistics per global variable for the whole cluster).
+
+With a SharedParameterStore (`store`) there is no parameter server: the global networks are a
+local mirror, weights are read from the store and gradients are applied to it in Python.
+With `test` the whole graph is local too; the evaluation worker restores checkpoints into it.
+
+Image summaries of the rollout frames are kept apart from the scalar ones: at most
+`image_summary_max` frames, resized to `image_summary_size` pixels (0 keeps them as they are), every
+`image_summary_every` actor updates or, if that is 0, every `image_summary_secs` seconds (never if
+both are 0). Only the first actor of task 0 writes summaries.
+
+`intrinsic` names the intrinsic reward of the actor (see intrinsic.py); the number of goals of the
+meta-controller follows from it. The actor is trained on beta * extrinsic reward + (1 - beta) *
+intrinsic_scale * intrinsic reward. `learning_rate` and `entropy_bonus` apply to both the actor
+and the meta-controller.
+
+With `meta_cached_features` the meta-controller is trained on the hidden features computed while
+it acted, instead of running the conv layers again, and its gradient does not reach them.
+
+`visualise` is a started Visualiser that gets the frames and current goal of every step, or None.
+
+`grad_compression` ("none", "fp16", "topk" or "int8", see compress_gradients) shrinks the gradients
+pushed to the parameter server; it does not apply to the shared-memory store.
+
+`fused_lstm` runs both policies' LSTMs as LSTMBlockFusedCell ops; checkpoints are interchangeable.
+
+`quantized_acting` makes act() of both local policies use a QuantizedActor (8 bit weights and
+activations); the quantized weights are refreshed as part of each sync. Training stays float32.
 """
 
         self.env = env
         self.task = task
-        self.meta_action_size = 32
+        self.thread = thread
+        self.num_meta_steps = num_meta_steps
+        self.num_actor_rollouts = num_actor_rollouts
+        self.num_local_steps = num_local_steps
+        self.scheduler = scheduler
+        self.optimizer = optimizer
+        self.store = store
+        self.intrinsic = intrinsic
+        self.intrinsic_scale = intrinsic_scale
+        self.meta_cached_features = meta_cached_features
+        self.meta_action_size = INTRINSIC_REWARDS[intrinsic].num_goals
 
         worker_device = "/job:worker/task:{}/cpu:0".format(task)
-        if test:
-           worker_device = "/job:eval/task:{}/cpu:0".format(task)
-        with tf.device(tf.train.replica_device_setter(1, worker_device=worker_device)):
-            with tf.variable_scope("global"):
-                self.network = LSTMPolicy(env.observation_space.shape, env.action_space.n, self.meta_action_size)
-                self.global_step = tf.get_variable("global_step", [], tf.int32, initializer=tf.constant_initializer(0, dtype=tf.int32),
-                                                   trainable=False)
-                self.meta_network = MetaPolicy(env.observation_space.shape, self.meta_action_size)
+        global_device = tf.train.replica_device_setter(1, worker_device=worker_device)
+        if store is not None or test:
+            # no parameter server: the global networks are in-process, for the store mirror or a
+            # restored checkpoint
+            worker_device = global_device = "/cpu:0"
+        if shared is None:
+            with tf.device(global_device):
+                with tf.variable_scope("global"):
+                    self.network = LSTMPolicy(env.observation_space.shape, env.action_space.n, self.meta_action_size, fused_lstm)
+                    self.global_step = tf.get_variable("global_step", [], tf.int32, initializer=tf.constant_initializer(0, dtype=tf.int32),
+                                                       trainable=False)
+                    self.meta_network = MetaPolicy(env.observation_space.shape, self.meta_action_size, fused_lstm,
+                                                   meta_cached_features)
+        else:
+            self.network = shared.network
+            self.global_step = shared.global_step
+            self.meta_network = shared.meta_network
 
+        # every actor thread gets its own local copy; names must keep the "local" prefix
+        # so that they are left out of checkpoints
+        local_scope = "local" if thread == 0 else "local_{}".format(thread)
         with tf.device(worker_device):
-            with tf.variable_scope("local"):
-                self.local_network = pi = LSTMPolicy(env.observation_space.shape, env.action_space.n, self.meta_action_size)
-                self.local_meta_network = meta_pi = MetaPolicy(env.observation_space.shape, self.meta_action_size)
+            with tf.variable_scope(local_scope):
+                self.local_network = pi = LSTMPolicy(env.observation_space.shape, env.action_space.n, self.meta_action_size, fused_lstm)
+                self.local_meta_network = meta_pi = MetaPolicy(env.observation_space.shape, self.meta_action_size, fused_lstm,
+                                                               meta_cached_features)
                 pi.global_step = self.global_step
 
             self.ac = tf.placeholder(tf.float32, [None, env.action_space.n], name="ac")
@@ -60,7 +233,7 @@ should be computed.
             entropy = - tf.reduce_sum(prob_tf * log_prob_tf)
 
             bs = tf.to_float(tf.shape(pi.x)[0])
-            self.loss = pi_loss + 0.5 * vf_loss - entropy * 0.01
+            self.loss = pi_loss + 0.5 * vf_loss - entropy * entropy_bonus
 
 
             self.visualise = visualise
@@ -71,29 +244,65 @@ should be computed.
                 tf.summary.scalar("model/policy_loss", pi_loss / bs),
                 tf.summary.scalar("model/value_loss", vf_loss / bs),
                 tf.summary.scalar("model/entropy", entropy / bs),
-                tf.summary.image("model/state", pi.x),
                 tf.summary.scalar("model/grad_global_norm", tf.global_norm(grads)),
                 tf.summary.scalar("model/var_global_norm", tf.global_norm(pi.var_list))
                 ]
 
-            self.summary_op = tf.summary.merge(actor_summary)
-
             grads, _ = tf.clip_by_global_norm(grads, 40.0)
 
             # This is sync ops which copy weights from shared space to the local.
-            self.sync = tf.group(
-                *(
-                    [ v1.assign(v2) for v1, v2 in zip(pi.var_list, self.network.var_list)]
-                 ))
+            if store is None:
+                self.sync = tf.group(
+                    *(
+                        [ v1.assign(v2) for v1, v2 in zip(pi.var_list, self.network.var_list)]
+                     ))
+                self.sync_feeds = None
+            else:
+                self.sync, self.sync_feeds = self._store_sync(pi.var_list, self.network.var_list)
 
 
             grads_and_vars = list(zip(grads, self.network.var_list))
-            inc_step = self.global_step.assign_add(tf.shape(pi.x)[0])
-            # each worker has a different set of adam optimizer parameters
-            opt = tf.train.AdamOptimizer(1e-4)
-            self.train_op = tf.group(opt.apply_gradients(grads_and_vars), inc_step)
+            if store is None:
+                grads_and_vars, self.grad_bytes = compress_gradients(
+                    grads_and_vars, grad_compression, local_scope + "/actor_compression", topk_ratio)
+                dense_bytes = sum(4 * v.get_shape().num_elements() for g, v in grads_and_vars if g is not None)
+                actor_summary += [
+                    tf.summary.scalar("model/grad_bytes_per_update", tf.constant(float(self.grad_bytes))),
+                    tf.summary.scalar("model/grad_compression_ratio", tf.constant(dense_bytes / float(self.grad_bytes)))
+                ]
+            self.summary_op = tf.summary.merge(actor_summary)
+
+            frames = pi.x[:image_summary_max]
+            if image_summary_size:
+                frames = tf.image.resize_images(frames, [image_summary_size, image_summary_size],
+                                                method=tf.image.ResizeMethod.AREA)
+            self.image_summary_op = tf.summary.image("model/state", frames, max_outputs=image_summary_max)
+            self.image_summary_every = image_summary_every
+            self.image_summary_secs = image_summary_secs
+            self.last_image_summary = None
+
+            existing_variables = set(v.name for v in tf.global_variables())
+            if store is not None:
+                # gradients are fetched and applied to the store by _update
+                self.train_op = [(g, v.name) for g, v in grads_and_vars if g is not None]
+            else:
+                inc_step = self.global_step.assign_add(tf.shape(pi.x)[0])
+                if shared is None or optimizer == 'adam':
+                    self.opt = make_optimizer(optimizer, "Shared", learning_rate)
+                    self.meta_opt = make_optimizer(optimizer, "SharedMeta", learning_rate)
+                else:
+                    self.opt, self.meta_opt = shared.opt, shared.meta_opt
+                self.train_op = tf.group(self.opt.apply_gradients(grads_and_vars), inc_step)
             self.summary_writer = None
             self.local_steps = 0
+            self.local_frames = 0
+            # for the metrics endpoint: time spent in syncs, and (end time, extrinsic reward, length)
+            # of the last episodes
+            self.syncs = 0
+            self.sync_secs = 0.0
+            self.episode_stats = deque(maxlen=20)
+            # episode summaries waiting for thread 0 to write them, see peers
+            self.finished_episodes = deque(maxlen=100)
 
             ###################################
             ########## META CONTROLLER ########
@@ -110,20 +319,45 @@ should be computed.
 
             # entropy
             meta_entropy = - tf.reduce_sum(meta_prob_tf * meta_log_prob_tf)
-            meta_bs = tf.to_float(tf.shape(meta_pi.x)[0])
+            meta_bs = tf.to_float(tf.shape(meta_pi.hidden_in if meta_cached_features else meta_pi.x)[0])
 
-            self.meta_loss = meta_pi_loss + 0.5 * meta_vf_loss - meta_entropy * 0.01
+            self.meta_loss = meta_pi_loss + 0.5 * meta_vf_loss - meta_entropy * entropy_bonus
             meta_grads = tf.gradients(self.meta_loss, meta_pi.var_list)
             meta_grads, _ = tf.clip_by_global_norm(meta_grads, 40.0)
 
-            self.meta_sync = tf.group(
-                *(
-                    [ v1.assign(v2) for v1, v2 in zip(meta_pi.var_list, self.meta_network.var_list)]
-                 ))
+            if store is None:
+                self.meta_sync = tf.group(
+                    *(
+                        [ v1.assign(v2) for v1, v2 in zip(meta_pi.var_list, self.meta_network.var_list)]
+                     ))
+                self.meta_sync_feeds = None
+            else:
+                self.meta_sync, self.meta_sync_feeds = self._store_sync(meta_pi.var_list, self.meta_network.var_list)
+
+            if quantized_acting:
+                with tf.variable_scope(local_scope), tf.variable_scope("quantized"):
+                    pi.quantized = QuantizedActor(pi, "lstm")
+                    meta_pi.quantized = QuantizedActor(meta_pi, "meta_lstm", trunk=pi.quantized)
+                # requantize from the weights the sync has just written
+                with tf.control_dependencies([self.sync]):
+                    self.sync = tf.group(self.sync, pi.quantized.requantize())
+                with tf.control_dependencies([self.meta_sync]):
+                    self.meta_sync = tf.group(self.meta_sync, meta_pi.quantized.requantize())
 
             meta_grads_and_vars = list(zip(meta_grads, self.meta_network.var_list))
-            meta_opt = tf.train.AdamOptimizer(1e-4)
-            self.meta_train_op = meta_opt.apply_gradients(meta_grads_and_vars)
+            if store is None:
+                meta_grads_and_vars, self.meta_grad_bytes = compress_gradients(
+                    meta_grads_and_vars, grad_compression, local_scope + "/meta_compression", topk_ratio)
+            if store is not None:
+                self.meta_train_op = [(g, v.name) for g, v in meta_grads_and_vars if g is not None]
+            else:
+                self.meta_train_op = self.meta_opt.apply_gradients(meta_grads_and_vars)
+
+            # slots that belong to this actor alone
+            self.actor_optimizer_variables = []
+            if optimizer == 'adam' and store is None:
+                self.actor_optimizer_variables = [v for v in tf.global_variables()
+                                                  if v.name not in existing_variables]
 
             meta_summary = [
                 tf.summary.scalar("meta_model/policy_loss", meta_pi_loss / meta_bs),
@@ -133,17 +367,146 @@ should be computed.
                 tf.summary.scalar("meta_model/var_global_norm", tf.global_norm(meta_pi.var_list))
             ]
             self.meta_summary_op = tf.summary.merge(meta_summary)
-            self.beta = 0.75
+            self.beta = beta
+
+    def _store_sync(self, local_vars, global_vars):
+        """
+        Sync op for the shared-memory backend: assigns fed store values to `local_vars` and the
+        global step. The chief actor also refreshes the global mirror, which is what gets
+        checkpointed. Returns the op and a list of (placeholder, global variable name) feeds.
+        """
+        feeds = []
+        assigns = []
+        mirror = self.task == 0 and self.thread == 0
+        for local_v, global_v in zip(local_vars, global_vars):
+            value = tf.placeholder(global_v.dtype.base_dtype, global_v.get_shape())
+            feeds.append((value, global_v.name))
+            assigns.append(local_v.assign(value))
+            if mirror:
+                assigns.append(global_v.assign(value))
+        step = tf.placeholder(tf.int32, [])
+        feeds.append((step, None))
+        assigns.append(self.global_step.assign(step))
+        return tf.group(*assigns), feeds
+
+    # set by the constructor but not part of the graph; see graphcache
+    runtime_attributes = ('env', 'task', 'visualise', 'scheduler', 'store', 'opt', 'meta_opt', 'summary_writer',
+                          'episode_stats', 'finished_episodes', 'inference', 'peers')
+
+    # the other actor threads of the worker, set by the worker on thread 0: it writes their
+    # episode summaries along with its own, so that the threads do not each write the same tags
+    peers = ()
+
+    # an InferenceClient that acts for the meta-controller (and for the actor if inference_actor),
+    # set by the worker after building; None acts with the local networks
+    inference = None
+    inference_actor = False
+
+    def _inference_failed(self, error):
+        print("Inference server failed ({}); acting with the local networks from now on".format(error))
+        self.inference.close()
+        self.inference = None
+
+    def attach(self, env, task, visualise=False, scheduler=None, store=None):
+        """Sets the runtime attributes of an A3C whose graph was imported by graphcache."""
+        self.env = env
+        self.task = task
+        self.visualise = visualise
+        self.scheduler = scheduler
+        self.store = store
+        # only needed while building the graph
+        self.opt = self.meta_opt = None
+        self.summary_writer = None
+        self.episode_stats = deque(maxlen=20)
+        self.finished_episodes = deque(maxlen=100)
+
+    def _write_episode_summary(self, global_step):
+        """Writes the means of the episodes finished by this thread and its peers since the last call."""
+        episodes = []
+        for trainer in (self,) + tuple(self.peers):
+            while trainer.finished_episodes:
+                episodes.append(trainer.finished_episodes.popleft())
+        if not episodes:
+            return
+        shaped, shaped_per_time, extrinsic, intrinsic = np.mean(episodes, axis=0)
+        summary = tf.Summary()
+        summary.value.add(tag='global/episode_shaped_reward', simple_value=shaped)
+        summary.value.add(tag='global/shaped_reward_per_time', simple_value=shaped_per_time)
+        summary.value.add(tag='global/episode_extrinsic_reward', simple_value=extrinsic)
+        summary.value.add(tag='global/episode_intrinsic_reward', simple_value=intrinsic)
+        self.summary_writer.add_summary(summary, global_step)
+        self.summary_writer.flush()
+
+    def store_variables(self):
+        """The global variables held by the shared-memory store, in store layout order."""
+        names = set()
+        variables = []
+        for v in self.network.var_list + self.meta_network.var_list:
+            if v.name not in names:
+                names.add(v.name)
+                variables.append(v)
+        return variables
+
+    def _run_sync(self, sess, op, feeds):
+        t0 = time.time()
+        feed_dict = None
+        if self.store is not None:
+            feed_dict = {}
+            for value, name in feeds:
+                feed_dict[value] = self.store.global_step if name is None else self.store.read(name)
+        sess.run(op, feed_dict=feed_dict)
+        self.syncs += 1
+        self.sync_secs += time.time() - t0
+
+    def sync_weights(self, sess):
+        """Copies the global actor weights to the local network."""
+        self._run_sync(sess, self.sync, self.sync_feeds)
+
+    def sync_meta_weights(self, sess):
+        """Copies the global meta-controller weights to the local meta network."""
+        self._run_sync(sess, self.meta_sync, self.meta_sync_feeds)
+
+    def get_global_step(self, sess):
+        if self.store is not None:
+            return self.store.global_step
+        return sess.run(self.global_step)
+
+    def _update(self, sess, train_op, fetches, feed_dict, num_frames=0):
+        """Runs `fetches` together with one update of the global variables."""
+        if self.store is None:
+            return sess.run(fetches + [train_op], feed_dict=feed_dict)[:-1]
+        fetched = sess.run(fetches + [[g for g, _ in train_op]], feed_dict=feed_dict)
+        self.store.apply_gradients(zip(fetched[-1], [name for _, name in train_op]), num_frames)
+        return fetched[:-1]
 
     def start(self, sess, summary_writer):
         self.summary_writer = summary_writer
 
+        # Invariants of the environment, looked up once instead of on every step
+        env = self.env
+        self.timestep_limit = env.spec.tags.get('wrapper_config.TimeLimit.max_episode_steps') or np.inf
+        self.autoreset = env.metadata.get('semantics.autoreset')
+
+        # Rollout buffers, reused by every actor_process call. The extra row of rewards/values
+        # holds the bootstrap value.
+        max_steps = self.num_local_steps if self.scheduler is None else self.scheduler.max_steps
+        ob_shape = tuple(env.observation_space.shape)
+        num_actions = env.action_space.n
+        self.rollout_states = np.zeros((max_steps,) + ob_shape, np.float32)
+        self.rollout_actions = np.zeros((max_steps, num_actions), np.float32)
+        self.rollout_rewards = np.zeros(max_steps + 1)
+        self.rollout_values = np.zeros(max_steps + 1)
+        self.rollout_prev_actions = np.zeros((max_steps, num_actions), np.float32)
+        self.rollout_prev_rewards = np.zeros((max_steps, 1), np.float32)
+        self.rollout_meta_actions = np.zeros((max_steps, self.meta_action_size), np.float32)
+
         # Initialise Actor
         # Initialise last_state and last_features
-        self.last_state = self.env.reset()
+        self.last_state = env.reset()
         self.last_features = self.local_network.get_initial_features()
-        self.last_action = np.zeros(self.env.action_space.n)
-        self.last_reward = [0]
+        self.last_action = np.zeros(num_actions)
+        # updated in place on every step
+        self.last_reward = np.zeros(1)
         self.length = 0
         self.rewards = 0
         self.ex_rewards = 0
@@ -151,26 +514,24 @@ should be computed.
 
 
         # Initialise Meta controller
-        self.last_meta_state = self.env.reset()
+        self.last_meta_state = self.last_state
         self.last_meta_features = self.local_meta_network.get_initial_features()
         self.last_meta_action = np.zeros(self.meta_action_size)
         self.last_meta_reward = [0]
 
-        #
-        self.last_conv_feature = np.zeros(self.meta_action_size)
+        self.intrinsic_reward = make_intrinsic(self.intrinsic, self.local_network, scale=self.intrinsic_scale)
 
     def process(self, sess):
         """
         Everytime process is called.
         The meta_network get sync.
-        The actor_process is run for 20 times.
+        The actor_process is run num_actor_rollouts times for each of num_meta_steps meta-steps.
         The meta_network calculate gradient and update
         """
-        sess.run(self.meta_sync)
+        self.sync_meta_weights(sess)
 
         terminal_end = False
-        # TODO: tune this too
-        num_local_steps = 20
+        num_local_steps = self.num_meta_steps
         env = self.env
         policy = self.local_meta_network
 
@@ -183,17 +544,27 @@ should be computed.
         features= []
         prev_actions = []
         prev_rewards = []
+        hiddens = []
+        cached = self.meta_cached_features
 
         for _local_step in range(num_local_steps):
-            fetched = policy.act(self.last_meta_state, self.last_meta_features[0],
-                                 self.last_meta_features[1], self.last_meta_action,
-                                 self.last_meta_reward)
-            action, value_, features_ = fetched[0], fetched[1], fetched[2:]
+            inputs = (self.last_meta_state, self.last_meta_features[0], self.last_meta_features[1],
+                      self.last_meta_action, self.last_meta_reward)
+            fetched = None
+            if self.inference is not None:
+                try:
+                    fetched = self.inference.meta_act(*inputs, with_hidden=cached)
+                except InferenceError as e:
+                    self._inference_failed(e)
+            if fetched is None:
+                fetched = policy.act(*inputs, with_hidden=cached)
+            action, value_, features_ = fetched[0], fetched[1], fetched[2:4]
+            if cached:
+                hiddens += [fetched[4]]
 
             reward = 0
             # run actors several times
-            # TODO: tune this ... 2? maybe
-            for _ in range(5):
+            for _ in range(self.num_actor_rollouts):
                 state, reward_, terminal, info = self.actor_process(sess, action)
                 reward += reward_
                 if terminal:
@@ -239,10 +610,9 @@ should be computed.
         features = features[0]
 
         # Gradient Calculation
-        fetches = [self.meta_summary_op, self.meta_train_op, self.global_step]
+        fetches = [self.meta_summary_op, self.global_step]
 
         feed_dict = {
-            self.local_meta_network.x: batch_si,
             self.meta_ac: batch_a,
             self.meta_adv: batch_adv,
             self.meta_r: batch_r,
@@ -251,100 +621,109 @@ should be computed.
             self.local_meta_network.prev_action: batch_prev_a,
             self.local_meta_network.prev_reward: batch_prev_r
         }
+        if cached:
+            # the conv layers are not run again
+            feed_dict[self.local_meta_network.hidden_in] = np.concatenate(hiddens)
+        else:
+            feed_dict[self.local_meta_network.x] = batch_si
 
-        fetched = sess.run(fetches, feed_dict=feed_dict)
-        if self.task == 0:
+        fetched = self._update(sess, self.meta_train_op, fetches, feed_dict)
+        if self.task == 0 and self.thread == 0:
             self.summary_writer.add_summary(tf.Summary.FromString(fetched[0]), fetched[-1])
             self.summary_writer.flush()
 
 
+    def _images_due(self):
+        if self.image_summary_every:
+            return self.local_steps % self.image_summary_every == 0
+        if not self.image_summary_secs:
+            return False
+        return self.last_image_summary is None or time.time() - self.last_image_summary >= self.image_summary_secs
+
     def actor_process(self, sess, meta_action):
         """
         Every time actor_process is called.
         The network get sync.
-        The environment is run for 20 steps or until termination.
+        The environment is run for num_local_steps steps (or as many as the scheduler asks for) or until termination.
         The worker calculates gradients and then one update to the shared weight is made.
-        (one local step = one update  =< 20 env steps )
+        (one local step = one update  =< num_local_steps env steps )
         (global step is the number of frames)
         """
-        sess.run(self.sync)  # copy weights from shared to local
+        self.sync_weights(sess)  # copy weights from shared to local
 
-        # Environment run for 20 steps or less
+        # Environment run for num_local_steps steps or less
         terminal_end = False
-        num_local_steps = 20
+        num_local_steps = self.num_local_steps
+        scheduler = self.scheduler
+        if scheduler is not None:
+            num_local_steps = scheduler.num_local_steps()
         env = self.env
         policy = self.local_network
-
-        states  = []
-        actions = []
-        rewards = []
-        values  = []
-        r       = 0.0
-        terminal= False
-        features= []
-        prev_actions = []
-        prev_rewards = []
-        extrinsic_rewards = []
-
-        # select patch 1 in 36. each patch is 14x14
-        # idx = 6*x + y where x:[0,5], y[0:5], idx:[0,35]
-        # x =  idx // 6
+        timestep_limit = self.timestep_limit
+        beta = self.beta
+
+        states = self.rollout_states
+        actions = self.rollout_actions
+        rewards = self.rollout_rewards
+        values = self.rollout_values
+        prev_actions = self.rollout_prev_actions
+        prev_rewards = self.rollout_prev_rewards
+        # only use first feature into dynamic rnn
+        features = self.last_features
+        extrinsic_reward = 0.0
+        last_reward = self.last_reward
+        terminal = False
+
+        intrinsic = self.intrinsic_reward
         idx = meta_action.argmax()
-        #pos_x = idx // 6
-        #pos_y = idx - 6*pos_x
-        #goal_patch = np.zeros([84, 84, 3])
-        #if idx != 37:
-        #    goal_patch[ 14 * pos_x: 14 * (pos_x + 1) + 1, 14*pos_y: 14*(pos_y+1) +1 ] = 1
 
-        for _local_step in range(num_local_steps):
+        steps = 0
+        while steps < num_local_steps:
             # Take a step
-            fetched = policy.act(self.last_state, self.last_features[0], self.last_features[1],
-                                 self.last_action, self.last_reward, meta_action)
+            t0 = time.time()
+            inputs = (self.last_state, self.last_features[0], self.last_features[1], self.last_action,
+                      last_reward, meta_action)
+            fetched = None
+            if self.inference_actor and self.inference is not None:
+                try:
+                    fetched = self.inference.act(*inputs)
+                except InferenceError as e:
+                    self._inference_failed(e)
+            if fetched is None:
+                fetched = policy.act(*inputs)
             action, value_, features_ = fetched[0], fetched[1], fetched[2:]
+            t1 = time.time()
             # argmax to convert from one-hot
             state, reward, terminal, info = env.step(action.argmax())
+            if scheduler is not None:
+                scheduler.record('act', t1 - t0)
+                scheduler.record('env', time.time() - t1)
 
             # clip reward
             reward = min(1, max(-1, reward))
 
-            # Intrinsic reward
-            # Pixel control
-            #pixel_changes = (state - self.last_state)**2
-            # mean square error normalized by all pixel_changes
-            #intrinsic_reward = 0.05 * np.sum( pixel_changes * goal_patch ) / np.sum( pixel_changes + 1e-5)
-
-            # Feature control [selectivity (Bengio et al., 2017)]
-            conv_feature = policy.get_conv_feature(state)[0][0]
-            sel = np.abs(conv_feature[idx] - self.last_conv_feature[idx])
-            sel = sel / ( np.sum( np.abs(conv_feature - self.last_conv_feature) ) + 1e-5)
-            self.last_conv_feature = conv_feature
-
-            intrinsic_reward = 0.05 * sel
+            # Intrinsic reward for the goal set by the meta-controller
+            intrinsic_reward = intrinsic.reward(self.last_state, state, idx)
 
             # record extrinsic reward
-            extrinsic_rewards += [reward]
+            extrinsic_reward += reward
             self.ex_rewards += reward
             self.in_rewards += intrinsic_reward
 
             # Apply intrinsic reward
-            beta = self.beta
             reward = beta * reward + (1.0 - beta) * intrinsic_reward
 
             if self.visualise:
-                vis = state - 0.5 * state * goal_patch + 0.5 * goal_patch
-                vis = cv2.resize(vis, (500,500))
-                cv2.imshow('img', vis)
-                cv2.waitKey(10)
+                self.visualise.frame(state, idx)
 
             # collect the experience
-            states += [self.last_state]
-            actions += [action]
-            rewards += [reward]
-            values += [value_]
-            features += [self.last_features]
-            prev_actions += [self.last_action]
-            prev_rewards += [self.last_reward]
-
+            states[steps] = self.last_state
+            actions[steps] = action
+            rewards[steps] = reward
+            values[steps] = value_[0]
+            prev_actions[steps] = self.last_action
+            prev_rewards[steps] = last_reward
+            steps += 1
 
             self.length += 1
             self.rewards += reward
@@ -352,9 +731,10 @@ should be computed.
             self.last_state = state
             self.last_features = features_
             self.last_action = action
-            self.last_reward = [reward]
+            last_reward[0] = reward
 
-            if info:
+            # the other threads' envs report the same diagnostics
+            if info and self.thread == 0:
                 summary = tf.Summary()
                 for k, v in info.items():
                     summary.value.add(tag=k, simple_value=float(v))
@@ -363,22 +743,20 @@ should be computed.
                 self.summary_writer.add_summary(summary, policy.global_step.eval())
                 self.summary_writer.flush()
 
-            timestep_limit = env.spec.tags.get('wrapper_config.TimeLimit.max_episode_steps')
             if terminal or self.length >= timestep_limit:
                 terminal_end = True
-                if self.length >= timestep_limit or not env.metadata.get('semantics.autoreset'):
+                if self.length >= timestep_limit or not self.autoreset:
                     self.last_state = env.reset()
                 self.last_features = policy.get_initial_features()
+                if self.visualise:
+                    self.visualise.new_episode()
                 print("Episode finished. Sum of rewards: %d. Length: %d" % (self.rewards, self.length))
 
-                summary = tf.Summary()
-                summary.value.add(tag='global/episode_shaped_reward', simple_value=self.rewards)
-                summary.value.add(tag='global/shaped_reward_per_time', simple_value=self.rewards/self.length)
-                summary.value.add(tag='global/episode_extrinsic_reward', simple_value=self.ex_rewards)
-                summary.value.add(tag='global/episode_intrinsic_reward', simple_value=self.in_rewards)
-
-                self.summary_writer.add_summary(summary, policy.global_step.eval())
-                self.summary_writer.flush()
+                self.finished_episodes.append((self.rewards, self.rewards / float(self.length), self.ex_rewards,
+                                               self.in_rewards))
+                if self.thread == 0:
+                    self._write_episode_summary(policy.global_step.eval())
+                self.episode_stats.append((time.time(), self.ex_rewards, self.length))
 
                 self.length = 0
                 self.rewards = 0
@@ -387,59 +765,68 @@ should be computed.
 
                 break
 
+        r = 0.0
         if not terminal_end:
             r = policy.value(self.last_state, self.last_features[0],
                              self.last_features[1], self.last_action,
-                             self.last_reward, meta_action)
+                             last_reward, meta_action)
 
         # Process rollout
         gamma = 0.99
         lambda_ = 1.0
-        batch_si = np.asarray(states)
-        batch_a = np.asarray(actions)
-        rewards_plus_v = np.asarray(rewards + [r])
-        rewards = np.asarray(rewards)
-        vpred_t = np.asarray(values + [r])
-        batch_r = discount(rewards_plus_v, gamma)[:-1]
-        delta_t = rewards + gamma * vpred_t[1:] - vpred_t[:-1]
+        rewards[steps] = r
+        values[steps] = r
+        batch_r = discount(rewards[:steps + 1], gamma)[:-1]
+        delta_t = rewards[:steps] + gamma * values[1:steps + 1] - values[:steps]
         # this formula for the advantage comes "Generalized Advantage Estimation":
         # https://arxiv.org/abs/1506.02438
         batch_adv = discount(delta_t, gamma * lambda_)
-        batch_prev_a = np.asarray(prev_actions)
-        batch_prev_r = np.asarray(prev_rewards)
-        features = features[0] # only use first feature into dynamic rnn
-
 
         # Batch meta action
-        batch_meta_ac = np.repeat([meta_action], len(batch_si), axis=0)
+        batch_meta_ac = self.rollout_meta_actions[:steps]
+        batch_meta_ac[:] = meta_action
 
         # Gradient Calculation
-        should_compute_summary = self.task == 0 and self.local_steps % 11 == 0
+        should_compute_summary = self.task == 0 and self.thread == 0 and self.local_steps % 11 == 0
+        should_compute_images = self.task == 0 and self.thread == 0 and self._images_due()
+        fetches = [self.global_step]
         if should_compute_summary:
-            fetches = [self.summary_op, self.train_op, self.global_step]
-        else:
-            fetches = [self.train_op, self.global_step]
+            fetches = [self.summary_op] + fetches
+        if should_compute_images:
+            fetches = [self.image_summary_op] + fetches
 
 
 
         feed_dict = {
-            self.local_network.x: batch_si,
-            self.ac: batch_a,
+            self.local_network.x: states[:steps],
+            self.ac: actions[:steps],
             self.adv: batch_adv,
             self.r: batch_r,
             self.local_network.state_in[0]: features[0],
             self.local_network.state_in[1]: features[1],
-            self.local_network.prev_action: batch_prev_a,
-            self.local_network.prev_reward: batch_prev_r,
+            self.local_network.prev_action: prev_actions[:steps],
+            self.local_network.prev_reward: prev_rewards[:steps],
             self.local_network.meta_action: batch_meta_ac
         }
 
-        fetched = sess.run(fetches, feed_dict=feed_dict)
+        t0 = time.time()
+        fetched = self._update(sess, self.train_op, fetches, feed_dict, num_frames=steps)
+        if scheduler is not None:
+            scheduler.record('update', time.time() - t0)
 
-        if should_compute_summary:
+        if should_compute_images:
             self.summary_writer.add_summary(tf.Summary.FromString(fetched[0]), fetched[-1])
+            self.last_image_summary = time.time()
+        if should_compute_summary:
+            self.summary_writer.add_summary(tf.Summary.FromString(fetched[-2]), fetched[-1])
+            if scheduler is not None:
+                summary = tf.Summary()
+                summary.value.add(tag='model/rollout_length', simple_value=num_local_steps)
+                self.summary_writer.add_summary(summary, fetched[-1])
+        if should_compute_summary or should_compute_images:
             self.summary_writer.flush()
         self.local_steps += 1
+        self.local_frames += steps
 
         # discount extrinsic reward for the meta controller
         #gamma = 0.99
@@ -447,24 +834,30 @@ should be computed.
         #discount_filter = np.array([gamma**i for i in range(len(extrinsic_rewards))])
         #extrinsic_reward = np.sum(discount_filter * extrinsic_rewards)
 
-        return self.last_state, np.sum(extrinsic_rewards), terminal_end, None
-
-    def evaluate(self,sess):
+        return self.last_state, extrinsic_reward, terminal_end, None
 
-        global_step = sess.run(self.global_step)
-        sess.run(self.meta_sync)
-        sess.run(self.sync)
+    def evaluate(self, sess, global_step=None, num_episodes=100, write_summary=True):
+        """
+        Runs `num_episodes` episodes with the current global weights and returns their rewards and
+        lengths. Unless `write_summary` is off, their statistics are also written at `global_step`
+        (by default the global step of the weights).
+        """
+        self.sync_meta_weights(sess)
+        self.sync_weights(sess)
+        if global_step is None:
+            global_step = sess.run(self.global_step)
 
         meta_policy = self.local_meta_network
         policy = self.local_network
         env = self.env
         rewards_stat = []
         length_stat = []
-        # average over 100 episode?
-        for episode in range(100):
+        for episode in range(num_episodes):
             terminal = False
 
             last_state = env.reset()
+            if self.visualise:
+                self.visualise.new_episode()
             last_meta_state = last_state
             last_features = policy.get_initial_features()
             last_meta_features = meta_policy.get_initial_features()
@@ -474,7 +867,7 @@ should be computed.
             last_reward = [0]
             rewards = 0
             length = 0
-            last_conv_feature = np.zeros(self.meta_action_size)
+            intrinsic = make_intrinsic(self.intrinsic, policy, scale=self.intrinsic_scale)
 
 
             while not terminal:
@@ -487,29 +880,21 @@ should be computed.
 
                 idx = meta_action.argmax()
 
-                for _ in range(20*5):
+                for _ in range(self.num_actor_rollouts * self.num_local_steps):
                     fetched = policy.act(last_state, last_features[0], last_features[1],
                                      last_action, last_reward, meta_action)
                     action, value_, features_ = fetched[0], fetched[1], fetched[2:]
                     state, reward, terminal, info = env.step(action.argmax())
 
                     if self.visualise:
-                        vis = cv2.resize(state , (500,500))
-                        cv2.imshow('img', vis)
-                        cv2.waitKey(10)
+                        self.visualise.frame(state, idx)
 
                     env_reward = reward
 
                     # clip reward
                     reward = min(1, max(-1, reward))
 
-                    # Feature control [selectivity (Bengio et al., 2017)]
-                    conv_feature = policy.get_conv_feature(state)[0][0]
-                    sel = np.abs(conv_feature[idx] - last_conv_feature[idx])
-                    sel = sel / ( np.sum( np.abs(conv_feature - last_conv_feature) ) + 1e-5)
-                    last_conv_feature = conv_feature
-
-                    intrinsic_reward = 0.05 * sel
+                    intrinsic_reward = intrinsic.reward(last_state, state, idx)
 
                     # Apply intrinsic reward
                     beta = self.beta
@@ -524,8 +909,7 @@ should be computed.
                     last_reward = [shaped_reward]
                     meta_reward += reward
 
-                    timestep_limit = env.spec.tags.get('wrapper_config.TimeLimit.max_episode_steps')
-                    if terminal or length >= timestep_limit:
+                    if terminal or length >= self.timestep_limit:
                         terminal = True
                         break
 
@@ -540,9 +924,43 @@ should be computed.
             rewards_stat.append(rewards)
             length_stat.append(length)
 
+        if write_summary:
+            self.write_eval_summary(rewards_stat, length_stat, global_step)
+        return rewards_stat, length_stat
+
+    def write_eval_summary(self, rewards, lengths, global_step):
         summary = tf.Summary()
-        summary.value.add(tag='Eval/Average_Reward', simple_value=np.mean(rewards_stat))
-        summary.value.add(tag='Eval/SD_Reward', simple_value=np.std(rewards_stat))
-        summary.value.add(tag='Eval/Average_Lenght', simple_value=np.mean(length_stat))
+        summary.value.add(tag='Eval/Average_Reward', simple_value=np.mean(rewards))
+        summary.value.add(tag='Eval/SD_Reward', simple_value=np.std(rewards))
+        summary.value.add(tag='Eval/Average_Lenght', simple_value=np.mean(lengths))
         self.summary_writer.add_summary(summary, global_step)
         self.summary_writer.flush()
+
+
+class ActorThread(threading.Thread):
+    """
+    Runs `trainer.process` in a loop on its own thread. All actor threads of a worker share
+    one session and the global variables; TensorFlow releases the GIL inside sess.run, so the
+    threads overlap on inference, environment steps and gradient pushes.
+    """
+    def __init__(self, trainer, sess):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.trainer = trainer
+        self.sess = sess
+        self.errors = queue.Queue()
+        self.halt = threading.Event()
+
+    def run(self):
+        # the default session is thread local
+        with self.sess.as_default():
+            try:
+                while not self.halt.is_set():
+                    self.trainer.process(self.sess)
+            except Exception:
+                self.errors.put(sys.exc_info())
+
+    def check(self):
+        """Re-raise, on the calling thread, an exception that killed this actor."""
+        if not self.errors.empty():
+            six.reraise(*self.errors.get())
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the agent, run against a stand-in environment so that no emulator or VNC
+remote is needed. Each benchmark prints one line per measurement.
+
+    python bench.py rollout
+    python bench.py compression
+    python bench.py startup
+    python bench.py lstm
+    python bench.py quantized
+    python bench.py intrinsic
+    python bench.py meta
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+from a3c import A3C
+from graphcache import cached_graph, graph_key
+
+
+class _Space(object):
+    def __init__(self, shape=None, n=None):
+        self.shape = shape
+        self.n = n
+
+
+class _Spec(object):
+    def __init__(self, tags):
+        self.tags = tags
+
+
+class StandInEnv(object):
+    """
+    Looks like the output of create_atari_env. Each frame is filled with the index of the
+    rewarded action (scaled to [0, 1]) plus noise, so an agent can learn it quickly.
+    """
+    metadata = {}
+
+    def __init__(self, shape=(84, 84, 3), num_actions=6, episode_length=1000, seed=0):
+        self.observation_space = _Space(shape=shape)
+        self.action_space = _Space(n=num_actions)
+        self.spec = _Spec({'wrapper_config.TimeLimit.max_episode_steps': episode_length})
+        self.episode_length = episode_length
+        self.rng = np.random.RandomState(seed)
+        self.step_time = 0.0
+
+    def _frame(self):
+        self.target = self.rng.randint(self.action_space.n)
+        frame = self.rng.uniform(0.0, 0.1, self.observation_space.shape).astype(np.float32)
+        frame += float(self.target) / self.action_space.n
+        return frame
+
+    def reset(self):
+        self.t = 0
+        return self._frame()
+
+    def step(self, action):
+        t0 = time.time()
+        reward = 1.0 if action == self.target else 0.0
+        self.t += 1
+        frame = self._frame()
+        self.step_time += time.time() - t0
+        return frame, reward, self.t >= self.episode_length, {}
+
+
+class _NullWriter(object):
+    def add_summary(self, *args, **kwargs):
+        pass
+
+    def flush(self):
+        pass
+
+
+def local_session(trainer):
+    """A session on an in-process cluster laid out like the one worker.py uses."""
+    workers, _ = tf.test.create_local_cluster(num_workers=1, num_ps=1)
+    sess = tf.Session(workers[0].target)
+    sess.run(tf.global_variables_initializer())
+    sess.run([trainer.sync, trainer.meta_sync])
+    return sess
+
+
+def bench_rollout(args):
+    """
+    Time per env step of A3C.actor_process, split into env, TensorFlow and Python time.
+    Only public methods of A3C are used so the same script can be run against older revisions.
+    """
+    env = StandInEnv()
+    trainer = A3C(env, 0, False)
+    sess = local_session(trainer)
+    with sess.as_default():
+        trainer.start(sess, _NullWriter())
+        meta_action = np.eye(trainer.meta_action_size)[0]
+        policy = trainer.local_network
+        for _ in range(args.warmup):
+            trainer.actor_process(sess, meta_action)
+
+        # inference cost per step, measured on its own
+        c, h = policy.get_initial_features()
+        t0 = time.time()
+        for _ in range(args.steps):
+            policy.act(trainer.last_state, c, h, trainer.last_action, [0.0], meta_action)
+            policy.get_conv_feature(trainer.last_state)
+        act_time = (time.time() - t0) / args.steps
+
+        # update cost per rollout, measured on its own
+        t0 = time.time()
+        for _ in range(args.rollouts):
+            sess.run(trainer.sync)
+        sync_time = (time.time() - t0) / args.rollouts
+
+        env.step_time = 0.0
+        frames = sess.run(trainer.global_step)
+        t0 = time.time()
+        for _ in range(args.rollouts):
+            trainer.actor_process(sess, meta_action)
+        total = time.time() - t0
+        frames = sess.run(trainer.global_step) - frames
+
+    per_step = total / frames
+    env_time = env.step_time / frames
+    print("frames: %d" % frames)
+    print("total per step: %.1f us" % (1e6 * per_step))
+    print("env per step: %.1f us" % (1e6 * env_time))
+    print("inference per step: %.1f us" % (1e6 * act_time))
+    print("sync per step: %.1f us" % (1e6 * sync_time * args.rollouts / frames))
+    print("python + update per step: %.1f us" % (1e6 * (per_step - env_time - act_time
+                                                         - sync_time * args.rollouts / frames)))
+
+
+def bench_compression(args):
+    """
+    Bytes pushed per actor update and a short convergence check on the stand-in env for each
+    gradient compression mode. The stand-in reward is 1 for the action encoded in the frame, so
+    the extrinsic reward of a 20 step rollout should climb from about 3 towards 20.
+    """
+    for mode in args.modes.split(','):
+        with tf.Graph().as_default():
+            tf.set_random_seed(args.seed)
+            env = StandInEnv(seed=args.seed)
+            trainer = A3C(env, 0, False, grad_compression=mode)
+            sess = local_session(trainer)
+            sess.run(tf.local_variables_initializer())
+            with sess.as_default():
+                trainer.start(sess, _NullWriter())
+                meta_action = np.eye(trainer.meta_action_size)[0]
+                returns = []
+                t0 = time.time()
+                for _ in range(args.rollouts):
+                    returns.append(trainer.actor_process(sess, meta_action)[1])
+                elapsed = time.time() - t0
+            window = returns[-args.window:]
+            print("%s: %d bytes/update, reward per rollout over the last %d rollouts %.2f (first %d: %.2f), %.1f s"
+                  % (mode, trainer.grad_bytes, len(window), np.mean(window), len(window),
+                     np.mean(returns[:args.window]), elapsed))
+
+
+def bench_lstm(args):
+    """
+    BasicLSTMCell against LSTMBlockFusedCell. The fused graph restores a checkpoint written by the
+    basic one, then both get the same inputs: prints the largest differences in act, value and
+    the actor loss, and the time per act call and per actor update.
+    """
+    env = StandInEnv(seed=args.seed)
+    rng = np.random.RandomState(args.seed)
+    T = args.batch
+    meta_action_size = 32
+    eye = np.eye(env.action_space.n, dtype=np.float32)
+    frames = np.array([env._frame() for _ in range(T)])
+    actions = eye[rng.randint(env.action_space.n, size=T)]
+    prev_actions = eye[rng.randint(env.action_space.n, size=T)]
+    prev_rewards = rng.randn(T, 1).astype(np.float32)
+    meta_actions = np.eye(meta_action_size, dtype=np.float32)[rng.randint(meta_action_size, size=T)]
+    advantages = rng.randn(T).astype(np.float32)
+    returns = rng.randn(T).astype(np.float32)
+    checkpoint_dir = tempfile.mkdtemp()
+    checkpoint = os.path.join(checkpoint_dir, 'model.ckpt')
+
+    results = {}
+    try:
+        for fused in (False, True):
+            with tf.Graph().as_default():
+                trainer = A3C(env, 0, False, test=True, fused_lstm=fused)
+                saver = tf.train.Saver(trainer.store_variables())
+                config = tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=2)
+                with tf.Session(config=config) as sess, sess.as_default():
+                    sess.run(tf.global_variables_initializer())
+                    sess.run(tf.local_variables_initializer())
+                    if fused:
+                        saver.restore(sess, checkpoint)
+                    else:
+                        saver.save(sess, checkpoint)
+                    trainer.sync_weights(sess)
+                    trainer.sync_meta_weights(sess)
+                    pi = trainer.local_network
+                    meta_pi = trainer.local_meta_network
+
+                    # act step by step, carrying the state, and the meta policy on the same frames
+                    values, states, meta_values = [], [], []
+                    c, h = pi.get_initial_features()
+                    meta_c, meta_h = meta_pi.get_initial_features()
+                    for t in range(T):
+                        fetched = pi.act(frames[t], c, h, prev_actions[t], prev_rewards[t], meta_actions[t])
+                        c, h = fetched[2:]
+                        values.append(fetched[1])
+                        states += [c, h]
+                        fetched = meta_pi.act(frames[t], meta_c, meta_h, meta_actions[t], prev_rewards[t])
+                        meta_c, meta_h = fetched[2:]
+                        meta_values.append(fetched[1])
+                    c, h = pi.get_initial_features()
+                    value = pi.value(frames[0], c, h, prev_actions[0], prev_rewards[0], meta_actions[0])
+                    feed = {pi.x: frames, trainer.ac: actions, trainer.adv: advantages, trainer.r: returns,
+                            pi.state_in[0]: c, pi.state_in[1]: h, pi.prev_action: prev_actions,
+                            pi.prev_reward: prev_rewards, pi.meta_action: meta_actions}
+                    loss = sess.run(trainer.loss, feed)
+
+                    start = time.time()
+                    for t in range(args.steps):
+                        pi.act(frames[t % T], c, h, prev_actions[0], prev_rewards[0], meta_actions[0])
+                    act_time = (time.time() - start) / args.steps
+                    start = time.time()
+                    for _ in range(args.updates):
+                        sess.run(trainer.train_op, feed)
+                    update_time = (time.time() - start) / args.updates
+            results[fused] = dict(values=np.array(values), states=np.array(states), meta_values=np.array(meta_values),
+                                  value=value, loss=loss, act_time=act_time, update_time=update_time)
+    finally:
+        shutil.rmtree(checkpoint_dir)
+
+    basic, fused = results[False], results[True]
+    for key in ('values', 'states', 'meta_values', 'value', 'loss'):
+        print("max abs difference in %s: %.3g" % (key, np.max(np.abs(basic[key] - fused[key]))))
+    for key, label in (('act_time', 'act per step'), ('update_time', 'update per %d-step batch' % T)):
+        print("%s: basic %.1f us, fused %.1f us (%.2fx)" % (label, 1e6 * basic[key], 1e6 * fused[key],
+                                                          basic[key] / fused[key]))
+
+
+def kl_divergence(logits, other_logits):
+    """KL(softmax(logits) || softmax(other_logits)) for each row."""
+    def log_softmax(z):
+        z = z - z.max(axis=-1, keepdims=True)
+        return z - np.log(np.exp(z).sum(axis=-1, keepdims=True))
+    log_p, log_q = log_softmax(logits), log_softmax(other_logits)
+    return (np.exp(log_p) * (log_p - log_q)).sum(axis=-1)
+
+
+def bench_quantized(args):
+    """
+    Float32 against quantized acting. Along a trajectory acted by the float32 policies, prints the
+    mean and largest KL divergence between the float32 and quantized action distributions and the
+    largest value difference, for the actor and the meta policy, then the time per act call.
+    StandInEnv frames are noise, which is harder on 8 bit activations than real frames.
+    """
+    env = StandInEnv(seed=args.seed)
+    rng = np.random.RandomState(args.seed)
+    T = args.batch
+    meta_action_size = 32
+    eye = np.eye(env.action_space.n, dtype=np.float32)
+    meta_eye = np.eye(meta_action_size, dtype=np.float32)
+
+    trainer = A3C(env, 0, False, test=True, quantized_acting=True)
+    pi = trainer.local_network
+    meta_pi = trainer.local_meta_network
+    config = tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=2)
+    with tf.Session(config=config) as sess, sess.as_default():
+        sess.run(tf.global_variables_initializer())
+        sess.run(tf.local_variables_initializer())
+        trainer.sync_weights(sess)
+        trainer.sync_meta_weights(sess)
+
+        for name, policy, inputs in (('actor', pi, lambda: [eye[rng.randint(env.action_space.n)], [rng.randn()],
+                                                             meta_eye[rng.randint(meta_action_size)]]),
+                                     ('meta', meta_pi, lambda: [meta_eye[rng.randint(meta_action_size)], [rng.randn()]])):
+            placeholders = [policy.prev_action, policy.prev_reward] + \
+                ([policy.meta_action] if policy is pi else [])
+            c, h = policy.get_initial_features()
+            kl, value_error = [], []
+            for t in range(T):
+                feed = {policy.x: env._frame()[np.newaxis], policy.state_in[0]: c, policy.state_in[1]: h}
+                feed.update((p, [v]) for p, v in zip(placeholders, inputs()))
+                logits, vf, q_logits, q_vf, c, h = sess.run(
+                    [policy.logits, policy.vf, policy.quantized.logits, policy.quantized.vf] + policy.state_out, feed)
+                kl.append(kl_divergence(logits, q_logits)[0])
+                value_error.append(abs(vf[0] - q_vf[0]))
+            print("%s: KL(float32 || quantized) mean %.3g, max %.3g; max abs value difference %.3g"
+                  % (name, np.mean(kl), np.max(kl), np.max(value_error)))
+
+        frame = env._frame()
+        c, h = pi.get_initial_features()
+        quantized = pi.quantized
+        times = {}
+        for label, actor in (('float32', None), ('quantized', quantized)):
+            pi.quantized = actor
+            pi.act(frame, c, h, eye[0], [0.0], meta_eye[0])
+            start = time.time()
+            for _ in range(args.steps):
+                pi.act(frame, c, h, eye[0], [0.0], meta_eye[0])
+            times[label] = (time.time() - start) / args.steps
+        print("act per step: float32 %.1f us, quantized %.1f us (%.2fx)"
+              % (1e6 * times['float32'], 1e6 * times['quantized'], times['float32'] / times['quantized']))
+
+
+def bench_intrinsic(args):
+    """
+    Env steps per second of A3C.actor_process with each intrinsic reward, and the time per step
+    spent on the reward itself. For the pixel reward also the time for a whole rollout at once.
+    """
+    for name in args.engines.split(','):
+        env = StandInEnv(seed=args.seed)
+        with tf.Graph().as_default():
+            trainer = A3C(env, 0, False, test=True, intrinsic=name)
+            config = tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=2)
+            with tf.Session(config=config) as sess, sess.as_default():
+                sess.run(tf.global_variables_initializer())
+                sess.run(tf.local_variables_initializer())
+                trainer.sync_weights(sess)
+                trainer.start(sess, _NullWriter())
+                meta_action = np.eye(trainer.meta_action_size)[0]
+                for _ in range(args.warmup):
+                    trainer.actor_process(sess, meta_action)
+
+                frames = sess.run(trainer.global_step)
+                t0 = time.time()
+                for _ in range(args.rollouts):
+                    trainer.actor_process(sess, meta_action)
+                total = time.time() - t0
+                frames = sess.run(trainer.global_step) - frames
+
+                states = np.array([env._frame() for _ in range(trainer.num_local_steps + 1)])
+                intrinsic = trainer.intrinsic_reward
+                t0 = time.time()
+                for t in range(args.steps):
+                    intrinsic.reward(states[t % trainer.num_local_steps], states[t % trainer.num_local_steps + 1], 0)
+                reward_time = (time.time() - t0) / args.steps
+                batch_time = None
+                if hasattr(intrinsic, 'rewards'):
+                    goals = np.zeros(trainer.num_local_steps, np.int64)
+                    t0 = time.time()
+                    for _ in range(args.rollouts):
+                        intrinsic.rewards(states[:-1], states[1:], goals)
+                    batch_time = (time.time() - t0) / args.rollouts / trainer.num_local_steps
+        line = "%s: %.0f steps/s, reward %.1f us per step" % (name, frames / total, 1e6 * reward_time)
+        if batch_time is not None:
+            line += ", %.1f us per step over a %d step rollout" % (1e6 * batch_time, trainer.num_local_steps)
+        print(line)
+
+
+def bench_meta(args):
+    """
+    Time per A3C.process with the meta LSTM trained on the conv features cached while acting,
+    against running the conv layers again. The actor takes a single step per meta-step, so the
+    time is mostly meta-controller acting and its update.
+    """
+    for cached in (False, True):
+        env = StandInEnv(seed=args.seed)
+        with tf.Graph().as_default():
+            tf.set_random_seed(args.seed)
+            trainer = A3C(env, 0, False, test=True, num_actor_rollouts=1, num_local_steps=1,
+                          meta_cached_features=cached)
+            config = tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=2)
+            with tf.Session(config=config) as sess, sess.as_default():
+                sess.run(tf.global_variables_initializer())
+                sess.run(tf.local_variables_initializer())
+                trainer.sync_weights(sess)
+                trainer.start(sess, _NullWriter())
+                for _ in range(args.warmup):
+                    trainer.process(sess)
+                t0 = time.time()
+                for _ in range(args.updates):
+                    trainer.process(sess)
+                elapsed = (time.time() - t0) / args.updates
+        print("%s: %.1f ms per meta update of %d steps" % ("cached features" if cached else "conv again",
+                                                          1e3 * elapsed, trainer.num_meta_steps))
+
+
+def startup_child(args):
+    """One process of bench_startup; prints the time at which its first rollout is done."""
+    env = StandInEnv(seed=args.task)
+
+    def build():
+        return [A3C(env, args.task, False, test=True)]
+
+    if args.graph_cache is None:
+        trainers = build()
+    else:
+        key = graph_key(benchmark='startup', observation_shape=list(env.observation_space.shape),
+                        num_actions=env.action_space.n)
+        trainers, imported = cached_graph(args.graph_cache, key, args.task, build)
+        if imported:
+            trainers[0].attach(env, args.task)
+    trainer = trainers[0]
+    config = tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=2)
+    with tf.Session(config=config) as sess, sess.as_default():
+        sess.run(tf.global_variables_initializer())
+        sess.run(tf.local_variables_initializer())
+        trainer.sync_meta_weights(sess)
+        trainer.sync_weights(sess)
+        trainer.start(sess, _NullWriter())
+        trainer.actor_process(sess, np.eye(trainer.meta_action_size)[0])
+    print(repr(time.time()))
+
+
+def bench_startup(args):
+    """
+    Time to first step of N worker-like processes started together: imports, graph construction,
+    session setup and one actor rollout, each process in its own local graph. Runs without the
+    graph cache, with an empty cache (one process builds and exports, the others wait and import)
+    and with the filled cache.
+    """
+    cache = tempfile.mkdtemp()
+    try:
+        for label, extra in [('no cache', []), ('cold cache', ['--graph-cache', cache]),
+                             ('warm cache', ['--graph-cache', cache])]:
+            start = time.time()
+            procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'startup-child', '--task', str(i)]
+                                      + extra, stdout=subprocess.PIPE) for i in range(args.workers)]
+            ready = []
+            for p in procs:
+                out, _ = p.communicate()
+                if p.returncode != 0:
+                    raise RuntimeError("startup-child exited with status {}".format(p.returncode))
+                ready.append(float(out.decode('utf-8').split()[-1]) - start)
+            print("%s: time to first step %.1f s on average, %.1f s for the last of %d processes"
+                  % (label, np.mean(ready), max(ready), args.workers))
+    finally:
+        shutil.rmtree(cache)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    p = subparsers.add_parser('rollout', help="Per-step overhead of the actor rollout loop")
+    p.add_argument('--rollouts', default=200, type=int)
+    p.add_argument('--steps', default=2000, type=int)
+    p.add_argument('--warmup', default=10, type=int)
+    p.set_defaults(func=bench_rollout)
+
+    p = subparsers.add_parser('compression', help="Gradient compression: bytes per update and convergence")
+    p.add_argument('--modes', default='none,fp16,topk,int8')
+    p.add_argument('--rollouts', default=3000, type=int)
+    p.add_argument('--window', default=200, type=int)
+    p.add_argument('--seed', default=0, type=int)
+    p.set_defaults(func=bench_compression)
+
+    p = subparsers.add_parser('lstm', help="Basic against fused LSTM: agreement, act and update time")
+    p.add_argument('--batch', default=20, type=int)
+    p.add_argument('--steps', default=2000, type=int)
+    p.add_argument('--updates', default=200, type=int)
+    p.add_argument('--seed', default=0, type=int)
+    p.set_defaults(func=bench_lstm)
+
+    p = subparsers.add_parser('quantized', help="Float32 against quantized acting: KL divergence and act time")
+    p.add_argument('--batch', default=200, type=int)
+    p.add_argument('--steps', default=2000, type=int)
+    p.add_argument('--seed', default=0, type=int)
+    p.set_defaults(func=bench_quantized)
+
+    p = subparsers.add_parser('intrinsic', help="Steps per second and reward cost of each intrinsic reward")
+    p.add_argument('--engines', default='feature,pixel')
+    p.add_argument('--rollouts', default=200, type=int)
+    p.add_argument('--steps', default=2000, type=int)
+    p.add_argument('--warmup', default=10, type=int)
+    p.add_argument('--seed', default=0, type=int)
+    p.set_defaults(func=bench_intrinsic)
+
+    p = subparsers.add_parser('meta', help="Meta-controller update time with and without cached features")
+    p.add_argument('--updates', default=200, type=int)
+    p.add_argument('--warmup', default=10, type=int)
+    p.add_argument('--seed', default=0, type=int)
+    p.set_defaults(func=bench_meta)
+
+    p = subparsers.add_parser('startup', help="Time to first step of concurrently started workers, with and without the graph cache")
+    p.add_argument('--workers', default=32, type=int)
+    p.set_defaults(func=bench_startup)
+
+    p = subparsers.add_parser('startup-child')
+    p.add_argument('--task', default=0, type=int)
+    p.add_argument('--graph-cache', default=None)
+    p.set_defaults(func=startup_child)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,89 +2,60 @@ import cv2
 from gym.spaces.box import Box
 import numpy as np
 import gym
-from gym import spaces
 import logging
-import universe
-from universe import vectorized
-from universe.wrappers import BlockingReset, GymCoreAction, EpisodeID, Unvectorize, Vectorize, Vision, Logger
-from universe import spaces as vnc_spaces
-from universe.spaces.vnc_event import keycode
 import time
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-universe.configure_logging()
 
-def create_env(env_id, client_id, remotes, **kwargs):
-    spec = gym.spec(env_id)
+# Observation modes for Atari games, as FramePreprocessor arguments. The model picks up the
+# observation shape from the env, so the conv layers follow the mode.
+OBS_MODES = {
+    '84x84x3': dict(size=84, channels=3),
+    '84x84x1': dict(size=84, channels=1),
+    '42x42x1': dict(size=42, channels=1, crop=(34, 0, 160, 160), intermediate=80),
+}
+
+def is_vnc_env(env_id):
+    # universe environments have dots in names and run in VNC remotes
+    return "." in env_id
 
-    if spec.tags.get('flashgames', False):
-        return create_flash_env(env_id, client_id, remotes, **kwargs)
-    elif spec.tags.get('atari', False) and spec.tags.get('vnc', False):
-        return create_vncatari_env(env_id, client_id, remotes, **kwargs)
+def create_env(env_id, client_id, remotes, **kwargs):
+    if is_vnc_env(env_id):
+        # universe (and its logging setup) is only imported for the environments that need it
+        import vnc_envs
+        return vnc_envs.create_env(env_id, client_id, remotes, **kwargs)
     else:
         # Assume atari.
-        assert "." not in env_id  # universe environments have dots in names.
-        return create_atari_env(env_id)
+        return create_atari_env(env_id, **kwargs)
 
-def create_flash_env(env_id, client_id, remotes, **_):
+def create_atari_env(env_id, obs_mode='84x84x3', **_):
     env = gym.make(env_id)
-    env = Vision(env)
-    env = Logger(env)
-    env = BlockingReset(env)
-
-    reg = universe.runtime_spec('flashgames').server_registry
-    height = reg[env_id]["height"]
-    width = reg[env_id]["width"]
-    env = CropScreen(env, height, width, 84, 18)
-    env = FlashRescale(env)
-
-    keys = ['left', 'right', 'up', 'down', 'x']
-    if env_id == 'flashgames.NeonRace-v0':
-        # Better key space for this game.
-        keys = ['left', 'right', 'up', 'left up', 'right up', 'down', 'up x']
-    logger.info('create_flash_env(%s): keys=%s', env_id, keys)
-
-    env = DiscreteToFixedKeysVNCActions(env, keys)
-    env = EpisodeID(env)
+    env = AtariRescale(env, obs_mode)
     env = DiagnosticsInfo(env)
-    env = Unvectorize(env)
-    env.configure(fps=5.0, remotes=remotes, start_timeout=15 * 60, client_id=client_id,
-                  vnc_driver='go', vnc_kwargs={
-                    'encoding': 'tight', 'compress_level': 0,
-                    'fine_quality_level': 50, 'subsample_level': 3})
     return env
 
-def create_vncatari_env(env_id, client_id, remotes, **_):
-    env = gym.make(env_id)
-    env = Vision(env)
-    env = Logger(env)
-    env = BlockingReset(env)
-    env = GymCoreAction(env)
-    env = AtariRescale42x42(env)
-    env = EpisodeID(env)
-    env = DiagnosticsInfo(env)
-    env = Unvectorize(env)
-
-    logger.info('Connecting to remotes: %s', remotes)
-    fps = env.metadata['video.frames_per_second']
-    env.configure(remotes=remotes, start_timeout=15 * 60, fps=fps, client_id=client_id)
-    return env
+class DiagnosticsInfo(gym.Wrapper):
+    """Replaces the info of every step by the statistics of a Diagnostics tracker."""
+    def __init__(self, env, log_interval=503):
+        super(DiagnosticsInfo, self).__init__(env)
+        self.diagnostics = Diagnostics(log_interval)
 
-def create_atari_env(env_id):
-    env = gym.make(env_id)
-    env = Vectorize(env)
-    env = AtariRescale42x42(env)
-    env = DiagnosticsInfo(env)
-    env = Unvectorize(env)
-    return env
+    def _reset(self):
+        observation = self.env.reset()
+        self.diagnostics.reset()
+        return observation
 
-def DiagnosticsInfo(env, *args, **kwargs):
-    return vectorized.VectorizeFilter(env, DiagnosticsInfoI, *args, **kwargs)
+    def _step(self, action):
+        observation, reward, done, info = self.env.step(action)
+        return observation, reward, done, self.diagnostics.step(observation, reward, done, info)
 
-class DiagnosticsInfoI(vectorized.Filter):
+class Diagnostics(object):
+    """
+    Episode and throughput statistics of an environment, reported through the info dict of every
+    step (the agent writes them as summaries). Shared by the DiagnosticsInfo wrapper above and its
+    universe counterpart in vnc_envs.
+    """
     def __init__(self, log_interval=503):
-        super(DiagnosticsInfoI, self).__init__()
-
         self._episode_time = time.time()
         self._last_time = time.time()
         self._local_t = 0
@@ -95,14 +66,14 @@ class DiagnosticsInfoI(vectorized.Filter):
         self._num_vnc_updates = 0
         self._last_episode_id = -1
 
-    def _after_reset(self, observation):
+    def reset(self):
         logger.info('Resetting environment')
         self._episode_reward = 0
         self._episode_length = 0
         self._all_rewards = []
-        return observation
 
-    def _after_step(self, observation, reward, done, info):
+    def step(self, observation, reward, done, info):
+        """Updates the statistics with one step and returns the ones to log."""
         to_log = {}
         if self._episode_length == 0:
             self._episode_time = time.time()
@@ -163,126 +134,54 @@ class DiagnosticsInfoI(vectorized.Filter):
             self._episode_length = 0
             self._all_rewards = []
 
-        return observation, reward, done, to_log
-"""
-def _process_frame42(frame):
-    print(np.shape(frame))
-    frame = frame[34:34+160, :160]
-    # Resize by half, then down to 42x42 (essentially mipmapping). If
-    # we resize directly we lose pixels that, when mapped to 42x42,
-    # aren't close enough to the pixel boundary.
-    frame = cv2.resize(frame, (80, 80))
-    frame = cv2.resize(frame, (42, 42))
-    frame = frame.mean(2)
-    frame = frame.astype(np.float32)
-    frame *= (1.0 / 255.0)
-    frame = np.reshape(frame, [42, 42, 1])
-    return frame
-"""
+        return to_log
 
-def _process_frame42(frame):
-    frame = cv2.resize(frame, (84, 84))
-    frame = frame.astype(np.float32)
-    frame *= (1.0/ 255.0)
-    frame = np.reshape(frame, [84, 84, 3])
-    return frame
 
-
-class AtariRescale42x42(vectorized.ObservationWrapper):
-    def __init__(self, env=None):
-        super(AtariRescale42x42, self).__init__(env)
-        #self.observation_space = Box(0.0, 1.0, [42, 42, 1])
-        self.observation_space = Box(0.0, 1.0, [84, 84, 3])
-
-    def _observation(self, observation_n):
-        return [_process_frame42(observation) for observation in observation_n]
-
-class FixedKeyState(object):
-    def __init__(self, keys):
-        self._keys = [keycode(key) for key in keys]
-        self._down_keysyms = set()
-
-    def apply_vnc_actions(self, vnc_actions):
-        for event in vnc_actions:
-            if isinstance(event, vnc_spaces.KeyEvent):
-                if event.down:
-                    self._down_keysyms.add(event.key)
-                else:
-                    self._down_keysyms.discard(event.key)
-
-    def to_index(self):
-        action_n = 0
-        for key in self._down_keysyms:
-            if key in self._keys:
-                # If multiple keys are pressed, just use the first one
-                action_n = self._keys.index(key) + 1
-                break
-        return action_n
-
-class DiscreteToFixedKeysVNCActions(vectorized.ActionWrapper):
+class FramePreprocessor(object):
     """
-    Define a fixed action space. Action 0 is all keys up. Each element of keys can be a single key or a space-separated list of keys
-
-    For example,
-       e=DiscreteToFixedKeysVNCActions(e, ['left', 'right'])
-    will have 3 actions: [none, left, right]
-
-    You can define a state with more than one key down by separating with spaces. For example,
-       e=DiscreteToFixedKeysVNCActions(e, ['left', 'right', 'space', 'left space', 'right space'])
-    will have 6 actions: [none, left, right, space, left space, right space]
+    Turns a batch of raw RGB frames into float observations in [0, 1].
+
+    Frames are optionally cropped (top, left, height, width), resized with bilinear interpolation,
+    optionally averaged over the color channels (as the old 42x42 preprocessing did), and scaled
+    into float32. `intermediate` adds a first resize to that size (essentially mipmapping) for
+    large downscales, instead of one INTER_AREA resize. This is the same work as the old
+    per-frame function, which it replaces: the float output is allocated for every batch, since
+    the agent keeps observations around across steps.
     """
-    def __init__(self, env, keys):
-        super(DiscreteToFixedKeysVNCActions, self).__init__(env)
-
-        self._keys = keys
-        self._generate_actions()
-        self.action_space = spaces.Discrete(len(self._actions))
-
-    def _generate_actions(self):
-        self._actions = []
-        uniq_keys = set()
-        for key in self._keys:
-            for cur_key in key.split(' '):
-                uniq_keys.add(cur_key)
-
-        for key in [''] + self._keys:
-            split_keys = key.split(' ')
-            cur_action = []
-            for cur_key in uniq_keys:
-                cur_action.append(vnc_spaces.KeyEvent.by_name(cur_key, down=(cur_key in split_keys)))
-            self._actions.append(cur_action)
-        self.key_state = FixedKeyState(uniq_keys)
-
-    def _action(self, action_n):
-        # Each action might be a length-1 np.array. Cast to int to
-        # avoid warnings.
-        return [self._actions[int(action)] for action in action_n]
-
-class CropScreen(vectorized.ObservationWrapper):
-    """Crops out a [height]x[width] area starting from (top,left) """
-    def __init__(self, env, height, width, top=0, left=0):
-        super(CropScreen, self).__init__(env)
-        self.height = height
-        self.width = width
-        self.top = top
-        self.left = left
-        self.observation_space = Box(0, 255, shape=(height, width, 3))
-
-    def _observation(self, observation_n):
-        return [ob[self.top:self.top+self.height, self.left:self.left+self.width, :] if ob is not None else None
-                for ob in observation_n]
-
-def _process_frame_flash(frame):
-    frame = cv2.resize(frame, (200, 128))
-    frame = frame.mean(2).astype(np.float32)
-    frame *= (1.0 / 255.0)
-    frame = np.reshape(frame, [128, 200, 1])
-    return frame
-
-class FlashRescale(vectorized.ObservationWrapper):
-    def __init__(self, env=None):
-        super(FlashRescale, self).__init__(env)
-        self.observation_space = Box(0.0, 1.0, [128, 200, 1])
-
-    def _observation(self, observation_n):
-        return [_process_frame_flash(observation) for observation in observation_n]
+    scale = np.float32(1.0 / 255.0)
+
+    def __init__(self, size=84, channels=3, crop=None, intermediate=None):
+        self.size = size
+        self.channels = channels
+        self.crop = crop
+        self.intermediate = intermediate
+        self.shape = (size, size, channels)
+        self._resized = np.empty((size, size, 3), np.uint8)
+        if intermediate is not None:
+            self._intermediate = np.empty((intermediate, intermediate, 3), np.uint8)
+
+    def __call__(self, frames):
+        out = np.empty((len(frames),) + self.shape, np.float32)
+        for i, frame in enumerate(frames):
+            if self.crop is not None:
+                top, left, height, width = self.crop
+                frame = frame[top:top + height, left:left + width]
+            if self.intermediate is not None:
+                frame = cv2.resize(frame, (self.intermediate, self.intermediate), dst=self._intermediate)
+            frame = cv2.resize(frame, (self.size, self.size), dst=self._resized)
+            if self.channels == 1:
+                # the sum of three uint8 values is exact in float32: same values as mean(2) in float64
+                frame = frame.mean(2, dtype=np.float32, keepdims=True)
+            np.multiply(frame, self.scale, out=out[i])
+        return list(out)
+
+
+class AtariRescale(gym.ObservationWrapper):
+    """Rescales Atari frames to one of the OBS_MODES."""
+    def __init__(self, env=None, obs_mode='84x84x3'):
+        super(AtariRescale, self).__init__(env)
+        self.preprocess = FramePreprocessor(**OBS_MODES[obs_mode])
+        self.observation_space = Box(0.0, 1.0, list(self.preprocess.shape))
+
+    def _observation(self, observation):
+        return self.preprocess([observation])[0]
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""
+Bounded event logs. A RotatingFileWriter starts a new event file once the current one reaches a
+size or an age, and folds the closed files into one archive file in which the old points are
+thinned out by a retention policy. The retention policy is a list of age:resolution pairs:
+
+    6h:60,2d:600    all points of the last 6 hours, then one point per tag and minute, and one
+                    per 10 minutes for the points older than 2 days
+
+`python eventlog.py -l <log-dir> [-o <out-dir>]` merges the event files of every run of a job
+(train_0, train_1, ..., train_eval) into one file in <out-dir>, with the run name in front of
+every tag, optionally thinned out the same way, for TensorBoard to load at once.
+"""
+from __future__ import print_function
+import argparse
+import glob
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import tensorflow as tf
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def _seconds(text):
+    match = re.match(r'^(\d+(?:\.\d+)?)([smhd]?)$', text.strip())
+    if match is None:
+        raise ValueError("Not a duration: {!r}".format(text))
+    return float(match.group(1)) * _UNITS[match.group(2) or 's']
+
+
+def parse_retention(text):
+    """"6h:60,2d:600" as [(21600.0, 60.0), (172800.0, 600.0)], sorted by age; [] for ''."""
+    policy = []
+    for item in filter(None, (t.strip() for t in (text or '').split(','))):
+        age, _, resolution = item.partition(':')
+        policy.append((_seconds(age), _seconds(resolution)))
+    return sorted(policy)
+
+
+def _resolution(policy, age):
+    resolution = 0
+    for min_age, r in policy:
+        if age >= min_age:
+            resolution = r
+    return resolution
+
+
+def event_files(logdir):
+    return sorted(glob.glob(os.path.join(logdir, 'events.out.tfevents.*')))
+
+
+def read_events(paths):
+    for path in paths:
+        try:
+            for event in tf.train.summary_iterator(path):
+                yield event
+        except tf.errors.DataLossError:
+            # the truncated last record of a file that was being written
+            logger.warn("Skipping the truncated end of %s", path)
+
+
+def compact_events(events, policy, now=None, prefix=None):
+    """
+    The summary values of `events` thinned out by `policy`, one value per event, with `prefix` in
+    front of the tags. They are sorted by step, since TensorBoard drops the points after a step
+    that goes back. Of the graphs, only the last one is kept; the session logs are dropped, since
+    their restarts would make TensorBoard discard points of the merged runs.
+    """
+    now = time.time() if now is None else now
+    kept = {}
+    graph = None
+    for event in events:
+        if event.HasField('graph_def') or event.HasField('meta_graph_def'):
+            graph = event
+            continue
+        if not event.HasField('summary'):
+            continue
+        for value in event.summary.value:
+            resolution = _resolution(policy, now - event.wall_time)
+            if resolution:
+                key = (value.tag, int(event.wall_time // resolution))
+            else:
+                key = (value.tag, event.wall_time, event.step)
+            previous = kept.get(key)
+            if previous is None or previous[0] <= event.wall_time:
+                kept[key] = (event.wall_time, event.step, value)
+    compacted = [graph] if graph is not None else []
+    for wall_time, step, value in sorted(kept.values(), key=lambda k: (k[1], k[0])):
+        summary = tf.Summary()
+        summary.value.add().CopyFrom(value)
+        if prefix:
+            summary.value[0].tag = prefix + '/' + value.tag
+        compacted.append(tf.Event(wall_time=wall_time, step=step, summary=summary))
+    return compacted
+
+
+def write_events(events, path):
+    """Writes `events` to the event file `path` (replacing it), through a temporary directory."""
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(path))
+    try:
+        writer = tf.summary.FileWriter(tmp)
+        for event in events:
+            writer.add_event(event)
+        writer.close()
+        os.rename(event_files(tmp)[0], path)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _archive_name(events, fallback, name=None):
+    # TensorBoard reads the files of a run in name order: the archive goes before the newer files
+    start = min([e.wall_time for e in events] or [fallback])
+    return 'events.out.tfevents.{:010d}.{}archive'.format(int(start), name + '.' if name else '')
+
+
+def _is_archive(path, name=None):
+    pattern = r'^events\.out\.tfevents\.\d+\.{}archive$'.format(re.escape(name + '.') if name else '')
+    return re.match(pattern, os.path.basename(path)) is not None
+
+
+class RotatingFileWriter(tf.summary.FileWriter):
+    """
+    A FileWriter that starts a new event file when the current one has grown past `max_bytes` or is
+    older than `max_secs` (0: no limit). With a `retention` policy, the closed files are then merged
+    into one archive file of the run by a background thread, thinned out by the policy.
+    The checks are made in `flush`, which the agent calls after writing its summaries. The actor
+    threads of a worker share one writer: adding waits while the file is being swapped.
+
+    Several writers can share a directory (the eval workers): a writer only compacts the event
+    files it opened itself and its own archive, which carries `name` when given.
+    """
+    def __init__(self, logdir, max_bytes=0, max_secs=0, retention=None, name=None, **kwargs):
+        before = set(event_files(logdir))
+        super(RotatingFileWriter, self).__init__(logdir, **kwargs)
+        self.max_bytes = max_bytes
+        self.max_secs = max_secs
+        self.retention = retention or []
+        self.name = name
+        self._opened = time.time()
+        # the event files this writer opened, the last one being written
+        self._files = self._opened_files(before)
+        self._compacting = None
+        # held while the event file is closed and reopened
+        self._lock = threading.RLock()
+
+    def _opened_files(self, before):
+        """The event file just opened: from the writer itself, else the new files of the directory."""
+        writer = getattr(self.event_writer, '_ev_writer', None)
+        if writer is not None and hasattr(writer, 'FileName'):
+            path = writer.FileName()
+            return [path.decode('utf-8') if isinstance(path, bytes) else path]
+        return sorted(f for f in set(event_files(self.get_logdir())) - before if not f.endswith('.archive'))
+
+    def _current_file(self):
+        return self._files[-1] if self._files else None
+
+    def _due(self):
+        if self.max_secs and time.time() - self._opened >= self.max_secs:
+            return True
+        if self.max_bytes:
+            path = self._current_file()
+            try:
+                return path is not None and os.path.getsize(path) >= self.max_bytes
+            except OSError:
+                return False
+        return False
+
+    def add_summary(self, *args, **kwargs):
+        with self._lock:
+            super(RotatingFileWriter, self).add_summary(*args, **kwargs)
+
+    def add_event(self, event):
+        with self._lock:
+            super(RotatingFileWriter, self).add_event(event)
+
+    def _rotation_due(self):
+        # event files are named after the second they are opened in: at most one a second
+        return self._due() and int(time.time()) != int(self._opened)
+
+    def flush(self):
+        with self._lock:
+            super(RotatingFileWriter, self).flush()
+        if self._rotation_due():
+            self.rotate()
+
+    def rotate(self):
+        """Closes the current event file and opens a new one, if that is still due."""
+        with self._lock:
+            # another thread may have rotated since this one looked
+            if not self._rotation_due():
+                return
+            self.close()
+            closed = self._files + [f for f in event_files(self.get_logdir()) if _is_archive(f, self.name)]
+            before = set(event_files(self.get_logdir()))
+            self.reopen()
+            self._opened = time.time()
+            self._files = self._opened_files(before)
+            if self.retention and (self._compacting is None or not self._compacting.is_alive()):
+                self._compacting = threading.Thread(target=self._compact, args=(closed,), name='compact-events')
+                self._compacting.daemon = True
+                self._compacting.start()
+
+    def _compact(self, paths):
+        try:
+            archives = [p for p in paths if _is_archive(p, self.name)]
+            events = compact_events(read_events(sorted(paths)), self.retention)
+            archive = os.path.join(self.get_logdir(), _archive_name(events, self._opened, self.name))
+            write_events(events, archive)
+            for path in paths:
+                if path != archive:
+                    os.remove(path)
+            logger.info("Compacted %d event files of %s into %s", len(paths) - len(archives),
+                        self.get_logdir(), os.path.basename(archive))
+        except Exception:
+            # the files stay as they are; the next rotation tries again
+            logger.exception("Cannot compact the event files of %s", self.get_logdir())
+
+
+def make_summary_writer(logdir, max_mb=0, max_hours=0, retention='', name=None):
+    """
+    The summary writer of a worker: a plain FileWriter unless a limit or a policy is given. `name`
+    tells apart the archives of writers that share `logdir`.
+    """
+    if not (max_mb or max_hours or retention):
+        return tf.summary.FileWriter(logdir)
+    return RotatingFileWriter(logdir, max_bytes=int(max_mb * 1e6), max_secs=max_hours * 3600,
+                              retention=parse_retention(retention), name=name)
+
+
+def compact_job(log_dir, out_dir, retention=None):
+    """Merges the runs of a job (the event directories under `log_dir`) into one file in `out_dir`."""
+    out = os.path.abspath(out_dir)
+    runs = sorted(os.path.basename(d) for d in glob.glob(os.path.join(log_dir, '*'))
+                  if event_files(d) and os.path.abspath(d) != out)
+    events = []
+    read = 0
+    for run in runs:
+        paths = event_files(os.path.join(log_dir, run))
+        read += sum(os.path.getsize(p) for p in paths)
+        run_events = compact_events(read_events(paths), retention or [], prefix=run)
+        # one graph for the merged file, the first run's
+        if events and run_events and not run_events[0].HasField('summary'):
+            run_events = run_events[1:]
+        events += run_events
+    events.sort(key=lambda e: (e.step, e.wall_time))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    for path in event_files(out_dir):
+        os.remove(path)
+    path = os.path.join(out_dir, _archive_name(events, time.time()))
+    write_events(events, path)
+    return runs, read, os.path.getsize(path), len(events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-l', '--log-dir', required=True, help="Log directory of the job")
+    parser.add_argument('-o', '--out-dir', default=None,
+                        help="Output directory (default: <log-dir>_compact, outside the directory TensorBoard watches)")
+    parser.add_argument('--retention', default='', help="Retention policy, e.g. 6h:60,2d:600 (default: keep every point)")
+    args = parser.parse_args()
+    out_dir = args.out_dir or os.path.normpath(args.log_dir) + '_compact'
+    runs, read, written, count = compact_job(args.log_dir, out_dir, parse_retention(args.retention))
+    print("Merged {} runs ({}): {:.1f} MB into {} events, {:.1f} MB in {}".format(
+        len(runs), ', '.join(runs), read / 1e6, count, written / 1e6, out_dir))
+
+
+if __name__ == "__main__":
+    main()
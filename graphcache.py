@@ -0,0 +1,149 @@
+"""
+Cache of the worker graph. The first worker that needs a graph builds it and exports it as a
+MetaGraph, together with the names of the tensors, operations and variables held by its A3C
+objects. Later workers import the MetaGraph and bind those names again, which skips building the
+networks and their gradients op by op from Python. Worker devices in the cached graph are
+rewritten to the task of the importing worker.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import numpy as np
+import six
+import tensorflow as tf
+import a3c
+import model
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_CLASSES = {'A3C': a3c.A3C, 'LSTMPolicy': model.LSTMPolicy, 'MetaPolicy': model.MetaPolicy,
+            'QuantizedActor': model.QuantizedActor}
+_WORKER_TASK = re.compile(r'(/job:worker/(?:replica:\d+/)?task:)\d+')
+
+
+def graph_key(**config):
+    """Names the cache entry of a graph built with `config`, by this code and this TensorFlow."""
+    digest = hashlib.md5(json.dumps(config, sort_keys=True).encode('utf-8'))
+    digest.update(tf.VERSION.encode('utf-8'))
+    for module in (a3c, model):
+        with open(os.path.splitext(module.__file__)[0] + '.py', 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def _encode(value):
+    if isinstance(value, tf.Variable):
+        return {'variable': value.name}
+    if isinstance(value, tf.Tensor):
+        return {'tensor': value.name}
+    if isinstance(value, tf.Operation):
+        return {'op': value.name}
+    if isinstance(value, np.ndarray):
+        return {'ndarray': value.tolist(), 'dtype': str(value.dtype)}
+    if isinstance(value, np.generic):
+        return {'value': value.item()}
+    if isinstance(value, list):
+        return {'list': [_encode(v) for v in value]}
+    if isinstance(value, tuple):
+        return {'tuple': [_encode(v) for v in value]}
+    if type(value).__name__ in _CLASSES:
+        skip = getattr(value, 'runtime_attributes', ())
+        return {'object': type(value).__name__,
+                'attributes': dict((k, _encode(v)) for k, v in vars(value).items() if k not in skip)}
+    if value is None or isinstance(value, (bool, float) + six.integer_types + six.string_types):
+        return {'value': value}
+    raise TypeError("Cannot cache an attribute of type {}".format(type(value).__name__))
+
+
+def _decode(encoded, graph, variables):
+    if 'variable' in encoded:
+        return variables[encoded['variable']]
+    if 'tensor' in encoded:
+        return graph.get_tensor_by_name(encoded['tensor'])
+    if 'op' in encoded:
+        return graph.get_operation_by_name(encoded['op'])
+    if 'ndarray' in encoded:
+        return np.array(encoded['ndarray'], encoded['dtype'])
+    if 'list' in encoded:
+        return [_decode(v, graph, variables) for v in encoded['list']]
+    if 'tuple' in encoded:
+        return tuple(_decode(v, graph, variables) for v in encoded['tuple'])
+    if 'object' in encoded:
+        cls = _CLASSES[encoded['object']]
+        obj = cls.__new__(cls)
+        for k, v in encoded['attributes'].items():
+            setattr(obj, k, _decode(v, graph, variables))
+        return obj
+    return encoded['value']
+
+
+def export_graph(path, trainers):
+    """Writes the default graph to `path`.meta and the bindings of `trainers` to `path`.json."""
+    meta_graph = tf.train.export_meta_graph()
+    for node in meta_graph.graph_def.node:
+        node.device = _WORKER_TASK.sub(r'\g<1>0', node.device)
+    bindings = [_encode(t) for t in trainers]
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(bindings, f)
+    os.rename(tmp, path + '.json')
+    # the .meta file goes last: its presence marks a complete entry
+    with open(tmp, 'wb') as f:
+        f.write(meta_graph.SerializeToString())
+    os.rename(tmp, path + '.meta')
+
+
+def import_graph(path, task):
+    """
+    Imports `path` into the default graph with the worker ops placed on `task`. Returns the
+    trainers, which still need A3C.attach.
+    """
+    meta_graph = tf.MetaGraphDef()
+    with open(path + '.meta', 'rb') as f:
+        meta_graph.ParseFromString(f.read())
+    for node in meta_graph.graph_def.node:
+        node.device = _WORKER_TASK.sub(r'\g<1>{}'.format(task), node.device)
+    tf.train.import_meta_graph(meta_graph)
+    graph = tf.get_default_graph()
+    variables = dict((v.name, v) for v in tf.global_variables() + tf.local_variables())
+    with open(path + '.json') as f:
+        bindings = json.load(f)
+    return [_decode(b, graph, variables) for b in bindings]
+
+
+def cached_graph(cache_dir, key, task, build, timeout=10 * 60):
+    """
+    Returns (trainers, imported). The trainers come from the cache entry `key` if there is one;
+    otherwise `build()` makes them and they are exported for the workers after this one. While
+    another worker builds the entry, this one waits for it instead of building too.
+    """
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # another worker got there first
+            pass
+    path = os.path.join(cache_dir, key)
+    deadline = time.time() + timeout
+    while not os.path.exists(path + '.meta'):
+        try:
+            os.close(os.open(path + '.lock', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            if time.time() > deadline:
+                logger.warn('Gave up waiting for the graph cache entry %s; building the graph', path)
+                return build(), False
+            time.sleep(0.5)
+            continue
+        try:
+            trainers = build()
+            export_graph(path, trainers)
+        finally:
+            os.remove(path + '.lock')
+        logger.info('Exported the graph to %s.meta', path)
+        return trainers, False
+    logger.info('Importing the graph from %s.meta', path)
+    return import_graph(path, task), True
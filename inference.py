@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+"""
+Inference server for the workers of one host. It holds a copy of the global policies, refreshed
+from the parameter server (or the shared-memory store) every --sync-secs, and answers act
+requests of the workers over a Unix socket. Requests that arrive within --max-wait-ms of each
+other are run as one batch, up to --max-batch.
+
+    python inference.py --log-dir /tmp/pong --ps 127.0.0.1:12222
+
+Workers started with --inference <socket> send the act steps of their meta-controller to the
+server (and those of the actor too with --inference-actor). The graph is built on the first
+connection, from the shapes the worker sends, so the server does not need an environment.
+"""
+from __future__ import print_function
+import argparse
+import logging
+import os
+import pickle
+import socket
+import struct
+import threading
+import time
+import numpy as np
+import six.moves.queue as queue
+from six.moves import socketserver
+import tensorflow as tf
+from model import LSTMPolicy, MetaPolicy, BatchedStep
+from sharedmem import SharedParameterStore
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_HEADER = struct.Struct('!I')
+
+
+class InferenceError(Exception):
+    pass
+
+
+def send_message(sock, message):
+    data = pickle.dumps(message, 2)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            raise EOFError("connection closed")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    size, = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return pickle.loads(_recv_exactly(sock, size))
+
+
+class InferenceClient(object):
+    """
+    One connection to the server, for one actor thread. `act` and `meta_act` take and return the
+    same values as LSTMPolicy.act and MetaPolicy.act. They raise InferenceError when the server
+    does not answer within `timeout` seconds.
+    """
+    def __init__(self, path, ob_shape, num_actions, meta_action_size, fused_lstm=False, timeout=30.0):
+        self.path = path
+        self.shape = dict(ob_shape=[int(d) for d in ob_shape], num_actions=int(num_actions),
+                          meta_action_size=int(meta_action_size), fused_lstm=bool(fused_lstm))
+        self.timeout = timeout
+        self.sock = None
+
+    def _request(self, message):
+        try:
+            if self.sock is None:
+                self._connect()
+                send_message(self.sock, dict(kind='hello', **self.shape))
+                self._check(recv_message(self.sock))
+            send_message(self.sock, message)
+            return self._check(recv_message(self.sock))
+        except (socket.error, socket.timeout, EOFError, struct.error) as e:
+            self.close()
+            raise InferenceError("inference server at {}: {}".format(self.path, e))
+
+    def _connect(self):
+        # the server may still be starting: wait up to `timeout` for its socket
+        deadline = time.time() + self.timeout
+        while True:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            try:
+                self.sock.connect(self.path)
+                return
+            except socket.error:
+                self.close()
+                if time.time() >= deadline:
+                    raise
+            time.sleep(0.5)
+
+    def _check(self, reply):
+        if 'error' in reply:
+            self.close()
+            raise InferenceError(reply['error'])
+        return reply.get('fetched')
+
+    def act(self, ob, c, h, prev_a, prev_r, meta_a):
+        return self._request(dict(kind='actor', x=ob, c=c, h=h, prev_a=prev_a, prev_r=prev_r, meta_a=meta_a))
+
+    def meta_act(self, ob, c, h, prev_a, prev_r, with_hidden=False):
+        return self._request(dict(kind='meta', x=ob, c=c, h=h, prev_a=prev_a, prev_r=prev_r,
+                                  with_hidden=with_hidden))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class StoreWeights(object):
+    """Global weights from the shared-memory store of the job, made for the workers' `optimizer`."""
+    def __init__(self, path, optimizer='adam'):
+        self.path = path
+        self.optimizer = optimizer
+        self.store = None
+
+    def read(self, variables):
+        if self.store is None:
+            store = SharedParameterStore(self.path, self.optimizer)
+            # the layout of the store starts with the policy variables in this order; a store of
+            # another size (another --optimizer) never attaches, so give up soon and report it
+            try:
+                store.attach([(v.name, v.get_shape()) for v in variables], timeout=10)
+            except RuntimeError:
+                raise RuntimeError("no store at {} with the layout of --optimizer {}".format(self.path, self.optimizer))
+            self.store = store
+        return [self.store.read(v.name).copy() for v in variables]
+
+
+class ParameterServerWeights(object):
+    """Global weights read from the parameter server, by the names the workers give them."""
+    def __init__(self, target):
+        self.target = target
+        self.sess = None
+
+    def read(self, variables):
+        if self.sess is None:
+            graph = tf.Graph()
+            with graph.as_default(), tf.device("/job:ps/task:0"):
+                self.remote = [tf.get_variable(v.op.name, v.get_shape(), v.dtype.base_dtype) for v in variables]
+            config = tf.ConfigProto(device_filters=["/job:ps"], operation_timeout_in_ms=60000)
+            self.sess = tf.Session(self.target, graph=graph, config=config)
+        return self.sess.run(self.remote)
+
+
+class _Batcher(threading.Thread):
+    """Runs the queued requests of one kind in batches."""
+    def __init__(self, server, kind, step, policy, max_batch, max_wait):
+        threading.Thread.__init__(self, name='batch-' + kind)
+        self.daemon = True
+        self.server = server
+        self.step = step
+        self.policy = policy
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.batched = 0
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._run(batch)
+            except Exception as e:
+                logger.exception("Batch of %d failed", len(batch))
+                for request in batch:
+                    request['reply'] = dict(error=str(e))
+                    request['done'].set()
+
+    def _run(self, batch):
+        step, policy = self.step, self.policy
+        feed = {policy.x: np.stack([r['x'] for r in batch]),
+                step.c_in: np.concatenate([r['c'] for r in batch]),
+                step.h_in: np.concatenate([r['h'] for r in batch]),
+                policy.prev_action: np.stack([r['prev_a'] for r in batch]),
+                policy.prev_reward: np.stack([r['prev_r'] for r in batch])}
+        fetches = list(step.fetches)
+        if hasattr(policy, 'meta_action'):
+            feed[policy.meta_action] = np.stack([r['meta_a'] for r in batch])
+        if any(r.get('with_hidden') for r in batch):
+            fetches.append(step.hidden)
+        fetched = self.server.sess.run(fetches, feed)
+        self.batches += 1
+        self.batched += len(batch)
+        for i, request in enumerate(batch):
+            # the shapes of a batch-of-one act: the action row, [value], [1, size] states
+            reply = [fetched[0][i], fetched[1][i:i + 1], fetched[2][i:i + 1], fetched[3][i:i + 1]]
+            if request.get('with_hidden'):
+                reply.append(fetched[4][i:i + 1])
+            request['reply'] = dict(fetched=reply)
+            request['done'].set()
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server.inference
+        while True:
+            try:
+                message = recv_message(self.request)
+            except (EOFError, socket.error):
+                return
+            batcher = server.batchers.get(message.get('kind'))
+            if message.get('kind') == 'hello':
+                reply = server.hello(message)
+            elif batcher is None:
+                reply = dict(error="unknown request {!r} (or no hello yet)".format(message.get('kind')))
+            else:
+                message['done'] = threading.Event()
+                batcher.requests.put(message)
+                message['done'].wait()
+                reply = message['reply']
+            try:
+                send_message(self.request, reply)
+            except socket.error:
+                return
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class InferenceServer(object):
+    """
+    Serves act requests at the Unix socket `path` with the weights of `source` (StoreWeights or
+    ParameterServerWeights), read every `sync_secs` seconds. A hello is answered with an error if
+    the weights cannot be read within `ready_secs`, below the 30 s timeout of the clients.
+    """
+    def __init__(self, path, source, sync_secs=1.0, max_batch=64, max_wait_ms=2.0, config=None, ready_secs=20.0):
+        self.path = path
+        self.source = source
+        self.sync_secs = sync_secs
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.config = config
+        self.ready_secs = ready_secs
+        self.shape = None
+        self.sess = None
+        self.batchers = {}
+        # held while the graph is built
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        # why the last read of the weights failed
+        self.sync_error = None
+
+    def hello(self, message):
+        """Builds the graph for the first worker; the others have to send the same shapes."""
+        shape = dict((k, v) for k, v in message.items() if k != 'kind')
+        with self.lock:
+            if self.shape is None:
+                self._build(shape)
+                self.shape = shape
+        if shape != self.shape:
+            return dict(error="the server runs {}, not {}".format(self.shape, shape))
+        if not self.ready.wait(self.ready_secs):
+            return dict(error="the server has no weights yet after {:.0f}s: {}".format(
+                self.ready_secs, self.sync_error or "the first read is still running"))
+        return dict(fetched=None)
+
+    def _build(self, shape):
+        logger.info("Building the policies for %s", shape)
+        graph = tf.Graph()
+        with graph.as_default(), tf.device("/cpu:0"):
+            # the names of the global variables of the workers
+            with tf.variable_scope("global"):
+                network = LSTMPolicy(shape['ob_shape'], shape['num_actions'], shape['meta_action_size'],
+                                     shape['fused_lstm'])
+                meta_network = MetaPolicy(shape['ob_shape'], shape['meta_action_size'], shape['fused_lstm'])
+            with tf.variable_scope("batched"):
+                steps = dict(actor=(BatchedStep(network, "lstm"), network),
+                             meta=(BatchedStep(meta_network, "meta_lstm"), meta_network))
+            variables = []
+            for v in network.var_list + meta_network.var_list:
+                if v not in variables:
+                    variables.append(v)
+            self.values = [tf.placeholder(v.dtype.base_dtype, v.get_shape()) for v in variables]
+            self.assign = tf.group(*[v.assign(value) for v, value in zip(variables, self.values)])
+        self.variables = variables
+        self.sess = tf.Session(graph=graph, config=self.config)
+        for kind, (step, policy) in steps.items():
+            self.batchers[kind] = _Batcher(self, kind, step, policy, self.max_batch, self.max_wait)
+            self.batchers[kind].start()
+        thread = threading.Thread(target=self._sync, name='sync')
+        thread.daemon = True
+        thread.start()
+
+    def _sync(self):
+        last_report = time.time()
+        while True:
+            try:
+                values = self.source.read(self.variables)
+                self.sess.run(self.assign, dict(zip(self.values, values)))
+                self.ready.set()
+                self.sync_error = None
+            except Exception as e:
+                self.sync_error = "{}: {}".format(type(e).__name__, e)
+                logger.exception("Cannot read the global weights")
+            if time.time() - last_report >= 60:
+                last_report = time.time()
+                for kind, batcher in sorted(self.batchers.items()):
+                    if batcher.batches:
+                        logger.info("%s: %d requests in %d batches (%.1f per batch)", kind, batcher.batched,
+                                    batcher.batches, batcher.batched / float(batcher.batches))
+            time.sleep(self.sync_secs)
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = _ThreadingUnixServer(self.path, _Handler)
+        server.inference = self
+        logger.info("Serving act requests at %s", self.path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(self.path)
+
+
+def default_socket_path(log_dir):
+    return os.path.join(log_dir, 'inference.sock')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--log-dir', default="/tmp/pong", help="Log directory of the job")
+    parser.add_argument('--socket', default=None, help="Socket path (default: <log-dir>/inference.sock)")
+    parser.add_argument('--ps', default=None, help="host:port of the parameter server to read the weights from")
+    parser.add_argument('--shm-path', default=None, help="Shared-memory store to read the weights from instead")
+    parser.add_argument('--optimizer', default='adam', choices=['adam', 'shared-adam', 'shared-rmsprop'],
+                        help="--optimizer of the workers, which the layout of the store depends on")
+    parser.add_argument('--sync-secs', default=1.0, type=float, help="Seconds between weight refreshes")
+    parser.add_argument('--max-batch', default=64, type=int, help="Largest batch")
+    parser.add_argument('--max-wait-ms', default=2.0, type=float,
+                        help="How long the first request of a batch waits for others")
+    parser.add_argument('--threads', default=0, type=int, help="TF intra-op threads (0: TF default)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    if (args.ps is None) == (args.shm_path is None):
+        parser.error("give one of --ps and --shm-path")
+    if args.ps is not None:
+        source = ParameterServerWeights('grpc://' + args.ps)
+    else:
+        source = StoreWeights(args.shm_path, args.optimizer)
+    config = tf.ConfigProto(intra_op_parallelism_threads=args.threads, inter_op_parallelism_threads=2)
+    InferenceServer(args.socket or default_socket_path(args.log_dir), source, args.sync_secs, args.max_batch,
+                    args.max_wait_ms, config).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Intrinsic rewards for the actor. The meta-controller picks a goal (the index of its one-hot action)
+and the actor is rewarded for changing the part of the observation the goal stands for:
+
+    feature  selectivity of one of the 32 channels of the last conv layer (Bengio et al., 2017);
+             needs a forward pass of the conv layers for every frame
+    pixel    share of the squared frame difference that falls in one of the 6x6 patches of the
+             frame; goal 36 is "no patch". Computed from the frames alone.
+
+An engine is made per actor with `make_intrinsic(name, policy)` and asked for the reward of every
+step with `reward(last_state, state, goal)`.
+"""
+import numpy as np
+
+
+class FeatureControl(object):
+    num_goals = 32
+
+    def __init__(self, policy, scale=0.05):
+        self.policy = policy
+        self.scale = scale
+        self.last_feature = np.zeros(self.num_goals)
+
+    def reward(self, last_state, state, goal):
+        # the previous frame's features are those computed at the previous step
+        feature = self.policy.get_conv_feature(state)[0][0]
+        change = np.abs(feature - self.last_feature)
+        self.last_feature = feature
+        return self.scale * change[goal] / (np.sum(change) + 1e-5)
+
+
+class PixelControl(object):
+    grid = 6
+    num_goals = grid * grid + 1
+
+    def __init__(self, policy=None, scale=0.05):
+        self.scale = scale
+
+    def patch_changes(self, last_states, states):
+        """
+        Squared frame differences of a batch of frames ([n, height, width, channels]) summed over
+        each patch, as [n, 37] with the last column 0, and summed over the whole frame, as [n].
+        """
+        n, height, width = states.shape[:3]
+        ph, pw = height // self.grid, width // self.grid
+        changes = np.square(states - last_states)
+        # strided sums over the patches; rows and columns past the grid only count in the total
+        patches = changes[:, :ph * self.grid, :pw * self.grid].reshape(n, self.grid, ph, self.grid, pw, -1)
+        patches = patches.sum(axis=(2, 4, 5)).reshape(n, -1)
+        totals = changes.reshape(n, -1).sum(axis=1) + 1e-5 * changes[0].size
+        return np.concatenate([patches, np.zeros((n, 1), patches.dtype)], axis=1), totals
+
+    def rewards(self, last_states, states, goals):
+        """Rewards of a batch of transitions for their goal indices, all at once."""
+        patches, totals = self.patch_changes(np.asarray(last_states), np.asarray(states))
+        return self.scale * patches[np.arange(len(patches)), goals] / totals
+
+    def reward(self, last_state, state, goal):
+        return self.rewards(last_state[np.newaxis], state[np.newaxis], [goal])[0]
+
+
+INTRINSIC_REWARDS = {'feature': FeatureControl, 'pixel': PixelControl}
+
+
+def make_intrinsic(name, policy, **kwargs):
+    return INTRINSIC_REWARDS[name](policy, **kwargs)
@@ -0,0 +1,223 @@
+"""
+Live metrics of a worker.py process. A MetricsServer samples the actors of the process every few
+seconds and answers HTTP GET requests on a Unix socket with the latest sample as JSON:
+
+    curl --unix-socket <log-dir>/metrics/w-0.sock http://localhost/
+
+Rates are over the last sampling interval. `python train.py --scrape 5 -l <log-dir>` reads every
+socket of a job and prints one table for the whole host.
+"""
+from __future__ import print_function
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from six.moves import BaseHTTPServer, socketserver
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# bytes in a sockaddr_un path, including the terminating NUL
+_MAX_SOCKET_PATH = 108
+
+
+def socket_path(log_dir, name):
+    return os.path.join(log_dir, 'metrics', name + '.sock')
+
+
+def process_usage():
+    """Resident memory (bytes) and cpu time (user + system seconds, all threads) of this process."""
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    times = os.times()
+    return rss, times[0] + times[1]
+
+
+class WorkerMetrics(object):
+    """
+    Counters of the actors (A3C instances) of one process, and their rates since the previous
+    `sample()`. Reads the counters without locking: a sample may be one update off.
+    """
+    def __init__(self, name, trainers, episodes=20):
+        self.name = name
+        self.trainers = trainers
+        self.episodes = episodes
+        self.last = None
+        self.current = self._state(self._counters())
+
+    def _counters(self):
+        counters = dict(time=time.time(), frames=0, updates=0, syncs=0, sync_secs=0.0)
+        for t in self.trainers:
+            counters['frames'] += t.local_frames
+            counters['updates'] += t.local_steps
+            counters['syncs'] += t.syncs
+            counters['sync_secs'] += t.sync_secs
+        counters['rss'], counters['cpu_secs'] = process_usage()
+        return counters
+
+    def _state(self, counters):
+        episodes = []
+        for t in self.trainers:
+            episodes += list(t.episode_stats)
+        episodes = sorted(episodes)[-self.episodes:]
+        state = dict(name=self.name, pid=os.getpid(), time=counters['time'], frames=counters['frames'],
+                     updates=counters['updates'], rss_mb=counters['rss'] / 1e6, episodes=len(episodes),
+                     fps=None, updates_per_sec=None, sync_ms=None, cpu_percent=None,
+                     episode_reward=None, episode_length=None)
+        if episodes:
+            state['episode_reward'] = sum(e[1] for e in episodes) / float(len(episodes))
+            state['episode_length'] = sum(e[2] for e in episodes) / float(len(episodes))
+        last = self.last
+        if last is not None and counters['time'] > last['time']:
+            elapsed = counters['time'] - last['time']
+            state['fps'] = (counters['frames'] - last['frames']) / elapsed
+            state['updates_per_sec'] = (counters['updates'] - last['updates']) / elapsed
+            state['cpu_percent'] = 100.0 * (counters['cpu_secs'] - last['cpu_secs']) / elapsed
+            if counters['syncs'] > last['syncs']:
+                state['sync_ms'] = 1000.0 * (counters['sync_secs'] - last['sync_secs']) / (counters['syncs'] - last['syncs'])
+        return state
+
+    def sample(self):
+        counters = self._counters()
+        self.current = self._state(counters)
+        self.last = counters
+        return self.current
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(self.server.metrics.current, sort_keys=True).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # a Unix socket has no client address, and scrapes are too frequent to log
+        pass
+
+
+class MetricsServer(object):
+    """Serves the WorkerMetrics of `trainers` at `path`, sampled every `interval` seconds."""
+    def __init__(self, path, name, trainers, interval=5):
+        self.path = path
+        self.metrics = WorkerMetrics(name, trainers)
+        self.interval = interval
+        self.server = None
+
+    def start(self):
+        """Starts serving, or logs why not and returns None."""
+        if len(self.path) >= _MAX_SOCKET_PATH:
+            logger.warn("Not serving metrics: the socket path %s is too long", self.path)
+            return None
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.path):
+            # left behind by the previous run of this task
+            os.remove(self.path)
+        self.server = socketserver.UnixStreamServer(self.path, _Handler)
+        self.server.metrics = self.metrics
+        for name, target in (('metrics-http', self.server.serve_forever), ('metrics-sample', self._sample)):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+        logger.info("Serving metrics at %s", self.path)
+        return self
+
+    def _sample(self):
+        while True:
+            self.metrics.sample()
+            time.sleep(self.interval)
+
+    def close(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def scrape(path, timeout=2.0):
+    """The metrics served at the Unix socket `path`, or None if nothing answers there."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(b'GET / HTTP/1.0\r\nHost: localhost\r\n\r\n')
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except (socket.error, socket.timeout):
+        return None
+    finally:
+        sock.close()
+    response = b''.join(chunks)
+    header, _, body = response.partition(b'\r\n\r\n')
+    if not header.startswith(b'HTTP/') or header.split()[1] != b'200':
+        return None
+    try:
+        return json.loads(body.decode('utf-8'))
+    except ValueError:
+        return None
+
+
+_COLUMNS = [
+    # title, key, width, format, how to total the column
+    ('process', 'name', 10, '', None),
+    ('pid', 'pid', 7, 'd', None),
+    ('frames/s', 'fps', 9, '.1f', sum),
+    ('updates/s', 'updates_per_sec', 9, '.2f', sum),
+    ('sync ms', 'sync_ms', 8, '.1f', None),
+    ('cpu%', 'cpu_percent', 7, '.1f', sum),
+    ('rss MB', 'rss_mb', 8, '.0f', sum),
+    ('episodes', 'episodes', 8, 'd', None),
+    ('reward', 'episode_reward', 8, '.2f', None),
+    ('length', 'episode_length', 8, '.0f', None),
+]
+
+
+def _line(cells):
+    return ' '.join(cell.ljust(width) if key == 'name' else cell.rjust(width)
+                    for cell, (_, key, width, _, _) in zip(cells, _COLUMNS))
+
+
+def _row(row):
+    return _line(['-' if row.get(key) is None else format(row[key], fmt) for _, key, _, fmt, _ in _COLUMNS])
+
+
+def format_table(rows, slow=0.5):
+    """
+    The metrics of several processes as a table with a total line. Workers below `slow` times the
+    median frames per second are marked with a *.
+    """
+    workers = [r for r in rows if r.get('fps') is not None and not r['name'].startswith('ps')]
+    rates = sorted(r['fps'] for r in workers)
+    median = rates[len(rates) // 2] if rates else None
+    lines = [_line([title for title, _, _, _, _ in _COLUMNS])]
+    for row in rows:
+        line = _row(row)
+        if median and row in workers and row['fps'] < slow * median:
+            line += ' *'
+        lines.append(line)
+    totals = dict(name='total')
+    for _, key, _, _, total in _COLUMNS:
+        values = [r[key] for r in rows if r.get(key) is not None]
+        if total is not None and values:
+            totals[key] = total(values)
+    lines.append(_row(totals))
+    return '\n'.join(lines)
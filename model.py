@@ -48,18 +48,71 @@ def categorical_sample(logits, d):
     return tf.one_hot(value, d)
 
 
-class LSTMPolicy(object):
-    def __init__(self, ob_space, ac_space, meta_ac_space):
+def lstm_state_tuple(c, h):
+    if use_tf100_api:
+        return rnn.LSTMStateTuple(c, h)
+    return rnn.rnn_cell.LSTMStateTuple(c, h)
+
+
+class RecurrentPolicy(object):
+    # a QuantizedActor that act() uses instead of the float32 graph when set
+    quantized = None
+
+    def _acting_fetches(self):
+        if self.quantized is not None:
+            return self.quantized.fetches
+        return [self.sample, self.vf] + self.state_out
+
+    def _lstm(self, x, size, fused=False):
+        """
+        Runs an LSTM over the time dimension of x ([1, time, features]) and sets up the state
+        placeholders and initial values. Returns the outputs ([time, size]) and the final state.
+
+        The fused variant is a single LSTMBlockFusedCell op for the whole sequence instead of a
+        while loop of small ops. Its variables are named like those of BasicLSTMCell under
+        dynamic_rnn (rnn/basic_lstm_cell/kernel and bias, same gate layout), so checkpoints load
+        either way.
+        """
+        self.state_size = lstm_state_tuple(size, size)
+        # from the LSTM input, which need not be computed from self.x (see MetaPolicy.hidden_in)
+        step_size = tf.shape(x)[1:2]
+
+        c_init = np.zeros((1, size), np.float32)
+        h_init = np.zeros((1, size), np.float32)
+        self.state_init = [c_init, h_init]
+        c_in = tf.placeholder(tf.float32, [1, size])
+        h_in = tf.placeholder(tf.float32, [1, size])
+        self.state_in = [c_in, h_in]
+
+        if fused:
+            lstm = rnn.LSTMBlockFusedCell(size)
+            with tf.variable_scope('rnn'):
+                # the fused cell is time major
+                lstm_outputs, (lstm_c, lstm_h) = lstm(
+                    tf.transpose(x, [1, 0, 2]), initial_state=(c_in, h_in), sequence_length=step_size,
+                    scope='basic_lstm_cell')
+        else:
+            lstm = rnn.BasicLSTMCell(size, state_is_tuple=True)
+            lstm_outputs, lstm_state = tf.nn.dynamic_rnn(
+                lstm, x, initial_state=lstm_state_tuple(c_in, h_in), sequence_length=step_size,
+                time_major=False)
+            lstm_c, lstm_h = lstm_state
+        return tf.reshape(lstm_outputs, [-1, size]), lstm_c, lstm_h
+
+
+class LSTMPolicy(RecurrentPolicy):
+    def __init__(self, ob_space, ac_space, meta_ac_space, fused_lstm=False):
 
         with tf.variable_scope('conv'):
             self.x = x = tf.placeholder(tf.float32, [None] + list(ob_space))
 
             x = tf.nn.relu( conv2d(x, 16, "l1", [8, 8], [4, 4]) )
             x = tf.nn.relu( conv2d(x, 32, "l2", [4, 4], [2, 2]) )
-            # x is [?, 11, 11, 32]
+            # x is [?, 11, 11, 32] for 84x84 observations, [?, 6, 6, 32] for 42x42
             self.conv_feature = tf.reduce_mean(x, axis=[1,2])
 
             x = tf.nn.relu(linear(flatten(x), 256, "hidden",  normalized_columns_initializer(1.0)))
+            self.hidden = x
 
             self.prev_action = prev_action = tf.placeholder(tf.float32, [None, ac_space], "prev_a")
             self.prev_reward = prev_reward = tf.placeholder(tf.float32, [None, 1], "prev_r")
@@ -78,27 +131,7 @@ class LSTMPolicy(object):
 
         with tf.variable_scope('lstm'):
             size = 256
-            lstm = rnn.BasicLSTMCell(size, state_is_tuple=True)
-
-            self.state_size = lstm.state_size
-            step_size = tf.shape(self.x)[:1]
-
-            c_init = np.zeros((1, lstm.state_size.c), np.float32)
-            h_init = np.zeros((1, lstm.state_size.h), np.float32)
-            self.state_init = [c_init, h_init]
-            c_in = tf.placeholder(tf.float32, [1, lstm.state_size.c])
-            h_in = tf.placeholder(tf.float32, [1, lstm.state_size.h])
-            self.state_in = [c_in, h_in]
-
-            if use_tf100_api:
-                state_in = rnn.LSTMStateTuple(c_in, h_in)
-            else:
-                state_in = rnn.rnn_cell.LSTMStateTuple(c_in, h_in)
-            lstm_outputs, lstm_state = tf.nn.dynamic_rnn(
-                lstm, x, initial_state=state_in, sequence_length=step_size,
-                time_major=False)
-            lstm_c, lstm_h = lstm_state
-            x = tf.reshape(lstm_outputs, [-1, size])
+            x, lstm_c, lstm_h = self._lstm(x, size, fused_lstm)
             self.logits = linear(x, ac_space, "action", normalized_columns_initializer(0.01))
             self.vf = tf.reshape(linear(x, 1, "value", normalized_columns_initializer(1.0)), [-1])
             self.state_out = [lstm_c[:1, :], lstm_h[:1, :]]
@@ -112,24 +145,29 @@ class LSTMPolicy(object):
 
     def act(self, ob, c, h, prev_a, prev_r, meta_a):
         sess = tf.get_default_session()
-        return sess.run([self.sample, self.vf] + self.state_out,
-                        {self.x: [ob], self.state_in[0]: c,
+        return sess.run(self._acting_fetches(),
+                        {self.x: ob[np.newaxis], self.state_in[0]: c,
                         self.state_in[1]: h, self.prev_action: [prev_a],
                         self.prev_reward: [prev_r], self.meta_action: [meta_a] })
 
     def value(self, ob, c, h, prev_a, prev_r, meta_a):
         sess = tf.get_default_session()
-        return sess.run(self.vf, {self.x: [ob], self.state_in[0]: c,
+        return sess.run(self.vf, {self.x: ob[np.newaxis], self.state_in[0]: c,
                         self.state_in[1]: h, self.prev_action: [prev_a],
                         self.prev_reward: [prev_r], self.meta_action: [meta_a]})[0]
 
     def get_conv_feature(self, ob):
         sess = tf.get_default_session()
-        return sess.run([self.conv_feature], {self.x: [ob]})
+        return sess.run([self.conv_feature], {self.x: ob[np.newaxis]})
 
 
-class MetaPolicy(object):
-    def __init__(self, ob_space, ac_space = 37):
+class MetaPolicy(RecurrentPolicy):
+    def __init__(self, ob_space, ac_space = 37, fused_lstm=False, cached_features=False):
+        """
+        With `cached_features` the LSTM input goes through `hidden_in`, which defaults to the hidden
+        features of x without their gradient: training can feed the features cached while acting
+        instead of x, and only updates the meta LSTM and heads.
+        """
 
         with tf.variable_scope('conv', reuse=True):
             self.x = x = tf.placeholder(tf.float32, [None] + list(ob_space))
@@ -137,6 +175,9 @@ class MetaPolicy(object):
             x = tf.nn.relu( conv2d(x, 16, "l1", [8, 8], [4, 4]) )
             x = tf.nn.relu( conv2d(x, 32, "l2", [4, 4], [2, 2]) )
             x = tf.nn.relu(linear(flatten(x), 256, "hidden",  normalized_columns_initializer(1.0)))
+            self.hidden = x
+            if cached_features:
+                self.hidden_in = x = tf.placeholder_with_default(tf.stop_gradient(x), [None, 256], "hidden_in")
 
             self.prev_action = prev_action = tf.placeholder(tf.float32, [None, ac_space], "prev_a")
             self.prev_reward = prev_reward = tf.placeholder(tf.float32, [None, 1], "prev_r")
@@ -150,27 +191,7 @@ class MetaPolicy(object):
 
         with tf.variable_scope('meta_lstm'):
             size = 256
-            lstm = rnn.BasicLSTMCell(size, state_is_tuple=True)
-
-            self.state_size = lstm.state_size
-            step_size = tf.shape(self.x)[:1]
-
-            c_init = np.zeros((1, lstm.state_size.c), np.float32)
-            h_init = np.zeros((1, lstm.state_size.h), np.float32)
-            self.state_init = [c_init, h_init]
-            c_in = tf.placeholder(tf.float32, [1, lstm.state_size.c])
-            h_in = tf.placeholder(tf.float32, [1, lstm.state_size.h])
-            self.state_in = [c_in, h_in]
-
-            if use_tf100_api:
-                state_in = rnn.LSTMStateTuple(c_in, h_in)
-            else:
-                state_in = rnn.rnn_cell.LSTMStateTuple(c_in, h_in)
-            lstm_outputs, lstm_state = tf.nn.dynamic_rnn(
-                lstm, x, initial_state=state_in, sequence_length=step_size,
-                time_major=False)
-            lstm_c, lstm_h = lstm_state
-            x = tf.reshape(lstm_outputs, [-1, size])
+            x, lstm_c, lstm_h = self._lstm(x, size, fused_lstm)
 
             # lstm output
             self.vf = tf.reshape(linear(x, 1, "value", normalized_columns_initializer(1.0)), [-1])
@@ -185,11 +206,147 @@ class MetaPolicy(object):
     def get_initial_features(self):
         return self.state_init
 
-    def act(self, ob, c, h, prev_a, prev_r):
+    def act(self, ob, c, h, prev_a, prev_r, with_hidden=False):
+        """With `with_hidden` the hidden features of ob are returned too, last."""
+        fetches = self._acting_fetches()
+        if with_hidden:
+            fetches = fetches + [self.hidden if self.quantized is None else self.quantized.hidden]
         sess = tf.get_default_session()
-        return sess.run([self.sample, self.vf] + self.state_out,
-                        {self.x: [ob], self.state_in[0]: c, self.state_in[1]: h, self.prev_action: [prev_a], self.prev_reward: [prev_r] })
+        return sess.run(fetches,
+                        {self.x: ob[np.newaxis], self.state_in[0]: c, self.state_in[1]: h, self.prev_action: [prev_a], self.prev_reward: [prev_r] })
 
     def value(self, ob, c, h, prev_a, prev_r):
         sess = tf.get_default_session()
-        return sess.run(self.vf, {self.x: [ob], self.state_in[0]: c, self.state_in[1]: h, self.prev_action: [prev_a], self.prev_reward: [prev_r]})[0]
+        return sess.run(self.vf, {self.x: ob[np.newaxis], self.state_in[0]: c, self.state_in[1]: h, self.prev_action: [prev_a], self.prev_reward: [prev_r]})[0]
+
+
+def find_variable(var_list, *suffixes):
+    """The one variable of `var_list` whose name ends with one of the scope paths `suffixes`."""
+    matches = [v for v in var_list if any(('/' + v.name).endswith('/' + s + ':0') for s in suffixes)]
+    assert len(matches) == 1, "expected one variable named {}, found {}".format(suffixes, matches)
+    return matches[0]
+
+
+def lstm_step(inputs, c_in, h_in, kernel, bias):
+    """One step of BasicLSTMCell (same gate order and forget bias) from its kernel and bias."""
+    z = tf.matmul(tf.concat(inputs + [h_in], axis=1), kernel) + bias
+    i, j, f, o = tf.split(z, 4, axis=1)
+    c = c_in * tf.sigmoid(f + 1.0) + tf.sigmoid(i) * tf.tanh(j)
+    return c, tf.tanh(c) * tf.sigmoid(o)
+
+
+class BatchedStep(object):
+    """
+    The acting step of a policy for a batch of independent agents: row i of the inputs (x,
+    prev_action, prev_reward and meta_action of the policy, and c_in and h_in here) is one step of
+    agent i, with its own LSTM state. Uses the variables of the policy. `fetches` are the sampled
+    one-hot actions, the values and the new LSTM states, one row per agent.
+    """
+    def __init__(self, policy, lstm_scope):
+        cell = lstm_scope + '/rnn/basic_lstm_cell/'
+        size = int(policy.state_init[0].shape[1])
+        self.c_in = tf.placeholder(tf.float32, [None, size], "batch_c_in")
+        self.h_in = tf.placeholder(tf.float32, [None, size], "batch_h_in")
+        inputs = [policy.hidden, policy.prev_action, policy.prev_reward]
+        if hasattr(policy, 'meta_action'):
+            inputs.append(policy.meta_action)
+        c, h = lstm_step(inputs, self.c_in, self.h_in,
+                         find_variable(policy.var_list, cell + 'kernel', cell + 'weights'),
+                         find_variable(policy.var_list, cell + 'bias', cell + 'biases'))
+        self.logits = tf.matmul(h, find_variable(policy.var_list, lstm_scope + '/action/w')) + \
+            find_variable(policy.var_list, lstm_scope + '/action/b')
+        self.vf = tf.reshape(tf.matmul(h, find_variable(policy.var_list, lstm_scope + '/value/w')) +
+                             find_variable(policy.var_list, lstm_scope + '/value/b'), [-1])
+        self.sample = categorical_sample(self.logits, int(self.logits.get_shape()[1]))
+        self.hidden = policy.hidden
+        self.fetches = [self.sample, self.vf, c, h]
+
+
+class QuantizedActor(object):
+    """
+    Reduced precision copy of the acting step of a policy (one step, no unrolling). The two
+    convolutions, the hidden layer and the LSTM kernel run as quint8 QuantizedConv2D ops (the fully
+    connected ones as 1x1 convolutions) on a quantized copy of the weights, which `requantize`
+    refreshes and has to run after every weight sync. Activations are quantized on the fly from
+    their own range. Biases, nonlinearities and the small action and value heads stay in float32,
+    and training keeps using the float32 graph.
+
+    `trunk` is the QuantizedActor of the actor when building the one of the meta policy: the conv
+    and hidden layers are shared, so are their quantized weights.
+    """
+    def __init__(self, policy, lstm_scope, trunk=None):
+        if trunk is None:
+            self.trunk = [self._weight(self._find(policy, 'conv/l1/W'), 'l1'),
+                          self._weight(self._find(policy, 'conv/l2/W'), 'l2'),
+                          self._weight(self._find(policy, 'conv/hidden/w'), 'hidden', matmul=True)]
+        else:
+            self.trunk = trunk.trunk
+        cell = lstm_scope + '/rnn/basic_lstm_cell/'
+        self.kernel = self._weight(self._find(policy, cell + 'kernel', cell + 'weights'), lstm_scope, matmul=True)
+
+        l1, l2, hidden = self.trunk
+        x = tf.nn.relu(self._conv(policy.x, l1, [1, 4, 4, 1]) + self._find(policy, 'conv/l1/b'))
+        x = tf.nn.relu(self._conv(x, l2, [1, 2, 2, 1]) + self._find(policy, 'conv/l2/b'))
+        self.hidden = x = tf.nn.relu(self._matmul(flatten(x), hidden) + self._find(policy, 'conv/hidden/b'))
+
+        inputs = [x, policy.prev_action, policy.prev_reward]
+        if hasattr(policy, 'meta_action'):
+            inputs.append(policy.meta_action)
+        c_in, h_in = policy.state_in
+        z = self._matmul(tf.concat(inputs + [h_in], axis=1), self.kernel) + \
+            self._find(policy, cell + 'bias', cell + 'biases')
+        # same gate order and forget bias as BasicLSTMCell
+        i, j, f, o = tf.split(z, 4, axis=1)
+        c = c_in * tf.sigmoid(f + 1.0) + tf.sigmoid(i) * tf.tanh(j)
+        h = tf.tanh(c) * tf.sigmoid(o)
+
+        self.logits = tf.matmul(h, self._find(policy, lstm_scope + '/action/w')) + \
+            self._find(policy, lstm_scope + '/action/b')
+        self.vf = tf.reshape(tf.matmul(h, self._find(policy, lstm_scope + '/value/w')) +
+                             self._find(policy, lstm_scope + '/value/b'), [-1])
+        self.sample = categorical_sample(self.logits, int(self.logits.get_shape()[1]))[0, :]
+        self.fetches = [self.sample, self.vf, c, h]
+
+    @staticmethod
+    def _find(policy, *suffixes):
+        return find_variable(policy.var_list, *suffixes)
+
+    @staticmethod
+    def _weight(w, name, matmul=False):
+        # fully connected weights are stored as [1, 1, in, out] filters
+        shape = [1, 1] + w.get_shape().as_list() if matmul else w.get_shape().as_list()
+        local = [tf.GraphKeys.LOCAL_VARIABLES]
+        q = tf.get_variable(name + "/quantized", shape, tf.uint8, tf.zeros_initializer(),
+                            collections=local, trainable=False)
+        w_min = tf.get_variable(name + "/min", [], initializer=tf.constant_initializer(0.0),
+                                collections=local, trainable=False)
+        w_max = tf.get_variable(name + "/max", [], initializer=tf.constant_initializer(1.0),
+                                collections=local, trainable=False)
+        return w, q, w_min, w_max
+
+    @staticmethod
+    def _conv(x, weight, strides):
+        _, q, w_min, w_max = weight
+        xq = tf.quantize_v2(x, tf.reduce_min(x), tf.reduce_max(x), tf.quint8, mode='MIN_FIRST')
+        out = tf.nn.quantized_conv2d(xq.output, tf.bitcast(q, tf.quint8), xq.output_min, xq.output_max,
+                                     w_min, w_max, strides, "SAME", out_type=tf.qint32)
+        return tf.dequantize(out.output, out.min_output, out.max_output, mode='MIN_FIRST')
+
+    def _matmul(self, x, weight):
+        k, n = weight[1].get_shape().as_list()[2:]
+        out = self._conv(tf.reshape(x, [1, 1, -1, k]), weight, [1, 1, 1, 1])
+        return tf.reshape(out, [-1, n])
+
+    def requantize(self):
+        """
+        Quantizes the current float weights. Build it under a control dependency on the op that
+        changes them, the reads are created here so they happen after it.
+        """
+        assigns = []
+        for w, q, w_min, w_max in self.trunk + [self.kernel]:
+            value = tf.reshape(tf.identity(w), q.get_shape())
+            quantized = tf.quantize_v2(value, tf.reduce_min(value), tf.reduce_max(value), tf.quint8,
+                                       mode='MIN_FIRST')
+            assigns += [q.assign(tf.bitcast(quantized.output, tf.uint8)),
+                        w_min.assign(quantized.output_min), w_max.assign(quantized.output_max)]
+        return tf.group(*assigns)
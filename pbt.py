@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""
+Population based training on one host. Runs --trials experiments side by side, each a
+`train.py -m supervise` job with its own log directory, port range and share of the cpus, and every
+--interval seconds replaces the worst trials by copies of the best ones: a losing trial is stopped,
+gets the latest checkpoint of a winner and a perturbed copy of its hyperparameters, and is started
+again. Trials are scored on the eval worker reports (eval_report.jsonl) written since they last
+started.
+
+    python pbt.py --trials 4 -w 2 -e MontezumaRevenge-v0 -l ~/experiments/pbt
+
+The state of the population is kept in <log-dir>/pbt.json and the decisions in <log-dir>/pbt.log.
+"""
+from __future__ import print_function
+import argparse
+import glob
+import json
+import math
+import os
+import random
+import re
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from train import allowed_cpus, format_cpulist
+
+# name: (low, high, log scale) of the worker.py flags that are searched
+HYPERPARAMETERS = {
+    'beta': (0.5, 1.0, False),
+    'intrinsic-scale': (0.01, 0.2, True),
+    'learning-rate': (1e-5, 1e-3, True),
+    'entropy-bonus': (1e-3, 0.1, True),
+}
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--trials', default=4, type=int, help="Number of trials running at the same time")
+parser.add_argument('-w', '--num-workers', default=2, type=int, help="Workers per trial")
+parser.add_argument('-e', '--env-id', type=str, default="PongDeterministic-v3", help="Environment id")
+parser.add_argument('-l', '--log-dir', type=str, default="/tmp/pbt", help="Log directory of the population")
+parser.add_argument('--interval', default=1800, type=float, help="Seconds between exploit/explore rounds")
+parser.add_argument('--fraction', default=0.25, type=float,
+                    help="Share of the population replaced in every round, and taken as winners")
+parser.add_argument('--min-reports', default=2, type=int,
+                    help="Eval reports a trial needs since its last start to be ranked")
+parser.add_argument('--perturb', default=0.2, type=float,
+                    help="Explore: every hyperparameter is multiplied by 1 +- this (clipped to its range)")
+parser.add_argument('--port', default=12222, type=int, help="First port of the first trial")
+parser.add_argument('--port-stride', default=100, type=int, help="Ports between the first ports of two trials")
+parser.add_argument('--pin', type=str, default='none', choices=['none', 'core', 'numa'],
+                    help="Passed to train.py: placement of the processes inside the cpus of their trial")
+parser.add_argument('--train-args', type=str, default='',
+                    help="Extra arguments for every train.py, e.g. --train-args='-t 2 --graph-cache'")
+parser.add_argument('--worker-args', type=str, default='', help="Extra arguments for every worker.py")
+parser.add_argument('--seed', default=None, type=int)
+
+
+def cpu_sets(num_trials):
+    """Splits the cpus this process may use into `num_trials` contiguous sets (shared if too few)."""
+    cpus = sorted(allowed_cpus() or range(os.sysconf('SC_NPROCESSORS_ONLN')))
+    if len(cpus) < num_trials:
+        return [[cpus[i % len(cpus)]] for i in range(num_trials)]
+    per_trial = len(cpus) // num_trials
+    return [cpus[i * per_trial:(i + 1) * per_trial] for i in range(num_trials)]
+
+
+def sample(rng):
+    hyperparameters = {}
+    for name, (low, high, log) in HYPERPARAMETERS.items():
+        if log:
+            hyperparameters[name] = 10 ** rng.uniform(math.log10(low), math.log10(high))
+        else:
+            hyperparameters[name] = rng.uniform(low, high)
+    return hyperparameters
+
+
+def perturb(hyperparameters, rng, amount):
+    perturbed = {}
+    for name, value in hyperparameters.items():
+        low, high, _ = HYPERPARAMETERS[name]
+        perturbed[name] = min(high, max(low, value * rng.choice([1.0 - amount, 1.0 + amount])))
+    return perturbed
+
+
+def latest_checkpoint(train_dir):
+    """The path prefix of the newest checkpoint in a train directory, from its `checkpoint` file."""
+    try:
+        with open(os.path.join(train_dir, 'checkpoint')) as f:
+            path = re.search(r'^model_checkpoint_path:\s*"(.*)"', f.read(), re.M).group(1)
+    except (IOError, OSError, AttributeError):
+        return None
+    return path if os.path.isabs(path) else os.path.join(train_dir, path)
+
+
+def copy_checkpoint(source_dir, target_dir):
+    """Replaces the checkpoints of `target_dir` by the newest one of `source_dir`. Returns its name."""
+    path = latest_checkpoint(source_dir)
+    if path is None or not glob.glob(path + '.*'):
+        return None
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    for f in glob.glob(os.path.join(target_dir, 'model.ckpt-*')) + glob.glob(os.path.join(target_dir, 'checkpoint')):
+        os.remove(f)
+    name = os.path.basename(path)
+    for f in glob.glob(path + '.*'):
+        shutil.copy(f, target_dir)
+    with open(os.path.join(target_dir, 'checkpoint'), 'w') as f:
+        f.write('model_checkpoint_path: "{0}"\nall_model_checkpoint_paths: "{0}"\n'.format(name))
+    return name
+
+
+class Trial(object):
+    def __init__(self, index, log_dir, hyperparameters, cpus, port):
+        self.index = index
+        self.name = 'trial-%d' % index
+        self.log_dir = os.path.join(log_dir, self.name)
+        self.hyperparameters = hyperparameters
+        self.cpus = cpus
+        self.port = port
+        self.generation = 0
+        self.parent = None
+        self.proc = None
+        self.reports_seen = 0
+        self.frames = None
+
+    def command(self, args):
+        worker_args = ' '.join('--{} {!r}'.format(k, v) for k, v in sorted(self.hyperparameters.items()))
+        worker_args = (worker_args + ' ' + args.worker_args).strip()
+        cmd = ['taskset', '-c', format_cpulist(self.cpus), sys.executable, 'train.py', '-m', 'supervise',
+               '-w', str(args.num_workers), '-e', args.env_id, '-l', self.log_dir, '--port', str(self.port),
+               '--tb-port', '0', '--pin', args.pin, '--worker-args', worker_args]
+        return cmd + shlex.split(args.train_args)
+
+    def reports(self):
+        try:
+            with open(os.path.join(self.log_dir, 'eval_report.jsonl')) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except (IOError, OSError):
+            return []
+
+    def score(self, min_reports):
+        """Mean eval reward of the reports since the last start, or None if there are too few."""
+        reports = self.reports()[self.reports_seen:]
+        if len(reports) < min_reports:
+            return None
+        return sum(r['reward_mean'] for r in reports[-min_reports:]) / float(min_reports)
+
+    def start(self, args):
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        self.reports_seen = len(self.reports())
+        with open(os.path.join(self.log_dir, 'train.out'), 'a') as out:
+            self.proc = subprocess.Popen(self.command(args), stdout=out, stderr=subprocess.STDOUT,
+                                         preexec_fn=os.setsid)
+
+    def stop(self, timeout=60):
+        if self.proc is None:
+            return
+        # train.py stops its children on SIGTERM; the process group is the fallback
+        for kill in (lambda: os.kill(self.proc.pid, signal.SIGTERM), lambda: os.killpg(self.proc.pid, signal.SIGKILL)):
+            try:
+                kill()
+            except OSError:
+                break
+            deadline = time.time() + timeout
+            while self.proc.poll() is None and time.time() < deadline:
+                time.sleep(0.5)
+            if self.proc.poll() is not None:
+                break
+        self.proc = None
+
+    def fps(self):
+        """Frames per second of all workers since the previous call, from their heartbeats."""
+        frames, now = 0, None
+        for path in glob.glob(os.path.join(self.log_dir, 'heartbeat', 'w-*.json')):
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            frames += state['frames']
+            now = max(now or 0, state['time'])
+        rate = None
+        if now is not None and self.frames is not None and now > self.frames[1] and frames >= self.frames[0]:
+            rate = (frames - self.frames[0]) / (now - self.frames[1])
+        if now is not None:
+            self.frames = (frames, now)
+        return rate
+
+    def state(self):
+        return dict(name=self.name, hyperparameters=self.hyperparameters, cpus=format_cpulist(self.cpus),
+                    port=self.port, generation=self.generation, parent=self.parent)
+
+
+class Population(object):
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        sets = cpu_sets(args.trials)
+        self.trials = [Trial(i, args.log_dir, sample(self.rng), sets[i], args.port + i * args.port_stride)
+                       for i in range(args.trials)]
+
+    def log(self, message):
+        line = "{} {}".format(time.strftime('%Y-%m-%d %H:%M:%S'), message)
+        print(line)
+        sys.stdout.flush()
+        with open(os.path.join(self.args.log_dir, 'pbt.log'), 'a') as f:
+            f.write(line + '\n')
+
+    def save(self):
+        path = os.path.join(self.args.log_dir, 'pbt.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump([t.state() for t in self.trials], f, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    def exploit(self):
+        scored = [(t.score(self.args.min_reports), t) for t in self.trials]
+        scored = sorted([(s, t) for s, t in scored if s is not None], key=lambda st: st[0])
+        self.log("scores: " + ", ".join("{} {:.2f}".format(t.name, s) for s, t in scored))
+        count = int(len(scored) * self.args.fraction)
+        if count == 0:
+            return
+        losers = [t for _, t in scored[:count]]
+        winners = [t for _, t in scored[-count:]]
+        for loser in losers:
+            winner = self.rng.choice(winners)
+            loser.stop()
+            name = copy_checkpoint(os.path.join(winner.log_dir, 'train'), os.path.join(loser.log_dir, 'train'))
+            if name is None:
+                self.log("{} has no checkpoint yet; {} keeps its own".format(winner.name, loser.name))
+            else:
+                # evaluate from the copied checkpoint on
+                shutil.rmtree(os.path.join(loser.log_dir, 'eval_queue'), ignore_errors=True)
+                loser.hyperparameters = perturb(winner.hyperparameters, self.rng, self.args.perturb)
+                loser.generation = winner.generation + 1
+                loser.parent = winner.name
+                self.log("{} <- {} ({}), {}".format(loser.name, winner.name, name, json.dumps(
+                    loser.hyperparameters, sort_keys=True)))
+            loser.start(self.args)
+        self.save()
+
+    def run(self):
+        if not os.path.exists(self.args.log_dir):
+            os.makedirs(self.args.log_dir)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        for trial in self.trials:
+            self.log("starting {} on cpus {}, ports from {}: {}".format(
+                trial.name, format_cpulist(trial.cpus), trial.port, json.dumps(trial.hyperparameters, sort_keys=True)))
+            trial.start(self.args)
+        self.save()
+        next_round = time.time() + self.args.interval
+        try:
+            while True:
+                time.sleep(60)
+                for trial in self.trials:
+                    if trial.proc.poll() is not None:
+                        self.log("{} exited with code {}: starting it again".format(trial.name, trial.proc.returncode))
+                        trial.start(self.args)
+                rates = [trial.fps() for trial in self.trials]
+                self.log("host throughput {:.0f} frames/s ({})".format(
+                    sum(r for r in rates if r), ", ".join('-' if r is None else '%.0f' % r for r in rates)))
+                if time.time() >= next_round:
+                    next_round = time.time() + self.args.interval
+                    self.exploit()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.log("stopping the population")
+            for trial in self.trials:
+                trial.stop()
+
+
+def main():
+    args = parser.parse_args()
+    Population(args).run()
+
+
+if __name__ == "__main__":
+    main()
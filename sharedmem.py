@@ -0,0 +1,198 @@
+"""
+Single-host parameter store. The global parameters, the global step and (for the shared
+optimizers) the optimizer statistics live in one file under /dev/shm that every worker process
+maps into memory. Workers read weights without copying them out of the segment and apply their
+gradients Hogwild-style, optionally holding a per-tensor lock while doing so.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import threading
+import time
+import numpy as np
+
+_MAGIC = 0x46434852  # "FCHR"
+_HEADER_BYTES = 64
+_ALIGN = 64
+_HEADER_LOCK = 0
+
+
+def default_store_path(log_dir):
+    """The segment used for a log directory unless one is given explicitly."""
+    digest = hashlib.md5(os.path.abspath(os.path.expanduser(log_dir)).encode('utf-8')).hexdigest()
+    return os.path.join('/dev/shm', 'fchrl_' + digest[:12])
+
+
+def _aligned(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class SharedParameterStore(object):
+    """
+    `optimizer` follows A3C: "shared-rmsprop" and "shared-adam" keep their statistics in the
+    segment, "adam" keeps them in the memory of each process (one set per worker).
+    The first worker calls `create` with the initial values, the others `attach`; both need the
+    same list of (name, shape) pairs, in the same order.
+    """
+    def __init__(self, path, optimizer='adam', learning_rate=1e-4, locks=False):
+        self.path = path
+        self.optimizer = optimizer
+        self.learning_rate = learning_rate
+        self.locks = locks
+        self._fd = None
+        self._mm = None
+        # updates made by this process: the bias correction of its own "adam" statistics
+        self._updates = 0
+        self._updates_lock = threading.Lock()
+
+    def _slot_names(self):
+        if self.optimizer == 'shared-rmsprop':
+            return ['ms']
+        elif self.optimizer in ('adam', 'shared-adam'):
+            return ['m', 'v']
+        raise ValueError("Unknown optimizer: {}".format(self.optimizer))
+
+    def _layout(self, variables):
+        shared_slots = self._slot_names() if self.optimizer.startswith('shared') else []
+        offset = _HEADER_BYTES
+        layout = []
+        for name, shape in variables:
+            shape = tuple(int(d) for d in shape)
+            nbytes = _aligned(4 * int(np.prod(shape)))
+            offsets = {}
+            for key in ['param'] + shared_slots:
+                offsets[key] = offset
+                offset += nbytes
+            layout.append((name, shape, offsets))
+        return layout, offset
+
+    def _map(self, variables, size):
+        self._mm = mmap.mmap(self._fd, size)
+        self._header = np.frombuffer(self._mm, np.int64, 4, 0)
+        self._tensors = {}
+        self._slots = {}
+        self._lock_index = {}
+        self._thread_locks = {}
+        layout, _ = self._layout(variables)
+        for i, (name, shape, offsets) in enumerate(layout):
+            count = int(np.prod(shape))
+            self._tensors[name] = np.frombuffer(self._mm, np.float32, count, offsets['param']).reshape(shape)
+            slots = {}
+            for key in self._slot_names():
+                if key in offsets:
+                    slots[key] = np.frombuffer(self._mm, np.float32, count, offsets[key]).reshape(shape)
+                else:
+                    slots[key] = np.zeros(shape, np.float32)
+            self._slots[name] = slots
+            self._lock_index[name] = i + 1
+            self._thread_locks[name] = threading.Lock()
+        self._thread_locks[_HEADER_LOCK] = threading.Lock()
+
+    def create(self, variables, values, global_step=0):
+        """Creates (or replaces) the segment and fills it with `values`."""
+        _, size = self._layout(variables)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        self._fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.ftruncate(self._fd, size)
+        self._map(variables, size)
+        for (name, _), value in zip(variables, values):
+            self._tensors[name][...] = value
+            if self.optimizer == 'shared-rmsprop':
+                # same initial mean square as tf.train.RMSPropOptimizer
+                self._slots[name]['ms'][...] = 1.0
+        self._header[1] = 1
+        self._header[2] = global_step
+        self._header[3] = 0
+        self._header[0] = _MAGIC
+        self._mm.flush()
+        os.rename(tmp_path, self.path)
+
+    def attach(self, variables, timeout=15 * 60):
+        """Maps an existing segment, waiting for the first worker to create it."""
+        _, size = self._layout(variables)
+        deadline = time.time() + timeout
+        while True:
+            if os.path.exists(self.path) and os.path.getsize(self.path) == size:
+                self._fd = os.open(self.path, os.O_RDWR)
+                self._map(variables, size)
+                if self._header[0] == _MAGIC and self._header[1] == 1:
+                    return
+                self.close()
+            if time.time() > deadline:
+                raise RuntimeError("Timed out waiting for the parameter store at {}".format(self.path))
+            time.sleep(1)
+
+    def close(self):
+        if self._mm is not None:
+            self._header = self._tensors = self._slots = None
+            try:
+                self._mm.close()
+            except BufferError:
+                # views handed out by read() are still alive; the mapping goes away with them
+                pass
+            self._mm = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def read(self, name):
+        """A view of the current value of `name`, valid while the store is open."""
+        return self._tensors[name]
+
+    @property
+    def global_step(self):
+        return int(self._header[2])
+
+    def _acquire(self, key, index):
+        self._thread_locks[key].acquire()
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, index)
+
+    def _release(self, key, index):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, index)
+        self._thread_locks[key].release()
+
+    def add_step(self, n):
+        self._acquire(_HEADER_LOCK, 0)
+        try:
+            self._header[2] += n
+            self._header[3] += 1
+            return int(self._header[3])
+        finally:
+            self._release(_HEADER_LOCK, 0)
+
+    def apply_gradients(self, grads_and_names, num_frames=0):
+        """Applies one update and adds `num_frames` to the global step."""
+        t = self.add_step(num_frames)
+        if self.optimizer == 'adam':
+            # the statistics start at zero in every process, however far the job is
+            with self._updates_lock:
+                self._updates += 1
+                t = self._updates
+        lr = self.learning_rate
+        if self.optimizer != 'shared-rmsprop':
+            lr = lr * np.sqrt(1.0 - 0.999 ** t) / (1.0 - 0.9 ** t)
+        for grad, name in grads_and_names:
+            if self.locks:
+                self._acquire(name, self._lock_index[name])
+            try:
+                self._apply(name, grad, lr)
+            finally:
+                if self.locks:
+                    self._release(name, self._lock_index[name])
+
+    def _apply(self, name, grad, lr):
+        param = self._tensors[name]
+        slots = self._slots[name]
+        if self.optimizer == 'shared-rmsprop':
+            ms = slots['ms']
+            ms *= 0.99
+            ms += 0.01 * np.square(grad)
+            param -= lr * grad / np.sqrt(ms + 0.1)
+        else:
+            m, v = slots['m'], slots['v']
+            m *= 0.9
+            m += 0.1 * grad
+            v *= 0.999
+            v += 0.001 * np.square(grad)
+            param -= lr * m / (np.sqrt(v) + 1e-8)
@@ -1,7 +1,18 @@
 import argparse
+import glob
+import json
+import multiprocessing
 import os
+import re
+import shlex
+import signal
+import subprocess
 import sys
+import time
 from six.moves import shlex_quote
+from metrics import format_table, scrape
+from sharedmem import default_store_path
+from vnc_remotes import RemotePool, runtime_image
 
 parser = argparse.ArgumentParser(description="Run commands")
 parser.add_argument('-w', '--num-workers', default=1, type=int,
@@ -9,6 +20,14 @@ parser.add_argument('-w', '--num-workers', default=1, type=int,
 parser.add_argument('-r', '--remotes', default=None,
                     help='The address of pre-existing VNC servers and '
                          'rewarders to use (e.g. -r vnc://localhost:5900+15900,vnc://localhost:5901+15901).')
+parser.add_argument('--remote-pool', action='store_true',
+                    help="VNC environments: run one universe container per worker (and eval worker) that outlives "
+                         "the workers and this script, and pass their addresses as --remotes. A later run with the "
+                         "same --log-dir reuses them")
+parser.add_argument('--remote-pool-port', default=5900, type=int,
+                    help="VNC port of the first pooled remote; its rewarder is 10000 above")
+parser.add_argument('--stop-remote-pool', action='store_true',
+                    help="Instead of launching, remove the pooled remotes of --log-dir")
 parser.add_argument('-e', '--env-id', type=str, default="PongDeterministic-v3",
                     help="Environment id")
 parser.add_argument('-l', '--log-dir', type=str, default="/tmp/pong",
@@ -16,12 +35,246 @@ parser.add_argument('-l', '--log-dir', type=str, default="/tmp/pong",
 parser.add_argument('-n', '--dry-run', action='store_true',
                     help="Print out commands rather than executing them")
 parser.add_argument('-m', '--mode', type=str, default='tmux',
-                    help="tmux: run workers in a tmux session. nohup: run workers with nohup. child: run workers as child processes")
+                    help="tmux: run workers in a tmux session. nohup: run workers with nohup. child: run workers as child processes. "
+                         "supervise: run them as children of train.py, which restarts dead or stalled workers and "
+                         "starts or stops workers when <log-dir>/num_workers changes")
+parser.add_argument('--stall-secs', default=600, type=float,
+                    help="supervise: restart a worker that has made no actor update for this long since its "
+                         "first heartbeat")
+parser.add_argument('--report-secs', default=60, type=float,
+                    help="supervise: seconds between reports of the frames per second of each worker")
 
 # Add visualise tag
 parser.add_argument('--visualise', action='store_true',
                     help="Visualise the gym environment by running env.render() between each timestep")
 
+parser.add_argument('--obs-mode', type=str, default='84x84x3', choices=['84x84x3', '84x84x1', '42x42x1'],
+                    help="Observation size and channels for Atari games")
+parser.add_argument('-t', '--num-threads', default=1, type=int,
+                    help="Number of actor threads per worker process")
+parser.add_argument('-b', '--backend', type=str, default='ps', choices=['ps', 'shm'],
+                    help="ps: parameter server over gRPC (required for multi-node runs). "
+                         "shm: single-host shared-memory parameter store, no parameter server process")
+parser.add_argument('--worker-args', type=str, default='',
+                    help="Extra arguments passed to every worker.py, e.g. --worker-args='--local-steps 40 --adaptive-rollout'")
+parser.add_argument('--num-eval-workers', default=1, type=int,
+                    help="Number of eval workers; they split the episodes of every evaluated checkpoint")
+parser.add_argument('--pin', type=str, default='none', choices=['none', 'core', 'numa'],
+                    help="core: pin the ps, every worker and the eval worker to their own cores with taskset. "
+                         "numa: bind processes round-robin to NUMA nodes with numactl")
+parser.add_argument('--ps-cores', default=2, type=int,
+                    help="Cores given to the ps with --pin core; its TF thread pools are sized to match")
+parser.add_argument('--cpu-report', type=float, default=None, metavar='SECONDS',
+                    help="Instead of launching, measure the CPU use and affinity of the running processes of "
+                         "--log-dir on this host over SECONDS and print a table")
+parser.add_argument('--scrape', type=float, default=None, metavar='SECONDS',
+                    help="Instead of launching, read the metrics endpoints of the processes of --log-dir on this "
+                         "host every SECONDS and print a live table (Ctrl-C to stop)")
+parser.add_argument('--graph-cache', action='store_true',
+                    help="Build the worker graph once, export it to <log-dir>/graph_cache and import it in the other workers")
+parser.add_argument('--port', default=12222, type=int,
+                    help="First port of a single-host job: the ps, then one per worker")
+parser.add_argument('--tb-port', default=12345, type=int, help="Tensorboard port (0: no tensorboard)")
+parser.add_argument('--inference-server', action='store_true',
+                    help="Run an inference server (inference.py) that batches the meta-controller act steps of "
+                         "all workers of a single-host job; add --inference-actor to --worker-args to batch "
+                         "the actor steps too")
+parser.add_argument('-c', '--cluster', type=str, default=None,
+                    help="JSON cluster description for a multi-node run, e.g. "
+                         "{\"hosts\": [{\"address\": \"10.0.0.1\", \"slots\": 8}, {\"address\": \"10.0.0.2\", \"slots\": 8}]}. "
+                         "Writes one launch script per host to <log-dir>/cluster instead of starting the job locally")
+
+
+def parse_cpulist(text):
+    # "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]
+    cpus = []
+    for part in text.strip().split(','):
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus += range(int(lo), int(hi) + 1)
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(lo) if lo == hi else '{}-{}'.format(lo, hi) for lo, hi in ranges)
+
+
+def allowed_cpus():
+    """The cpus this process may run on (e.g. inside taskset), or None if /proc does not say."""
+    try:
+        with open('/proc/self/status') as f:
+            return set(parse_cpulist(re.search(r'Cpus_allowed_list:\s*(\S+)', f.read()).group(1)))
+    except (IOError, OSError, AttributeError):
+        return None
+
+
+def cpu_topology():
+    """
+    The NUMA nodes of this machine as (node id, cpus) pairs; a single node if /sys has no NUMA info.
+    Only the cpus train.py may run on count, so that a job started under taskset stays inside it.
+    """
+    allowed = allowed_cpus()
+    nodes = []
+    for path in glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'):
+        with open(path) as f:
+            cpus = [cpu for cpu in parse_cpulist(f.read()) if allowed is None or cpu in allowed]
+        if cpus:
+            nodes.append((int(re.search(r'node(\d+)/cpulist', path).group(1)), cpus))
+    return sorted(nodes) or [(0, sorted(allowed) if allowed else list(range(multiprocessing.cpu_count())))]
+
+
+class CpuPlanner(object):
+    """
+    Hands out the cpus of one host to the processes launched on it, in launch order.
+    "core" gives every process its own cores (wrapping around when the host runs out), walking the
+    cpus node by node so that a multi-core process stays on one NUMA node where possible.
+    "numa" binds whole processes, cpus and memory, to NUMA nodes round-robin.
+    """
+    def __init__(self, mode, nodes):
+        self.mode = mode
+        self.nodes = nodes
+        self.cpus = [cpu for _, cpus in nodes for cpu in cpus]
+        self.next_cpu = 0
+        self.next_node = 0
+
+    @property
+    def oversubscribed(self):
+        return self.mode == 'core' and self.next_cpu > len(self.cpus)
+
+    def prefix(self, num_cores):
+        if self.mode == 'core':
+            cpus = [self.cpus[(self.next_cpu + i) % len(self.cpus)] for i in range(num_cores)]
+            self.next_cpu += num_cores
+            return ['taskset', '-c', format_cpulist(cpus)]
+        elif self.mode == 'numa':
+            node, _ = self.nodes[self.next_node % len(self.nodes)]
+            self.next_node += 1
+            return ['numactl', '--cpunodebind={}'.format(node), '--membind={}'.format(node)]
+        return []
+
+
+def pinned(cmd, prefix):
+    # the placement command goes between the environment assignment and the interpreter
+    return cmd[:1] + prefix + cmd[1:]
+
+
+def ps_thread_args(pin, ps_cores):
+    if pin == 'none':
+        return []
+    return ['--intra-op-threads', str(ps_cores), '--inter-op-threads', str(ps_cores)]
+
+
+def _proc_stat(pid):
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime + stime in clock ticks, thread count, cpu last run on
+    return int(fields[11]) + int(fields[12]), int(fields[17]), int(fields[36])
+
+
+def _thread_cpus(pid):
+    cpus = []
+    for path in glob.glob('/proc/{}/task/*/stat'.format(pid)):
+        try:
+            with open(path) as f:
+                cpus.append(int(f.read().rsplit(')', 1)[1].split()[36]))
+        except (IOError, OSError):
+            pass
+    return cpus
+
+
+def find_processes(logdir):
+    """The worker.py processes (ps, workers, eval) of the run in `logdir` on this host, as (name, pid)."""
+    logdir = os.path.abspath(os.path.expanduser(logdir))
+    found = []
+    for path in glob.glob('/proc/[0-9]*/cmdline'):
+        try:
+            with open(path, 'rb') as f:
+                argv = f.read().decode('utf-8', 'replace').split('\0')
+        except (IOError, OSError):
+            continue
+        if not any(os.path.basename(a) == 'worker.py' for a in argv) or '--log-dir' not in argv:
+            continue
+        i = argv.index('--log-dir')
+        if i + 1 >= len(argv) or os.path.abspath(os.path.expanduser(argv[i + 1])) != logdir:
+            continue
+        job = argv[argv.index('--job-name') + 1] if '--job-name' in argv else 'worker'
+        task = argv[argv.index('--task') + 1] if '--task' in argv else '0'
+        if job == 'ps':
+            name = 'ps'
+        elif '--eval' in argv:
+            name = 'eval-' + argv[argv.index('--eval-index') + 1] if '--eval-index' in argv else 'eval-worker'
+        else:
+            name = 'w-' + task
+        found.append((name, int(path.split('/')[2])))
+    return sorted(found)
+
+
+def cpu_report(logdir, seconds):
+    """Prints the CPU use, thread count and affinity of each process of the run over `seconds`."""
+    processes = find_processes(logdir)
+    if not processes:
+        print("No worker.py processes with --log-dir {} on this host".format(logdir))
+        return
+    hz = float(os.sysconf('SC_CLK_TCK'))
+    before = {}
+    for name, pid in processes:
+        try:
+            before[pid] = _proc_stat(pid)[0]
+        except (IOError, OSError):
+            pass
+    start = time.time()
+    time.sleep(seconds)
+    elapsed = time.time() - start
+
+    print("{:<12} {:>7} {:>7} {:>8} {:<16} {}".format('process', 'pid', 'cpu%', 'threads', 'affinity', 'cpus run on'))
+    total = 0.0
+    for name, pid in processes:
+        try:
+            ticks, num_threads, _ = _proc_stat(pid)
+            with open('/proc/{}/status'.format(pid)) as f:
+                affinity = re.search(r'Cpus_allowed_list:\s*(\S+)', f.read()).group(1)
+            ran_on = format_cpulist(_thread_cpus(pid))
+        except (IOError, OSError):
+            continue
+        if pid not in before:
+            continue
+        usage = 100.0 * (ticks - before[pid]) / hz / elapsed
+        total += usage
+        print("{:<12} {:>7} {:>7.1f} {:>8} {:<16} {}".format(name, pid, usage, num_threads, affinity, ran_on))
+    print("{:<12} {:>7} {:>7.1f}   ({} cpus on this host)".format('total', '', total, multiprocessing.cpu_count()))
+
+
+def _process_order(name):
+    # ps first, then the workers by task index
+    number = re.search(r'(\d+)$', name)
+    return name != 'ps', int(number.group(1)) if number else 0, name
+
+
+def scrape_report(logdir, seconds):
+    """Prints the metrics served by every process of the run in `logdir` on this host, every `seconds`."""
+    pattern = os.path.join(os.path.expanduser(logdir), 'metrics', '*.sock')
+    try:
+        while True:
+            rows = [scrape(path) for path in glob.glob(pattern)]
+            rows = sorted([r for r in rows if r is not None], key=lambda r: _process_order(r['name']))
+            # clear the terminal, like watch
+            sys.stdout.write('\033[H\033[2J')
+            print("{}  {} processes of {}  (* below half the median frames/s)".format(
+                time.strftime('%H:%M:%S'), len(rows), logdir))
+            print(format_table(rows) if rows else "No metrics endpoints answer under {}".format(pattern))
+            sys.stdout.flush()
+            time.sleep(seconds)
+    except KeyboardInterrupt:
+        pass
+
 
 def new_cmd(session, name, cmd, mode, logdir, shell):
     if isinstance(cmd, (list, tuple)):
@@ -34,30 +287,92 @@ def new_cmd(session, name, cmd, mode, logdir, shell):
         return name, "nohup {} -c {} >{}/{}.{}.out 2>&1 & echo kill $! >>{}/kill.sh".format(shell, shlex_quote(cmd), logdir, session, name, logdir)
 
 
-def create_commands(session, num_workers, remotes, env_id, logdir, shell='bash', mode='tmux', visualise=False):
-    # for launching the TF workers and for launching tensorboard
+def worker_command(num_workers, env_id, logdir, visualise=False, worker_args='', obs_mode='84x84x3', backend='ps',
+                   graph_cache=False, port=12222, inference=False):
+    # the part of the worker.py command line shared by every worker, ps and eval process
     base_cmd = [
         'CUDA_VISIBLE_DEVICES=',
         sys.executable, 'worker.py',
         '--log-dir', logdir,
         '--env-id', env_id,
-        '--num-workers', str(num_workers)]
+        '--num-workers', str(num_workers),
+        '--obs-mode', obs_mode]
 
     if visualise:
         base_cmd += ['--visualise']
+    if backend == 'shm':
+        base_cmd += ['--backend', 'shm', '--shm-path', default_store_path(logdir)]
+    if graph_cache:
+        base_cmd += ['--graph-cache', os.path.join(logdir, 'graph_cache')]
+    if port != 12222:
+        base_cmd += ['--port', str(port)]
+    if inference:
+        # only the training workers act through the server; the ps and the eval workers ignore it
+        base_cmd += ['--inference', inference_socket(logdir)]
+    base_cmd += shlex.split(worker_args)
+    return base_cmd
+
+
+def inference_socket(logdir):
+    # inference.default_socket_path, without importing TensorFlow here
+    return os.path.join(logdir, 'inference.sock')
+
+
+def inference_command(logdir, backend='ps', port=12222, worker_args=''):
+    # the inference server reads the weights where the workers push them
+    cmd = ['CUDA_VISIBLE_DEVICES=', sys.executable, 'inference.py', '--log-dir', logdir]
+    if backend == 'shm':
+        # the layout of the store depends on the optimizer of the workers
+        optimizer_parser = argparse.ArgumentParser(add_help=False)
+        optimizer_parser.add_argument('--optimizer', default='adam')
+        optimizer = optimizer_parser.parse_known_args(shlex.split(worker_args))[0].optimizer
+        cmd += ['--shm-path', default_store_path(logdir), '--optimizer', optimizer]
+    else:
+        cmd += ['--ps', '127.0.0.1:{}'.format(port)]
+    return cmd
+
+
+def training_worker(base_cmd, prefix, task, remote, num_threads, num_workers=None):
+    # a worker added at run time needs a cluster spec that has its own task in it
+    cmd = pinned(base_cmd, prefix) + ["--job-name", "worker", "--task", str(task), "--remotes", remote,
+                                      "--num-threads", str(num_threads)]
+    if num_workers is not None:
+        cmd += ["--num-workers", str(num_workers)]
+    return cmd
+
+
+def eval_worker(num_workers, num_eval_workers, index, remotes):
+    # window name and arguments of one of the eval workers
+    name = "eval-worker" if num_eval_workers == 1 else "eval-%d" % index
+    # a remote of its own if there are enough, as with --remote-pool
+    remote = remotes[min(num_workers + index, len(remotes) - 1)]
+    args = ["--job-name", "worker", "--task", str(num_workers + index), "--remotes", remote, "--eval"]
+    if num_eval_workers > 1:
+        args += ["--num-eval-workers", str(num_eval_workers), "--eval-index", str(index)]
+    return name, args
+
+
+def create_commands(session, num_workers, remotes, env_id, logdir, shell='bash', mode='tmux', visualise=False,
+                    num_threads=1, worker_args='', obs_mode='84x84x3', backend='ps', pin='none', ps_cores=2,
+                    num_eval_workers=1, graph_cache=False, port=12222, tb_port=12345, inference=False):
+    # for launching the TF workers and for launching tensorboard
+    base_cmd = worker_command(num_workers, env_id, logdir, visualise, worker_args, obs_mode, backend, graph_cache, port,
+                              inference)
+    inference_cmd = inference_command(logdir, backend, port, worker_args) if inference else None
+    shm_path = default_store_path(logdir)
+    planner = CpuPlanner(pin, cpu_topology())
 
     if remotes is None:
         remotes = ["1"] * num_workers
     else:
         remotes = remotes.split(',')
-        assert len(remotes) == num_workers
+        assert len(remotes) >= num_workers
 
-    cmds_map = [new_cmd(session, "ps", base_cmd + ["--job-name", "ps"], mode, logdir, shell)]
-    for i in range(num_workers):
-        cmds_map += [new_cmd(session,
-            "w-%d" % i, base_cmd + ["--job-name", "worker", "--task", str(i), "--remotes", remotes[i]], mode, logdir, shell)]
-    cmds_map += [new_cmd(session, "eval-worker", base_cmd + ["--job-name", "worker", "--task", str(num_workers), "--remotes", remotes[-1], "--eval"], mode,logdir,shell)]
-    cmds_map += [new_cmd(session, "tb", ["tensorboard", "--logdir", logdir, "--port", "12345"], mode, logdir, shell)]
+    cmds_map = []
+    if mode != 'supervise':
+        processes = local_processes(num_workers, remotes, base_cmd, planner, num_threads, backend, pin, ps_cores,
+                                    num_eval_workers, logdir, tb_port, inference_cmd)
+        cmds_map += [new_cmd(session, name, cmd, mode, logdir, shell) for name, cmd in processes]
     if mode == 'tmux':
         cmds_map += [new_cmd(session, "htop", ["htop"], mode, logdir, shell)]
 
@@ -68,20 +383,32 @@ def create_commands(session, num_workers, remotes, env_id, logdir, shell='bash',
         "mkdir -p {}".format(logdir),
         "echo {} {} > {}/cmd.sh".format(sys.executable, ' '.join([shlex_quote(arg) for arg in sys.argv if arg != '-n']), logdir),
     ]
+    if backend == 'shm':
+        # never attach to the parameter store of an earlier run
+        cmds += ["rm -f {}".format(shm_path)]
     if mode == 'nohup' or mode == 'child':
         cmds += ["echo '#!/bin/sh' >{}/kill.sh".format(logdir)]
         notes += ["Run `source {}/kill.sh` to kill the job".format(logdir)]
     if mode == 'tmux':
         notes += ["Use `tmux attach -t {}` to watch process output".format(session)]
         notes += ["Use `tmux kill-session -t {}` to kill the job".format(session)]
+    elif mode == 'supervise':
+        notes += ["Use `tail -f {}/*.out` to watch process output and {}/supervisor.log for restarts".format(logdir, logdir)]
+        notes += ["Write a number to {}/num_workers to change the number of workers".format(logdir)]
+        notes += ["Stop train.py (Ctrl-C) to kill the job"]
     else:
         notes += ["Use `tail -f {}/*.out` to watch process output".format(logdir)]
-    notes += ["Point your browser to http://localhost:12345 to see Tensorboard"]
+    if tb_port:
+        notes += ["Point your browser to http://localhost:{} to see Tensorboard".format(tb_port)]
+    if planner.oversubscribed:
+        notes += ["More cores requested than this host has; --pin core wrapped around and some processes share cores"]
+    if pin != 'none':
+        notes += ["Run `{} train.py --cpu-report 30 -l {}` to measure the CPU use of each process".format(sys.executable, logdir)]
 
     if mode == 'tmux':
         cmds += [
-        "kill $( lsof -i:12345 -t ) > /dev/null 2>&1",  # kill any process using tensorboard's port
-        "kill $( lsof -i:12222-{} -t ) > /dev/null 2>&1".format(num_workers+12222), # kill any processes using ps / worker ports
+        "kill $( lsof -i:{} -t ) > /dev/null 2>&1".format(tb_port),  # kill any process using tensorboard's port
+        "kill $( lsof -i:{}-{} -t ) > /dev/null 2>&1".format(port, num_workers+port), # kill any processes using ps / worker ports
         "tmux kill-session -t {}".format(session),
         "tmux new-session -s {} -n {} -d {}".format(session, windows[0], shell)
         ]
@@ -94,9 +421,407 @@ def create_commands(session, num_workers, remotes, env_id, logdir, shell='bash',
     return cmds, notes
 
 
+def local_processes(num_workers, remotes, base_cmd, planner, num_threads=1, backend='ps', pin='none', ps_cores=2,
+                    num_eval_workers=1, logdir=None, tb_port=12345, inference_cmd=None):
+    """The (name, command) of every process of a single-host job, in launch order."""
+    processes = []
+    if backend == 'ps':
+        processes += [("ps", pinned(base_cmd, planner.prefix(ps_cores)) + ["--job-name", "ps"]
+                       + ps_thread_args(pin, ps_cores))]
+    if inference_cmd is not None:
+        # before the workers: they wait for its socket on their first act step
+        processes += [("inference", pinned(inference_cmd, planner.prefix(1)))]
+    for i in range(num_workers):
+        processes += [("w-%d" % i, training_worker(base_cmd, planner.prefix(num_threads), i, remotes[i], num_threads))]
+    for i in range(num_eval_workers):
+        name, eval_args = eval_worker(num_workers, num_eval_workers, i, remotes)
+        processes += [(name, pinned(base_cmd, planner.prefix(1)) + eval_args)]
+    if tb_port:
+        processes += [("tb", ["tensorboard", "--logdir", logdir, "--port", str(tb_port)])]
+    return processes
+
+
+class _Child(object):
+    """One process of a supervised job, in its own process group."""
+    def __init__(self, session, name, cmd, logdir):
+        self.session = session
+        self.name = name
+        self.cmd = cmd
+        self.logdir = logdir
+        self.proc = None
+        self.started = 0
+        self.next_start = 0
+        self.restarts = 0
+        self.failures = 0
+        self.updates = None
+        self.progress_time = 0
+        self.report = None
+
+    @property
+    def training(self):
+        return self.name.startswith('w-')
+
+    def start(self, resume=False):
+        cmd = self.cmd + (['--resume'] if resume and self.training else [])
+        with open(os.path.join(self.logdir, '{}.{}.out'.format(self.session, self.name)), 'a') as out:
+            self.proc = subprocess.Popen(" ".join(shlex_quote(str(v)) for v in cmd), shell=True, stdout=out,
+                                         stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        self.started = self.progress_time = time.time()
+        self.updates = None
+
+    def stop(self, timeout=10):
+        if self.proc is None:
+            return
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(self.proc.pid, sig)
+            except OSError:
+                break
+            deadline = time.time() + timeout
+            while self.proc.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self.proc.poll() is not None:
+                break
+        self.proc = None
+
+    def heartbeat(self):
+        try:
+            with open(os.path.join(self.logdir, 'heartbeat', self.name + '.json')) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        # a heartbeat left by an earlier run of this worker does not count
+        return state if state['time'] >= self.started else None
+
+
+class JobSupervisor(object):
+    """
+    Runs the processes of a single-host job as children (-m supervise). A process that exits is
+    started again, after a delay that doubles with every quick failure in a row, and a worker whose
+    heartbeat shows no new actor update for `stall_secs` is killed and started again. The stall
+    check starts with the first heartbeat of a worker, so a slow start does not count. Restarted
+    workers get --resume: they join the running job, and a restarted task 0 leaves the global
+    variables alone.
+    The number of workers follows <log-dir>/num_workers, which can be changed at any time; workers
+    are added with new task indices and removed from the highest index down, while the ps keeps
+    running. `make_worker(task, num_workers)` returns the command of a new worker, or None if it
+    cannot be added.
+    """
+    def __init__(self, session, processes, logdir, make_worker, stall_secs=600, report_secs=60, interval=2):
+        self.session = session
+        self.logdir = logdir
+        self.make_worker = make_worker
+        self.stall_secs = stall_secs
+        self.report_secs = report_secs
+        self.interval = interval
+        self.children = [_Child(session, name, cmd, logdir) for name, cmd in processes]
+        self.num_workers_path = os.path.join(logdir, 'num_workers')
+        self.next_report = time.time() + report_secs
+
+    def log(self, message):
+        line = "{} {}".format(time.strftime('%Y-%m-%d %H:%M:%S'), message)
+        print(line)
+        sys.stdout.flush()
+        with open(os.path.join(self.logdir, 'supervisor.log'), 'a') as f:
+            f.write(line + '\n')
+
+    def workers(self):
+        return sorted((c for c in self.children if c.training), key=lambda c: int(c.name[2:]))
+
+    def desired_workers(self):
+        try:
+            with open(self.num_workers_path) as f:
+                return max(1, int(f.read().strip()))
+        except (IOError, OSError, ValueError):
+            return len(self.workers())
+
+    def scale(self):
+        workers = self.workers()
+        desired = self.desired_workers()
+        for task in range(len(workers), desired):
+            cmd = self.make_worker(task, desired)
+            if cmd is None:
+                self.log("cannot add w-{}: -r lists no remote for it".format(task))
+                break
+            child = _Child(self.session, 'w-%d' % task, cmd, self.logdir)
+            self.log("adding {}".format(child.name))
+            child.start()
+            # keep the launch order: new workers go after the existing ones
+            self.children.insert(self.children.index(workers[-1]) + 1 + task - len(workers), child)
+        for child in workers[desired:]:
+            self.log("removing {}".format(child.name))
+            child.stop()
+            self.children.remove(child)
+
+    def check(self):
+        self.scale()
+        now = time.time()
+        for child in self.children:
+            if child.proc is None:
+                if now >= child.next_start:
+                    self.log("restarting {} (restart {})".format(child.name, child.restarts))
+                    child.start(resume=True)
+                continue
+            code = child.proc.poll()
+            if code is not None:
+                child.proc = None
+                child.restarts += 1
+                # a process that ran for a while gets restarted right away
+                child.failures = child.failures + 1 if now - child.started < 300 else 0
+                child.next_start = now + min(60, 2 ** child.failures - 1)
+                self.log("{} exited with code {}".format(child.name, code))
+                continue
+            if not child.training:
+                continue
+            state = child.heartbeat()
+            if state is not None and state['updates'] != child.updates:
+                child.updates = state['updates']
+                child.progress_time = now
+            if child.updates is None:
+                # still starting: the heartbeat begins once the session is up and the env reset,
+                # which can take as long as the VNC start timeout
+                continue
+            if now - child.progress_time > self.stall_secs:
+                self.log("{} made no progress for {:.0f}s: killing it".format(child.name, now - child.progress_time))
+                child.stop()
+                child.restarts += 1
+                child.next_start = now
+        if now >= self.next_report:
+            self.next_report = now + self.report_secs
+            self.report()
+
+    def report(self):
+        parts = []
+        for child in self.workers():
+            state = child.heartbeat()
+            rate = '-'
+            if state is not None:
+                if child.report is not None and state['time'] > child.report['time'] and state['frames'] >= child.report['frames']:
+                    rate = '{:.0f}'.format((state['frames'] - child.report['frames']) / (state['time'] - child.report['time']))
+                child.report = state
+            parts.append("{} {} fps, {} restarts".format(child.name, rate, child.restarts))
+        self.log("; ".join(parts))
+
+    def run(self):
+        if not os.path.exists(self.num_workers_path):
+            with open(self.num_workers_path, 'w') as f:
+                f.write('{}\n'.format(len(self.workers())))
+        # stopping train.py (pbt.py does it with SIGTERM) stops the job
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        for child in self.children:
+            child.start()
+        try:
+            while True:
+                time.sleep(self.interval)
+                self.check()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.log("stopping the job")
+            for child in reversed(self.children):
+                child.stop()
+
+
+LOCAL_ADDRESSES = ('localhost', '127.0.0.1')
+
+
+def load_cluster(path):
+    """
+    Reads a cluster description: the hosts of the run and how many processes each of them takes.
+        {"hosts": [{"address": "10.0.0.1", "slots": 8}, {"address": "10.0.0.2", "slots": 8, "port": 13222}]}
+    `port` is the first port used on the host (default 12222) and `cpus` its core count for --pin
+    (default: the topology of the machine running train.py). Entries may share an address as long
+    as their port ranges do not overlap, which simulates several nodes on one machine.
+    """
+    with open(os.path.expanduser(path)) as f:
+        description = json.load(f)
+    hosts = []
+    for entry in description['hosts']:
+        hosts.append(dict(address=entry['address'], slots=int(entry.get('slots', 1)),
+                          port=int(entry.get('port', 12222)), cpus=int(entry.get('cpus', 0))))
+    for i, a in enumerate(hosts):
+        for b in hosts[:i]:
+            if a['address'] == b['address'] and a['port'] < b['port'] + b['slots'] and b['port'] < a['port'] + a['slots']:
+                raise ValueError("Overlapping port ranges on {}: {} and {}".format(a['address'], b['port'], a['port']))
+    return hosts
+
+
+def assign_roles(hosts, num_workers, num_eval_workers=1):
+    """
+    Places the ps, the workers and the eval workers on the slots of the hosts. The ps goes on the first
+    host and the workers are spread round-robin so that every host gets a similar share.
+    Returns the TF cluster spec and, for each host, the (name, job, task) of the processes it runs.
+    """
+    order = []
+    for slot in range(max(h['slots'] for h in hosts)):
+        order += [i for i, h in enumerate(hosts) if slot < h['slots']]
+    needed = num_workers + 1 + num_eval_workers
+    if len(order) < needed:
+        raise ValueError("{} workers need {} slots (ps and eval workers included), the cluster has {}".format(
+            num_workers, needed, len(order)))
+
+    spec = {'ps': [], 'worker': []}
+    placement = [[] for _ in hosts]
+    ports = [h['port'] for h in hosts]
+
+    def place(i, name, job):
+        spec[job].append('{}:{}'.format(hosts[i]['address'], ports[i]))
+        ports[i] += 1
+        placement[i].append((name, job, len(spec[job]) - 1))
+
+    place(order[0], 'ps', 'ps')
+    for k in range(num_workers):
+        place(order[k + 1], 'w-%d' % k, 'worker')
+    # eval workers need no port, but they read the checkpoints written by task 0, so they go on
+    # the same host while it has slots left
+    for k in range(num_eval_workers):
+        i = next(i for i in [order[1]] + order[num_workers + 1:] if len(placement[i]) < hosts[i]['slots'])
+        placement[i].append(('eval-%d' % k, 'eval', k))
+    return spec, placement
+
+
+def create_cluster_commands(session, num_workers, remotes, env_id, logdir, cluster, shell='bash', visualise=False,
+                            num_threads=1, worker_args='', obs_mode='84x84x3', pin='none', ps_cores=2,
+                            num_eval_workers=1, graph_cache=False, tb_port=12345):
+    hosts = load_cluster(cluster)
+    spec, placement = assign_roles(hosts, num_workers, num_eval_workers)
+    base_cmd = worker_command(num_workers, env_id, logdir, visualise, worker_args, obs_mode, graph_cache=graph_cache)
+    base_cmd += ['--cluster-spec', json.dumps(spec, sort_keys=True, separators=(',', ':'))]
+
+    if remotes is None:
+        remotes = ["1"] * num_workers
+    else:
+        remotes = remotes.split(',')
+        assert len(remotes) >= num_workers
+
+    # one planner per machine, so that simulated nodes sharing an address do not share cores
+    planners = {}
+    for host in hosts:
+        if host['address'] not in planners:
+            nodes = [(0, list(range(host['cpus'])))] if host['cpus'] else cpu_topology()
+            planners[host['address']] = CpuPlanner(pin, nodes)
+
+    cluster_dir = os.path.join(logdir, 'cluster')
+    cmds = [
+        "mkdir -p {}".format(cluster_dir),
+        "echo {} {} > {}/cmd.sh".format(sys.executable, ' '.join([shlex_quote(arg) for arg in sys.argv if arg != '-n']), logdir),
+        "echo {} > {}/cluster.json".format(shlex_quote(json.dumps(spec, indent=2, sort_keys=True)), cluster_dir),
+    ]
+    notes = []
+    for i, host in enumerate(hosts):
+        node_dir = os.path.join(cluster_dir, 'node-%d' % i)
+        lines = ["#!/bin/sh",
+                 "# {}, ports {}-{}".format(host['address'], host['port'], host['port'] + host['slots'] - 1),
+                 "cd {}".format(shlex_quote(os.getcwd())),
+                 "mkdir -p {}".format(node_dir),
+                 "echo '#!/bin/sh' >{}/kill.sh".format(node_dir)]
+        planner = planners[host['address']]
+        for name, job, task in placement[i]:
+            if job == 'ps':
+                cmd = pinned(base_cmd, planner.prefix(ps_cores)) + ["--job-name", "ps"] + ps_thread_args(pin, ps_cores)
+            elif job == 'eval':
+                name, eval_args = eval_worker(num_workers, num_eval_workers, task, remotes)
+                cmd = pinned(base_cmd, planner.prefix(1)) + eval_args
+            else:
+                cmd = training_worker(base_cmd, planner.prefix(num_threads), task, remotes[task], num_threads)
+            lines += [new_cmd(session, name, cmd, 'nohup', node_dir, shell)[1]]
+        if i == 0 and tb_port:
+            lines += [new_cmd(session, "tb", ["tensorboard", "--logdir", logdir, "--port", str(tb_port)], 'nohup',
+                              node_dir, shell)[1]]
+
+        script = "{}/node-{}.sh".format(cluster_dir, i)
+        cmds += ["cat > {} <<'EOF'\n{}\nEOF".format(script, "\n".join(lines))]
+        if host['address'] in LOCAL_ADDRESSES:
+            cmds += ["sh {}".format(script)]
+        else:
+            notes += ["Run `ssh {} sh -s < {}` to start node {} (the code and {} must be at the same paths there)".format(
+                host['address'], script, i, logdir)]
+        notes += ["Run `source {}/kill.sh` on {} to kill node {}".format(node_dir, host['address'], i)]
+    chief_host = next(i for i, processes in enumerate(placement) if ('w-0', 'worker', 0) in processes)
+    eval_hosts = sorted(set(i for i, processes in enumerate(placement) for _, job, _ in processes if job == 'eval'))
+    if eval_hosts != [chief_host]:
+        notes += ["Eval workers run on nodes {} and read the checkpoints w-0 writes on node {}: "
+                  "{} must be on a shared file system".format(','.join(map(str, eval_hosts)), chief_host, logdir)]
+    notes += ["Use `tail -f {}/node-*/*.out` to watch process output".format(cluster_dir)]
+    if any(p.oversubscribed for p in planners.values()):
+        notes += ["More cores requested than some hosts have; --pin core wrapped around and some processes share cores"]
+    if tb_port:
+        notes += ["Point your browser to http://{}:{} to see Tensorboard".format(hosts[0]['address'], tb_port)]
+    return cmds, notes
+
+
+def supervised_job(args):
+    """The JobSupervisor of a single-host job launched with -m supervise."""
+    base_cmd = worker_command(args.num_workers, args.env_id, args.log_dir, args.visualise, args.worker_args,
+                              args.obs_mode, args.backend, args.graph_cache, args.port,
+                              args.inference_server) + ['--heartbeat-secs', '5']
+    inference_cmd = None
+    if args.inference_server:
+        inference_cmd = inference_command(args.log_dir, args.backend, args.port, args.worker_args)
+    planner = CpuPlanner(args.pin, cpu_topology())
+    remotes = ["1"] * args.num_workers if args.remotes is None else args.remotes.split(',')
+    processes = local_processes(args.num_workers, remotes, base_cmd, planner, args.num_threads, args.backend,
+                                args.pin, args.ps_cores, args.num_eval_workers, args.log_dir, args.tb_port,
+                                inference_cmd)
+
+    def make_worker(task, num_workers):
+        # the remotes past the workers are for the eval workers
+        if args.remotes is not None and task >= min(len(remotes), args.num_workers):
+            return None
+        remote = "1" if args.remotes is None else remotes[task]
+        return training_worker(base_cmd, planner.prefix(args.num_threads), task, remote, args.num_threads, num_workers)
+
+    return JobSupervisor("a3c", processes, args.log_dir, make_worker, args.stall_secs, args.report_secs)
+
+
 def run():
     args = parser.parse_args()
-    cmds, notes = create_commands("a3c", args.num_workers, args.remotes, args.env_id, args.log_dir, mode=args.mode, visualise=args.visualise)
+    if args.cpu_report is not None:
+        cpu_report(args.log_dir, args.cpu_report)
+        return
+    if args.scrape is not None:
+        scrape_report(args.log_dir, args.scrape)
+        return
+    if args.stop_remote_pool:
+        print("Removed {} remotes".format(RemotePool(args.log_dir, None, port=args.remote_pool_port).stop()))
+        return
+    if args.remote_pool:
+        if '.' not in args.env_id:
+            parser.error("--remote-pool is for VNC environments (ids with a dot, such as flashgames.NeonRace-v0)")
+        if args.remotes is not None or args.cluster is not None or args.num_threads > 1:
+            parser.error("--remote-pool makes one remote per single-threaded worker on this host; "
+                         "it cannot be used with -r, --cluster or -t")
+        image, command, host_config = runtime_image(args.env_id)
+        pool = RemotePool(args.log_dir, image, command, host_config, port=args.remote_pool_port)
+        count = args.num_workers + args.num_eval_workers
+        if args.dry_run:
+            args.remotes = ','.join(pool.address(i) for i in range(count))
+        else:
+            print("Waiting for {} pooled remotes (containers {}-*)".format(count, pool.prefix))
+            args.remotes = ','.join(pool.ensure(count))
+    job = None
+    if args.cluster is not None:
+        if args.backend == 'shm':
+            parser.error("--backend shm is single-host and cannot be used with --cluster")
+        if args.mode == 'supervise':
+            parser.error("-m supervise runs a single-host job and cannot be used with --cluster")
+        if args.inference_server:
+            parser.error("--inference-server serves the workers of one host and cannot be used with --cluster")
+        cmds, notes = create_cluster_commands("a3c", args.num_workers, args.remotes, args.env_id, args.log_dir,
+                                              args.cluster, visualise=args.visualise, num_threads=args.num_threads,
+                                              worker_args=args.worker_args, obs_mode=args.obs_mode, pin=args.pin,
+                                              ps_cores=args.ps_cores, num_eval_workers=args.num_eval_workers,
+                                              graph_cache=args.graph_cache, tb_port=args.tb_port)
+    else:
+        cmds, notes = create_commands("a3c", args.num_workers, args.remotes, args.env_id, args.log_dir, mode=args.mode,
+                                      visualise=args.visualise, num_threads=args.num_threads, worker_args=args.worker_args,
+                                      obs_mode=args.obs_mode, backend=args.backend, pin=args.pin,
+                                      ps_cores=args.ps_cores, num_eval_workers=args.num_eval_workers,
+                                      graph_cache=args.graph_cache, port=args.port, tb_port=args.tb_port,
+                                      inference=args.inference_server)
+        if args.mode == 'supervise':
+            job = supervised_job(args)
+            cmds += ["# supervised: " + " ".join(shlex_quote(str(v)) for v in child.cmd) for child in job.children]
     if args.dry_run:
         print("Dry-run mode due to -n flag, otherwise the following commands would be executed:")
     else:
@@ -104,10 +829,12 @@ def run():
     print("\n".join(cmds))
     print("")
     if not args.dry_run:
-        if args.mode == "tmux":
+        if args.mode == "tmux" and args.cluster is None:
             os.environ["TMUX"] = ""
         os.system("\n".join(cmds))
     print('\n'.join(notes))
+    if job is not None and not args.dry_run:
+        job.run()
 
 
 if __name__ == "__main__":
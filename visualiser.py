@@ -0,0 +1,117 @@
+"""
+Visualisation off the acting thread. The actor hands frames to a Visualiser, which passes them over
+a bounded queue to a separate process that either shows them in a window or, headless, writes
+every episode to a video file. When the consumer falls behind, the oldest queued frames are
+dropped: the actor never waits for a window or an encoder.
+"""
+import logging
+import multiprocessing
+import os
+import six.moves.queue as queue
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _to_bgr(frame, size):
+    frame = cv2.resize(frame, size, interpolation=cv2.INTER_NEAREST)
+    if frame.ndim == 2 or frame.shape[2] == 1:
+        return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+    return cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+
+
+def _consume(frames, video_dir, prefix, size, fps):
+    writer = None
+    episode = None
+    while True:
+        item = frames.get()
+        if item is None:
+            break
+        frame_episode, frame, goal = item
+        image = _to_bgr(frame, size)
+        if goal is not None:
+            cv2.putText(image, "goal {}".format(goal), (8, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 255), 1)
+        if video_dir is None:
+            cv2.imshow(prefix, image)
+            cv2.waitKey(1)
+            continue
+        if frame_episode != episode:
+            if writer is not None:
+                writer.release()
+            episode = frame_episode
+            path = os.path.join(video_dir, "{}-episode{:06d}.avi".format(prefix, episode))
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+        writer.write(image)
+    if writer is not None:
+        writer.release()
+
+
+class Visualiser(object):
+    """
+    Shows every `every`-th frame in a window, or writes them to `video_dir` (one file per episode,
+    named after `prefix`) when it is given. Frames are float images in [0, 1] as returned by the
+    environments, or uint8. Start the process before building the graph, so that it is not forked
+    from a process running TensorFlow threads.
+    """
+    def __init__(self, video_dir=None, prefix='worker', every=1, queue_size=64, size=(500, 500), fps=15):
+        self.video_dir = video_dir
+        self.prefix = prefix
+        self.every = max(1, every)
+        self.size = tuple(size)
+        self.fps = fps
+        self.frames = multiprocessing.Queue(queue_size)
+        self.process = None
+        self.episode = 0
+        self.count = 0
+        self.dropped = 0
+
+    def start(self):
+        if self.video_dir is not None and not os.path.exists(self.video_dir):
+            os.makedirs(self.video_dir)
+        self.process = multiprocessing.Process(target=_consume, name='visualiser',
+                                               args=(self.frames, self.video_dir, self.prefix, self.size, self.fps))
+        self.process.daemon = True
+        self.process.start()
+        return self
+
+    def frame(self, image, goal=None):
+        """Queues `image` (with the current goal, if any) unless it is decimated away."""
+        self.count += 1
+        if self.count % self.every:
+            return
+        if image.dtype != np.uint8:
+            image = (np.clip(image, 0.0, 1.0) * 255).astype(np.uint8)
+        item = (self.episode, image, goal)
+        try:
+            self.frames.put_nowait(item)
+        except queue.Full:
+            # make room by dropping the oldest frame; the consumer may have made room meanwhile
+            try:
+                self.frames.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            try:
+                self.frames.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+
+    def new_episode(self):
+        self.episode += 1
+        self.count = 0
+
+    def close(self, timeout=10):
+        if self.process is None:
+            return
+        try:
+            self.frames.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process = None
+        if self.dropped:
+            logger.info("visualiser dropped %d frames", self.dropped)
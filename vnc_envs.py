@@ -0,0 +1,224 @@
+"""
+Environments that run in universe VNC remotes: flash games and Atari over VNC. Importing this
+module imports universe and configures its logging, so envs.create_env only does it for the
+environment ids that need it.
+"""
+import cv2
+from gym.spaces.box import Box
+import numpy as np
+import gym
+from gym import spaces
+import logging
+import universe
+from universe import vectorized
+from universe.wrappers import BlockingReset, GymCoreAction, EpisodeID, Unvectorize, Vision, Logger
+from universe import spaces as vnc_spaces
+from universe.spaces.vnc_event import keycode
+from envs import Diagnostics, FramePreprocessor, OBS_MODES
+from vnc_remotes import StreamSettings
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+universe.configure_logging()
+
+def create_env(env_id, client_id, remotes, **kwargs):
+    spec = gym.spec(env_id)
+
+    if spec.tags.get('flashgames', False):
+        return create_flash_env(env_id, client_id, remotes, **kwargs)
+    elif spec.tags.get('atari', False) and spec.tags.get('vnc', False):
+        return create_vncatari_env(env_id, client_id, remotes, **kwargs)
+    else:
+        raise ValueError("Not a VNC environment: {}".format(env_id))
+
+def create_flash_env(env_id, client_id, remotes, vnc_settings=None, **_):
+    env = gym.make(env_id)
+    env = Vision(env)
+    env = Logger(env)
+    env = BlockingReset(env)
+
+    reg = universe.runtime_spec('flashgames').server_registry
+    height = reg[env_id]["height"]
+    width = reg[env_id]["width"]
+    env = CropScreen(env, height, width, 84, 18)
+    env = FlashRescale(env)
+
+    keys = ['left', 'right', 'up', 'down', 'x']
+    if env_id == 'flashgames.NeonRace-v0':
+        # Better key space for this game.
+        keys = ['left', 'right', 'up', 'left up', 'right up', 'down', 'up x']
+    logger.info('create_flash_env(%s): keys=%s', env_id, keys)
+
+    env = DiscreteToFixedKeysVNCActions(env, keys)
+    env = EpisodeID(env)
+    env = DiagnosticsInfo(env)
+    env = Unvectorize(env)
+    fps = 5.0
+    vnc_kwargs = {'encoding': 'tight', 'compress_level': 0, 'fine_quality_level': 50, 'subsample_level': 3}
+    if vnc_settings is not None:
+        env = AdaptiveStream(env, StreamSettings(vnc_settings, fps, vnc_kwargs))
+        fps, vnc_kwargs = env.settings.fps, env.settings.vnc_kwargs
+    env.configure(fps=fps, remotes=remotes, start_timeout=15 * 60, client_id=client_id,
+                  vnc_driver='go', vnc_kwargs=vnc_kwargs)
+    return env
+
+def create_vncatari_env(env_id, client_id, remotes, obs_mode='84x84x3', vnc_settings=None, **_):
+    env = gym.make(env_id)
+    env = Vision(env)
+    env = Logger(env)
+    env = BlockingReset(env)
+    env = GymCoreAction(env)
+    env = VNCAtariRescale(env, obs_mode)
+    env = EpisodeID(env)
+    env = DiagnosticsInfo(env)
+    env = Unvectorize(env)
+
+    logger.info('Connecting to remotes: %s', remotes)
+    fps = env.metadata['video.frames_per_second']
+    if vnc_settings is None:
+        env.configure(remotes=remotes, start_timeout=15 * 60, fps=fps, client_id=client_id)
+    else:
+        env = AdaptiveStream(env, StreamSettings(vnc_settings, fps))
+        env.configure(remotes=remotes, start_timeout=15 * 60, fps=env.settings.fps, client_id=client_id,
+                      vnc_kwargs=env.settings.vnc_kwargs)
+    return env
+
+class AdaptiveStream(gym.Wrapper):
+    """
+    Moves the StreamSettings of the connection along with the lag reported by DiagnosticsInfo.
+    A new frame rate is set at once on the wrappers that pace the env with an `fps` attribute
+    (universe's Throttle); the encoder settings only apply to the next connection, i.e. from the
+    next start of the worker, which reads them back from the settings file.
+    """
+    def __init__(self, env, settings):
+        super(AdaptiveStream, self).__init__(env)
+        self.settings = settings
+
+    def _step(self, action):
+        observation, reward, done, info = self.env.step(action)
+        if self.settings.update(info.get('diagnostics/action_lag_ub'), info.get('diagnostics/observation_lag_ub')):
+            logger.info('Stream level %d: fps=%s vnc_kwargs=%s', self.settings.level, self.settings.fps,
+                        self.settings.vnc_kwargs)
+            self._set_fps(self.settings.fps)
+        return observation, reward, done, info
+
+    def _set_fps(self, fps):
+        env = self.env
+        while env is not None:
+            if isinstance(getattr(env, 'fps', None), (int, float)):
+                env.fps = fps
+            env = getattr(env, 'env', None)
+
+def DiagnosticsInfo(env, *args, **kwargs):
+    return vectorized.VectorizeFilter(env, DiagnosticsInfoI, *args, **kwargs)
+
+class DiagnosticsInfoI(vectorized.Filter):
+    def __init__(self, log_interval=503):
+        super(DiagnosticsInfoI, self).__init__()
+        self.diagnostics = Diagnostics(log_interval)
+
+    def _after_reset(self, observation):
+        self.diagnostics.reset()
+        return observation
+
+    def _after_step(self, observation, reward, done, info):
+        return observation, reward, done, self.diagnostics.step(observation, reward, done, info)
+
+class VNCAtariRescale(vectorized.ObservationWrapper):
+    """Rescales the Atari frames of a vectorized env to one of the OBS_MODES."""
+    def __init__(self, env=None, obs_mode='84x84x3'):
+        super(VNCAtariRescale, self).__init__(env)
+        self.preprocess = FramePreprocessor(**OBS_MODES[obs_mode])
+        self.observation_space = Box(0.0, 1.0, list(self.preprocess.shape))
+
+    def _observation(self, observation_n):
+        return self.preprocess(observation_n)
+
+class FixedKeyState(object):
+    def __init__(self, keys):
+        self._keys = [keycode(key) for key in keys]
+        self._down_keysyms = set()
+
+    def apply_vnc_actions(self, vnc_actions):
+        for event in vnc_actions:
+            if isinstance(event, vnc_spaces.KeyEvent):
+                if event.down:
+                    self._down_keysyms.add(event.key)
+                else:
+                    self._down_keysyms.discard(event.key)
+
+    def to_index(self):
+        action_n = 0
+        for key in self._down_keysyms:
+            if key in self._keys:
+                # If multiple keys are pressed, just use the first one
+                action_n = self._keys.index(key) + 1
+                break
+        return action_n
+
+class DiscreteToFixedKeysVNCActions(vectorized.ActionWrapper):
+    """
+    Define a fixed action space. Action 0 is all keys up. Each element of keys can be a single key or a space-separated list of keys
+
+    For example,
+       e=DiscreteToFixedKeysVNCActions(e, ['left', 'right'])
+    will have 3 actions: [none, left, right]
+
+    You can define a state with more than one key down by separating with spaces. For example,
+       e=DiscreteToFixedKeysVNCActions(e, ['left', 'right', 'space', 'left space', 'right space'])
+    will have 6 actions: [none, left, right, space, left space, right space]
+    """
+    def __init__(self, env, keys):
+        super(DiscreteToFixedKeysVNCActions, self).__init__(env)
+
+        self._keys = keys
+        self._generate_actions()
+        self.action_space = spaces.Discrete(len(self._actions))
+
+    def _generate_actions(self):
+        self._actions = []
+        uniq_keys = set()
+        for key in self._keys:
+            for cur_key in key.split(' '):
+                uniq_keys.add(cur_key)
+
+        for key in [''] + self._keys:
+            split_keys = key.split(' ')
+            cur_action = []
+            for cur_key in uniq_keys:
+                cur_action.append(vnc_spaces.KeyEvent.by_name(cur_key, down=(cur_key in split_keys)))
+            self._actions.append(cur_action)
+        self.key_state = FixedKeyState(uniq_keys)
+
+    def _action(self, action_n):
+        # Each action might be a length-1 np.array. Cast to int to
+        # avoid warnings.
+        return [self._actions[int(action)] for action in action_n]
+
+class CropScreen(vectorized.ObservationWrapper):
+    """Crops out a [height]x[width] area starting from (top,left) """
+    def __init__(self, env, height, width, top=0, left=0):
+        super(CropScreen, self).__init__(env)
+        self.height = height
+        self.width = width
+        self.top = top
+        self.left = left
+        self.observation_space = Box(0, 255, shape=(height, width, 3))
+
+    def _observation(self, observation_n):
+        return [ob[self.top:self.top+self.height, self.left:self.left+self.width, :] if ob is not None else None
+                for ob in observation_n]
+
+def _process_frame_flash(frame):
+    frame = cv2.resize(frame, (200, 128))
+    frame = frame.mean(2).astype(np.float32)
+    frame *= (1.0 / 255.0)
+    frame = np.reshape(frame, [128, 200, 1])
+    return frame
+
+class FlashRescale(vectorized.ObservationWrapper):
+    def __init__(self, env=None):
+        super(FlashRescale, self).__init__(env)
+        self.observation_space = Box(0.0, 1.0, [128, 200, 1])
+
+    def _observation(self, observation_n):
+        return [_process_frame_flash(observation) for observation in observation_n]
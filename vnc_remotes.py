@@ -0,0 +1,224 @@
+"""
+VNC remotes that outlive the workers, and adaptive settings for the connections to them. Neither
+needs universe: train.py runs the pool, and vnc_envs applies the settings.
+
+With `-r 1`, every worker starts its own universe container and tears it down when it exits, so a
+restarted worker waits for a new container to boot. A RemotePool keeps one container per worker
+task running under a name derived from the log directory. A later train.py, or a restarted worker,
+finds the container warm and connects to it with a vnc:// address.
+"""
+import hashlib
+import json
+import logging
+import os
+import socket
+import subprocess
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# ports of the VNC server and the rewarder inside a universe runtime container
+_VNC_PORT = 5900
+_REWARDER_PORT = 15900
+
+
+def rfb_ready(host, port, timeout=2.0):
+    """Whether a VNC server answers at (host, port) with the RFB protocol version greeting."""
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    try:
+        greeting = b''
+        while len(greeting) < 12:
+            chunk = sock.recv(12 - len(greeting))
+            if not chunk:
+                break
+            greeting += chunk
+        return greeting.startswith(b'RFB ')
+    except (socket.error, socket.timeout):
+        return False
+    finally:
+        sock.close()
+
+
+def _docker(*args):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['docker'] + list(args), stdout=devnull)
+
+
+def runtime_image(env_id):
+    """The docker image and container command of the universe runtime of `env_id`, e.g. flashgames."""
+    import universe
+    spec = universe.runtime_spec(env_id.split('.')[0])
+    return spec.image, getattr(spec, 'command', None) or [], getattr(spec, 'host_config', None) or {}
+
+
+class RemotePool(object):
+    """
+    Docker containers of a universe runtime for the workers of the job in `log_dir`. Remote i
+    publishes its VNC server on `port + i` and its rewarder on `port + 10000 + i`.
+    The containers stay up when the workers or train.py exit; `stop()` removes them.
+    """
+    def __init__(self, log_dir, image, command=(), host_config=None, port=5900, host='127.0.0.1'):
+        self.log_dir = log_dir
+        self.image = image
+        self.command = list(command)
+        self.host_config = host_config or {}
+        self.port = port
+        self.host = host
+        digest = hashlib.md5(os.path.abspath(os.path.expanduser(log_dir)).encode('utf-8')).hexdigest()
+        self.prefix = 'fchrl-' + digest[:12]
+        self.state_path = os.path.join(log_dir, 'remote_pool.json')
+
+    def name(self, i):
+        return '{}-{}'.format(self.prefix, i)
+
+    def address(self, i):
+        return 'vnc://{}:{}+{}'.format(self.host, self.port + i, self.port + 10000 + i)
+
+    def _status(self, name):
+        """'running', another docker state, or None if there is no such container."""
+        try:
+            out = subprocess.check_output(['docker', 'inspect', '-f', '{{.State.Status}}', name],
+                                          stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            return None
+        return out.decode('utf-8').strip()
+
+    def _run(self, i):
+        cmd = ['run', '-d', '--name', self.name(i),
+               '-p', '{}:{}'.format(self.port + i, _VNC_PORT),
+               '-p', '{}:{}'.format(self.port + 10000 + i, _REWARDER_PORT)]
+        if self.host_config.get('privileged'):
+            cmd += ['--privileged']
+        if self.host_config.get('ipc_mode'):
+            cmd += ['--ipc', self.host_config['ipc_mode']]
+        for cap in self.host_config.get('cap_add', []):
+            cmd += ['--cap-add', cap]
+        _docker(*(cmd + [self.image] + self.command))
+
+    def ensure(self, count, timeout=15 * 60):
+        """
+        Makes remotes 0..count-1 run, reusing the containers that are there and starting the
+        stopped or missing ones, and waits for their VNC servers. Returns their addresses.
+        """
+        started = []
+        for i in range(count):
+            status = self._status(self.name(i))
+            if status == 'running':
+                continue
+            if status is None:
+                logger.info("Starting remote %s on port %d", self.name(i), self.port + i)
+                self._run(i)
+            else:
+                logger.info("Restarting remote %s (%s)", self.name(i), status)
+                _docker('start', self.name(i))
+            started.append(i)
+        deadline = time.time() + timeout
+        for i in range(count):
+            while not rfb_ready(self.host, self.port + i):
+                if time.time() > deadline:
+                    raise RuntimeError("Remote {} does not answer on port {}".format(self.name(i), self.port + i))
+                time.sleep(2)
+        if started:
+            logger.info("Remotes %s are up", ', '.join(self.name(i) for i in started))
+        self._save(count)
+        return [self.address(i) for i in range(count)]
+
+    def _save(self, count):
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        state = dict(image=self.image, port=self.port,
+                     remotes=[dict(name=self.name(i), address=self.address(i)) for i in range(count)])
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(state, f, indent=2)
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+    def stop(self):
+        """Removes every container of the pool, including those past the last `ensure` count."""
+        out = subprocess.check_output(['docker', 'ps', '-aq', '-f', 'name=^/{}-'.format(self.prefix)])
+        ids = out.decode('utf-8').split()
+        if ids:
+            _docker('rm', '-f', *ids)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        return len(ids)
+
+
+# From the best picture to the cheapest: the encoder settings first, then the frame rate, which
+# changes how often the agent acts
+STREAM_LEVELS = [
+    dict(fps_scale=1.0, compress_level=0, fine_quality_level=50),
+    dict(fps_scale=1.0, compress_level=3, fine_quality_level=30),
+    dict(fps_scale=1.0, compress_level=6, fine_quality_level=10),
+    dict(fps_scale=0.75, compress_level=6, fine_quality_level=10),
+    dict(fps_scale=0.5, compress_level=6, fine_quality_level=10),
+]
+
+
+class StreamSettings(object):
+    """
+    The fps and VNC encoder settings of one connection, moved along STREAM_LEVELS from the lag
+    diagnostics of the environment and kept in a JSON file at `path`, so that a restarted worker
+    starts where the previous one left off. More than `high` seconds of lag (upper bound of the
+    action or observation lag) in `patience` reports in a row move to the next, cheaper level;
+    less than `low` in `recovery` reports in a row move back.
+    """
+    def __init__(self, path, fps, vnc_kwargs=None, high=0.25, low=0.05, patience=2, recovery=10):
+        self.path = path
+        self.base_fps = fps
+        self.base_vnc_kwargs = dict(vnc_kwargs or {'encoding': 'tight'})
+        self.high = high
+        self.low = low
+        self.patience = patience
+        self.recovery = recovery
+        self.level = 0
+        self.slow = 0
+        self.fast = 0
+        try:
+            with open(path) as f:
+                self.level = min(len(STREAM_LEVELS) - 1, max(0, int(json.load(f)['level'])))
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    @property
+    def fps(self):
+        return self.base_fps * STREAM_LEVELS[self.level]['fps_scale']
+
+    @property
+    def vnc_kwargs(self):
+        kwargs = dict(self.base_vnc_kwargs)
+        kwargs.update(compress_level=STREAM_LEVELS[self.level]['compress_level'],
+                      fine_quality_level=STREAM_LEVELS[self.level]['fine_quality_level'])
+        return kwargs
+
+    def update(self, action_lag=None, observation_lag=None):
+        """Takes one diagnostics report; returns True if the level changed."""
+        lags = [lag for lag in (action_lag, observation_lag) if lag is not None]
+        if not lags:
+            return False
+        lag = max(lags)
+        self.slow = self.slow + 1 if lag > self.high else 0
+        self.fast = self.fast + 1 if lag < self.low else 0
+        level = self.level
+        if self.slow >= self.patience and level < len(STREAM_LEVELS) - 1:
+            level += 1
+        elif self.fast >= self.recovery and level > 0:
+            level -= 1
+        if level == self.level:
+            return False
+        self.level = level
+        self.slow = self.fast = 0
+        self.save(lag)
+        return True
+
+    def save(self, lag=None):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        state = dict(level=self.level, fps=self.fps, vnc_kwargs=self.vnc_kwargs, lag=lag, time=time.time())
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
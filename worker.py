@@ -1,14 +1,35 @@
 #!/usr/bin/env python
-import cv2
-import go_vncdriver
-import tensorflow as tf
 import argparse
+import sys
+from envs import create_env, is_vnc_env, OBS_MODES
+
+def vnc_requested(argv):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--env-id', default="PongDeterministic-v3")
+    return is_vnc_env(parser.parse_known_args(argv)[0].env_id)
+
+# go_vncdriver has to be loaded before TensorFlow, but only the VNC environments need it
+if vnc_requested(sys.argv[1:]):
+    import go_vncdriver
+import numpy as np
+import tensorflow as tf
 import logging
-import sys, signal
+import signal
 import time
 import os
-from a3c import A3C
-from envs import create_env
+import re
+import glob
+import json
+import shutil
+import threading
+from a3c import A3C, ActorThread, RolloutScheduler
+from eventlog import make_summary_writer
+from graphcache import cached_graph, graph_key
+from inference import InferenceClient
+from intrinsic import INTRINSIC_REWARDS
+from metrics import MetricsServer, socket_path
+from sharedmem import SharedParameterStore, default_store_path
+from visualiser import Visualiser
 import distutils.version
 use_tf12_api = distutils.version.LooseVersion(tf.VERSION) >= distutils.version.LooseVersion('0.12.0')
 from time import sleep
@@ -22,19 +43,176 @@ class FastSaver(tf.train.Saver):
         super(FastSaver, self).save(sess, save_path, global_step, latest_filename,
                                     meta_graph_suffix, False)
 
-def run(args, server):
-    env = create_env(args.env_id, client_id=str(args.task), remotes=args.remotes)
-    trainer = A3C(env, args.task, args.visualise)
+class EventFileGrowth(object):
+    """Size of the event files under a log directory and its growth per hour since the last call."""
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.last = None
+
+    def size(self):
+        total = 0
+        for root, _, files in os.walk(self.log_dir):
+            for name in files:
+                if name.startswith('events.out.tfevents.'):
+                    try:
+                        total += os.path.getsize(os.path.join(root, name))
+                    except OSError:
+                        pass
+        return total
+
+    def update(self):
+        """Returns the current size in bytes and the bytes per hour since the last update (None at first)."""
+        now, size = time.time(), self.size()
+        rate = None
+        if self.last is not None and now > self.last[0]:
+            rate = (size - self.last[1]) * 3600.0 / (now - self.last[0])
+        self.last = (now, size)
+        return size, rate
+
+
+class Heartbeat(threading.Thread):
+    """
+    Writes the pid and the actor updates and frames of this worker to `path` every `interval` seconds,
+    for the supervisor of train.py -m supervise to tell stalled workers from busy ones.
+    """
+    def __init__(self, path, trainers, interval):
+        threading.Thread.__init__(self, name='heartbeat')
+        self.daemon = True
+        self.path = path
+        self.trainers = trainers
+        self.interval = interval
+
+    def beat(self):
+        state = dict(time=time.time(), pid=os.getpid(),
+                     updates=sum(t.local_steps for t in self.trainers),
+                     frames=sum(t.local_frames for t in self.trainers))
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(self.path + '.tmp', self.path)
+
+    def run(self):
+        while True:
+            try:
+                self.beat()
+            except (IOError, OSError) as e:
+                logger.warn("Cannot write the heartbeat to %s: %s", self.path, e)
+            time.sleep(self.interval)
+
+
+def globals_initialized(target, ready_op, config):
+    """
+    Whether the parameter server already holds the global variables, i.e. the job is running and
+    this worker was restarted. Gives up (False) if the ps does not answer within a minute.
+    """
+    probe_config = tf.ConfigProto()
+    probe_config.CopyFrom(config)
+    probe_config.operation_timeout_in_ms = 60000
+    try:
+        with tf.Session(target, config=probe_config) as sess:
+            return len(sess.run(ready_op)) == 0
+    except tf.errors.OpError:
+        return False
+
+
+def initialize_if_uninitialized(variable):
+    """
+    Initializes `variable` unless it already holds a value. The check runs on the variable's
+    device, so a worker that joins (or rejoins) the job keeps the values on the parameter server.
+    """
+    value = tf.cond(tf.is_variable_initialized(variable), variable.read_value, lambda: variable.initial_value)
+    return variable.assign(value)
+
+
+def make_env(args, client_id):
+    vnc_settings = None
+    if args.vnc_adaptive:
+        # per client, so that a restarted worker picks up the settings of the connection it replaces
+        vnc_settings = os.path.join(args.log_dir, 'vnc', 'client-{}.json'.format(client_id))
+    return create_env(args.env_id, client_id=client_id, remotes=args.remotes, obs_mode=args.obs_mode,
+                      vnc_settings=vnc_settings)
+
+
+def make_scheduler(args):
+    if not args.adaptive_rollout:
+        return None
+    updates_per_sec = None
+    if args.ps_updates_per_sec:
+        # the budget is for the whole cluster; every actor gets an equal share
+        updates_per_sec = args.ps_updates_per_sec / float(args.num_workers * args.num_threads)
+    return RolloutScheduler(frames_per_update=args.frames_per_update, updates_per_sec=updates_per_sec,
+                            max_steps=args.max_local_steps)
 
-    # Variable names that start with "local" are not saved in checkpoints.
+def run(args, server, visualiser=None):
+    # without a server the global parameters live in a shared-memory store
+    store = None
+    if server is None:
+        store = SharedParameterStore(args.shm_path or default_store_path(args.log_dir),
+                                     optimizer=args.optimizer, learning_rate=args.learning_rate,
+                                     locks=args.shm_locks)
+    trainer_kwargs = dict(num_meta_steps=args.meta_steps, num_actor_rollouts=args.actor_rollouts,
+                          num_local_steps=args.local_steps, optimizer=args.optimizer, store=store,
+                          grad_compression=args.grad_compression, topk_ratio=args.topk_ratio,
+                          fused_lstm=args.fused_lstm, quantized_acting=args.quantized_acting,
+                          image_summary_every=args.image_summary_every, image_summary_secs=args.image_summary_secs,
+                          image_summary_max=args.image_summary_max, image_summary_size=args.image_summary_size,
+                          intrinsic=args.intrinsic, meta_cached_features=args.meta_cached_features,
+                          beta=args.beta, intrinsic_scale=args.intrinsic_scale, learning_rate=args.learning_rate,
+                          entropy_bonus=args.entropy_bonus)
+    envs = [make_env(args, str(args.task))]
+    for i in range(1, args.num_threads):
+        envs.append(make_env(args, "{}.{}".format(args.task, i)))
+
+    def build():
+        trainer = A3C(envs[0], args.task, visualiser, scheduler=make_scheduler(args), **trainer_kwargs)
+        trainers = [trainer]
+        # extra actor threads share the global networks (and session) of the first one
+        for i in range(1, args.num_threads):
+            trainers.append(A3C(envs[i], args.task, False, thread=i, shared=trainer,
+                                scheduler=make_scheduler(args), **trainer_kwargs))
+        return trainers
+
+    if args.graph_cache is None:
+        trainers = build()
+    else:
+        # everything the graph depends on, apart from the task its worker ops are placed on
+        key = graph_key(observation_shape=[int(d) for d in envs[0].observation_space.shape],
+                        num_actions=int(envs[0].action_space.n), num_threads=args.num_threads,
+                        shared_memory=store is not None, store_mirror=store is not None and args.task == 0, **dict(
+                            (k, v) for k, v in trainer_kwargs.items() if k != 'store'))
+        trainers, imported = cached_graph(args.graph_cache, key, args.task, build)
+        if imported:
+            for i, t in enumerate(trainers):
+                t.attach(envs[i], args.task, visualiser if i == 0 else None, make_scheduler(args), store)
+    trainer = trainers[0]
+    # the first actor writes the episode summaries of all threads
+    trainer.peers = trainers[1:]
+    if args.inference:
+        # the meta-controller (and with --inference-actor the actor) acts through the host's server
+        for i, t in enumerate(trainers):
+            t.inference = InferenceClient(args.inference, envs[i].observation_space.shape, envs[i].action_space.n,
+                                          t.meta_action_size, args.fused_lstm)
+            t.inference_actor = args.inference_actor
+
+    # Variable names that start with "local" are not saved in checkpoints, and neither are the
+    # optimizer slots of the extra actor threads, so that checkpoints do not grow with
+    # --num-threads. Those slots are shared by name with the same thread of the other workers, and
+    # are initialized as part of the local init only if no worker has done so yet. The slots of
+    # the first actor are checkpointed and initialized like the other global variables.
+    thread_slots = [v for t in trainers if t.thread > 0 for v in t.actor_optimizer_variables]
+    actor_slots = set(v.name for v in thread_slots)
     if use_tf12_api:
-        variables_to_save = [v for v in tf.global_variables() if not v.name.startswith("local")]
+        variables_to_save = [v for v in tf.global_variables()
+                             if not v.name.startswith("local") and v.name not in actor_slots]
         init_op = tf.variables_initializer(variables_to_save)
         init_all_op = tf.global_variables_initializer()
+        local_init_op = tf.local_variables_initializer()
     else:
-        variables_to_save = [v for v in tf.all_variables() if not v.name.startswith("local")]
+        variables_to_save = [v for v in tf.all_variables()
+                             if not v.name.startswith("local") and v.name not in actor_slots]
         init_op = tf.initialize_variables(variables_to_save)
         init_all_op = tf.initialize_all_variables()
+        local_init_op = tf.initialize_local_variables()
+    local_init_op = tf.group(local_init_op, *[initialize_if_uninitialized(v) for v in thread_slots])
     saver = FastSaver(variables_to_save)
 
     var_list = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, tf.get_variable_scope().name)
@@ -46,25 +224,39 @@ def run(args, server):
         logger.info("Initializing all parameters.")
         ses.run(init_all_op)
 
-    config = tf.ConfigProto(device_filters=["/job:ps", "/job:worker/task:{}/cpu:0".format(args.task)])
+    if server is None:
+        config = worker_thread_config(args)
+    else:
+        config = tf.ConfigProto(device_filters=["/job:ps", "/job:worker/task:{}/cpu:0".format(args.task)])
     logdir = os.path.join(args.log_dir, 'train')
 
     if use_tf12_api:
-        summary_writer = tf.summary.FileWriter(logdir + "_%d" % args.task)
+        summary_writer = make_summary_writer(logdir + "_%d" % args.task, args.events_max_mb, args.events_max_hours,
+                                             args.events_retention)
     else:
         summary_writer = tf.train.SummaryWriter(logdir + "_%d" % args.task)
-    if args.eval:
-        summary_writer = tf.summary.FileWriter(logdir + "_eval")
 
     logger.info("Events directory: %s_%s", logdir, args.task)
-    sv = tf.train.Supervisor(is_chief=(args.task == 0),
-                             logdir=logdir,
+    # With the shared-memory store every worker initializes its own graph, but only task 0
+    # checkpoints its mirror of the global variables.
+    is_chief = args.task == 0 or store is not None
+    ready_op = tf.report_uninitialized_variables(variables_to_save)
+    # A restarted task 0 joins the running job like the other workers instead of initializing or
+    # restoring the global variables, and saves the checkpoints itself.
+    resumed_chief = (args.resume and store is None and args.task == 0 and
+                     globals_initialized(server.target, ready_op, config))
+    if resumed_chief:
+        logger.info("The global variables are initialized already: resuming the running job")
+        is_chief = False
+    sv = tf.train.Supervisor(is_chief=is_chief,
+                             logdir=logdir if args.task == 0 or store is None else None,
                              saver=saver,
                              summary_op=None,
                              init_op=init_op,
+                             local_init_op=local_init_op,
                              init_fn=init_fn,
                              summary_writer=summary_writer,
-                             ready_op=tf.report_uninitialized_variables(variables_to_save),
+                             ready_op=ready_op,
                              global_step=trainer.global_step,
                              save_model_secs=30,
                              save_summaries_secs=30)
@@ -74,33 +266,78 @@ def run(args, server):
     logger.info(
         "Starting session. If this hangs, we're mostly likely waiting to connect to the parameter server. " +
         "One common cause is that the parameter server DNS name isn't resolving yet, or is misspecified.")
-    with sv.managed_session(server.target, config=config) as sess, sess.as_default():
+    target = server.target if server is not None else ""
+    with sv.managed_session(target, config=config) as sess, sess.as_default():
         # set random seed for each worker
         # offset will be set for different experiment run
         tf.set_random_seed(args.task + args.seed_offset)
 
-        sess.run(trainer.meta_sync)
-        sess.run(trainer.sync)
+        if store is not None:
+            variables = trainer.store_variables()
+            layout = [(v.name, v.get_shape().as_list()) for v in variables]
+            if args.task == 0 and not (args.resume and os.path.exists(store.path)):
+                # task 0 has restored the latest checkpoint, if there is one
+                store.create(layout, sess.run(variables), global_step=sess.run(trainer.global_step))
+            else:
+                logger.info("Waiting for the parameter store at %s", store.path)
+                store.attach(layout)
+
+        for t in trainers:
+            t.sync_meta_weights(sess)
+            t.sync_weights(sess)
+            t.start(sess, summary_writer)
+
+        global_step = trainer.get_global_step(sess)
+        logger.info("Starting training at step=%d with %d actor thread(s)", global_step, len(trainers))
+
+        actors = []
+        if len(trainers) > 1:
+            actors = [ActorThread(t, sess) for t in trainers]
+            for actor in actors:
+                actor.start()
+
+        if args.heartbeat_secs:
+            heartbeat_dir = os.path.join(args.log_dir, 'heartbeat')
+            if not os.path.exists(heartbeat_dir):
+                os.makedirs(heartbeat_dir)
+            Heartbeat(os.path.join(heartbeat_dir, 'w-{}.json'.format(args.task)), trainers, args.heartbeat_secs).start()
+        if args.metrics_secs:
+            name = 'w-{}'.format(args.task)
+            MetricsServer(socket_path(args.log_dir, name), name, trainers, args.metrics_secs).start()
+        next_save = time.time() + 30
+
+        events = None
+        if args.task == 0 and args.event_report_secs:
+            events = EventFileGrowth(args.log_dir)
+            events.update()
+            next_event_report = time.time() + args.event_report_secs
 
-        trainer.start(sess, summary_writer)
-        global_step = sess.run(trainer.global_step)
-        if args.eval:
-            logger.info("Starting Evaluate-worker")
-        else:
-            logger.info("Starting training at step=%d", global_step)
-        eval_step = 1
         while not sv.should_stop() and (not num_global_steps or global_step < num_global_steps):
-            if args.eval:
-                global_step = sess.run(trainer.global_step)
-                # every N step
-                if global_step > eval_step * 100000:
-                    logger.info(" !!!! Starting Evaluation at step=%d", global_step)
-                    trainer.evaluate(sess)
-                    eval_step += 1
-                sleep(10)
+            if actors:
+                for actor in actors:
+                    actor.check()
+                sleep(1)
+                global_step = trainer.get_global_step(sess)
             else:
                 trainer.process(sess)
-                global_step = sess.run(trainer.global_step)
+                global_step = trainer.get_global_step(sess)
+            if resumed_chief and time.time() >= next_save:
+                saver.save(sess, os.path.join(logdir, 'model.ckpt'), global_step=trainer.global_step)
+                next_save = time.time() + 30
+            if events is not None and time.time() >= next_event_report:
+                size, rate = events.update()
+                next_event_report = time.time() + args.event_report_secs
+                logger.info("Event files: %.1f MB, growing %.1f MB/hour", size / 1e6, rate / 1e6)
+                summary = tf.Summary()
+                summary.value.add(tag='global/event_file_mb', simple_value=size / 1e6)
+                summary.value.add(tag='global/event_file_mb_per_hour', simple_value=rate / 1e6)
+                summary_writer.add_summary(summary, global_step)
+                summary_writer.flush()
+
+        for actor in actors:
+            actor.halt.set()
+        for actor in actors:
+            actor.join()
 
     # Ask for all the services to stop.
     sv.stop()
@@ -108,12 +345,175 @@ def run(args, server):
 
 
 
-def cluster_spec(num_workers, num_ps):
+def checkpoint_step(path):
+    # model.ckpt-123456 -> 123456
+    return int(re.search(r'-(\d+)$', path).group(1))
+
+
+class CheckpointQueue(object):
+    """
+    Picks the checkpoints to evaluate from the checkpoint state file of `checkpoint_dir`: the first
+    one at or past each multiple of `interval` steps. Picked checkpoints are hard-linked into
+    `queue_dir`, so that the saver deleting old checkpoints loses nothing while evaluation is
+    behind. The next step to pick is kept in `queue_dir` too, so a restarted eval worker carries
+    on where it stopped.
+
+    With several eval workers, each evaluates its share of the episodes of every queued checkpoint.
+    Only the first one (`index` 0) picks checkpoints; the others follow its queue. Every worker
+    records its share with `done`, and the one that completes a checkpoint merges the shares and
+    removes the checkpoint from the queue.
+    """
+    def __init__(self, checkpoint_dir, queue_dir, interval, num_workers=1, index=0):
+        self.checkpoint_dir = checkpoint_dir
+        self.queue_dir = queue_dir
+        self.interval = interval
+        self.num_workers = num_workers
+        self.index = index
+        if not os.path.exists(queue_dir):
+            try:
+                os.makedirs(queue_dir)
+            except OSError:
+                # another eval worker got there first
+                pass
+        self.state_path = os.path.join(queue_dir, 'next_step')
+        self.next_step = interval
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.next_step = int(f.read())
+
+    def poll(self):
+        """
+        Queues the new checkpoints that are due and returns the ones this worker has not evaluated
+        yet as (step, path), oldest first.
+        """
+        state = tf.train.get_checkpoint_state(self.checkpoint_dir) if self.index == 0 else None
+        if state is not None:
+            paths = list(state.all_model_checkpoint_paths) or [state.model_checkpoint_path]
+            for step, path in sorted((checkpoint_step(p), p) for p in paths):
+                if step >= self.next_step and self._link(path):
+                    self.next_step = (step // self.interval + 1) * self.interval
+                    with open(self.state_path, 'w') as f:
+                        f.write(str(self.next_step))
+        queued = [p[:-len('.index')] for p in glob.glob(os.path.join(self.queue_dir, '*.index'))]
+        return sorted((checkpoint_step(p), p) for p in queued if not os.path.exists(self._part(p, self.index)))
+
+    def _link(self, path):
+        # the .index file goes last: it is what poll() looks for
+        files = sorted(glob.glob(path + '.*'), key=lambda f: f.endswith('.index'))
+        if not any(f.endswith('.index') for f in files):
+            logger.warn('Checkpoint %s disappeared before it could be queued', path)
+            return False
+        for f in files:
+            target = os.path.join(self.queue_dir, os.path.basename(f))
+            if not os.path.exists(target):
+                try:
+                    os.link(f, target)
+                except OSError:
+                    shutil.copy(f, target)
+        return True
+
+    def _part(self, path, index):
+        return '{}.part-{}.json'.format(path, index)
+
+    def done(self, path, result):
+        """
+        Records this worker's result (a JSON-serializable dict) for the checkpoint at `path`.
+        Returns the results of all the workers if this one completed the checkpoint, else None.
+        """
+        part = self._part(path, self.index)
+        with open(part + '.tmp', 'w') as f:
+            json.dump(result, f)
+        os.rename(part + '.tmp', part)
+
+        parts = [self._part(path, i) for i in range(self.num_workers)]
+        if not all(os.path.exists(p) for p in parts):
+            return None
+        try:
+            # only one of the workers that see all the parts merges them
+            os.close(os.open(path + '.merge', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            return None
+        results = []
+        for p in parts:
+            with open(p) as f:
+                results.append(json.load(f))
+        os.remove(path + '.index')
+        for f in glob.glob(path + '.*'):
+            os.remove(f)
+        return results
+
+
+def run_eval(args, visualiser=None):
+    """
+    Evaluation worker: evaluates the checkpoints picked by a CheckpointQueue in a local graph, without
+    connecting to the parameter server. With --num-eval-workers E, the eval workers split the
+    --eval-episodes of each checkpoint and the last one to finish merges their results, appends them
+    to <log-dir>/eval_report.jsonl and writes the summaries, at the step of the checkpoint.
+    """
+    env = make_env(args, str(args.task))
+    trainer = A3C(env, args.task, visualiser, test=True, num_meta_steps=args.meta_steps,
+                  num_actor_rollouts=args.actor_rollouts, num_local_steps=args.local_steps,
+                  fused_lstm=args.fused_lstm, quantized_acting=args.quantized_acting, intrinsic=args.intrinsic,
+                  beta=args.beta, intrinsic_scale=args.intrinsic_scale)
+    # only the networks: the optimizer state in the checkpoints depends on the training flags
+    saver = tf.train.Saver(trainer.store_variables() + [trainer.global_step])
+
+    logdir = os.path.join(args.log_dir, 'train')
+    # the eval workers share train_eval; each compacts only its own event files
+    summary_writer = make_summary_writer(logdir + "_eval", args.events_max_mb, args.events_max_hours,
+                                         args.events_retention, name="eval-%d" % args.eval_index)
+    checkpoints = CheckpointQueue(logdir, os.path.join(args.log_dir, 'eval_queue'), args.eval_interval,
+                                  num_workers=args.num_eval_workers, index=args.eval_index)
+    num_episodes = len(range(args.eval_index, args.eval_episodes, args.num_eval_workers))
+
+    with tf.Session(config=worker_thread_config(args)) as sess, sess.as_default():
+        sess.run(tf.global_variables_initializer())
+        sess.run(tf.local_variables_initializer())
+        trainer.start(sess, summary_writer)
+        logger.info("Starting Evaluate-worker %d/%d on the checkpoints in %s, every %d steps, %d episodes each",
+                    args.eval_index, args.num_eval_workers, logdir, args.eval_interval, num_episodes)
+        while True:
+            queued = checkpoints.poll()
+            if not queued:
+                sleep(5)
+                continue
+            if len(queued) > 1:
+                logger.info("%d checkpoints waiting for evaluation", len(queued))
+            step, path = queued[0]
+            saver.restore(sess, path)
+            logger.info(" !!!! Starting Evaluation of %s at step=%d", os.path.basename(path), step)
+            start = time.time()
+            rewards, lengths = trainer.evaluate(sess, global_step=step, num_episodes=num_episodes,
+                                                write_summary=False)
+            results = checkpoints.done(path, dict(rewards=[float(r) for r in rewards], lengths=lengths,
+                                                  seconds=time.time() - start))
+            if results is None:
+                continue
+            rewards = [r for result in results for r in result['rewards']]
+            lengths = [l for result in results for l in result['lengths']]
+            report = dict(step=step, checkpoint=os.path.basename(path), episodes=len(rewards),
+                          eval_workers=len(results), seconds=max(result['seconds'] for result in results),
+                          reward_mean=float(np.mean(rewards)), reward_sd=float(np.std(rewards)),
+                          length_mean=float(np.mean(lengths)), length_sd=float(np.std(lengths)))
+            with open(os.path.join(args.log_dir, 'eval_report.jsonl'), 'a') as f:
+                f.write(json.dumps(report, sort_keys=True) + '\n')
+            trainer.write_eval_summary(rewards, lengths, step)
+            logger.info("Evaluation at step=%d: reward %.2f +- %.2f over %d episodes", step,
+                        report['reward_mean'], report['reward_sd'], len(rewards))
+
+
+def worker_thread_config(args):
+    # by default one inter-op thread per actor so that concurrent sess.run calls do not queue up
+    intra = args.intra_op_threads if args.intra_op_threads is not None else 1
+    inter = args.inter_op_threads if args.inter_op_threads is not None else max(2, args.num_threads + 1)
+    return tf.ConfigProto(intra_op_parallelism_threads=intra, inter_op_parallelism_threads=inter)
+
+
+def cluster_spec(num_workers, num_ps, port=12222):
     """
 More tensorflow setup for data parallelism
 """
     cluster = {}
-    port = 12222
 
     all_ps = []
     host = '127.0.0.1'
@@ -123,8 +523,7 @@ More tensorflow setup for data parallelism
     cluster['ps'] = all_ps
 
     all_workers = []
-    # plus the eval worker
-    for _ in range(num_workers + 1):
+    for _ in range(num_workers):
         all_workers.append('{}:{}'.format(host, port))
         port += 1
     cluster['worker'] = all_workers
@@ -141,6 +540,11 @@ Setting up Tensorflow for data parallel work
     parser.add_argument('--task', default=0, type=int, help='Task index')
     parser.add_argument('--job-name', default="worker", help='worker or ps')
     parser.add_argument('--num-workers', default=1, type=int, help='Number of workers')
+    parser.add_argument('--cluster-spec', default=None,
+                        help='JSON cluster spec with the addresses of the ps and worker tasks, as written by train.py --cluster '
+                             '(default: one ps and the workers on 127.0.0.1 from port 12222)')
+    parser.add_argument('--port', default=12222, type=int,
+                        help='First port of the default cluster spec: the ps, then one per worker')
     parser.add_argument('--log-dir', default="/tmp/pong", help='Log directory path')
     parser.add_argument('--env-id', default="PongDeterministic-v3", help='Environment id')
     parser.add_argument('-r', '--remotes', default=None,
@@ -148,18 +552,128 @@ Setting up Tensorflow for data parallel work
                              'or the address of pre-existing VNC servers and '
                              'rewarders to use (e.g. -r vnc://localhost:5900+15900,vnc://localhost:5901+15901)')
 
+    parser.add_argument('--obs-mode', default='84x84x3', choices=sorted(OBS_MODES),
+                        help="Observation size and channels for Atari games")
+    parser.add_argument('--vnc-adaptive', action='store_true',
+                        help="VNC environments: lower the fps and the encoder quality when the action or observation "
+                             "lag grows, and raise them again when it shrinks. The settings are kept in "
+                             "<log-dir>/vnc and reused by restarted workers")
+
     # Add visualisation argument
     parser.add_argument('--visualise', action='store_true',
-                        help="Visualise the gym environment by running env.render() between each timestep")
+                        help="Show the frames of the first actor in a window, from a separate process")
+    parser.add_argument('--visualise-every', default=1, type=int,
+                        help="Only visualise every n-th frame")
+    parser.add_argument('--video-dir', default=None,
+                        help="Visualise headless: write the frames of every episode to a video file in this directory")
 
     # Seed offset for different experiments
     parser.add_argument('--seed_offset', default=0, type=int, help='Offset to the seed number')
 
     parser.add_argument('--eval', action='store_true',
                         help="Evaluation Thread")
+    parser.add_argument('--eval-interval', default=100000, type=int,
+                        help="Evaluate the first checkpoint at or past every multiple of this many steps")
+    parser.add_argument('--eval-episodes', default=100, type=int,
+                        help="Episodes per evaluated checkpoint, split between the eval workers")
+    parser.add_argument('--num-eval-workers', default=1, type=int, help="Number of eval workers")
+    parser.add_argument('--eval-index', default=0, type=int, help="Index of this eval worker")
+
+    parser.add_argument('--resume', action='store_true',
+                        help="Restarted worker: join the running job. Task 0 leaves the global variables (or the "
+                             "shared-memory store) alone if they are initialized already")
+    parser.add_argument('--metrics-secs', default=5, type=float,
+                        help="Serve the throughput and resource use of this process as JSON over HTTP on the Unix "
+                             "socket <log-dir>/metrics/<process>.sock, sampled this often (0: no endpoint)")
+    parser.add_argument('--heartbeat-secs', default=0, type=float,
+                        help="Write the progress of the actors to <log-dir>/heartbeat/w-<task>.json this often (0: never)")
+
+    parser.add_argument('--num-threads', default=1, type=int,
+                        help="Number of actor threads sharing this worker's graph and session")
+
+    parser.add_argument('--intra-op-threads', default=None, type=int,
+                        help="TF intra-op thread pool size (default: 1 for workers, all cores for the ps)")
+    parser.add_argument('--inter-op-threads', default=None, type=int,
+                        help="TF inter-op thread pool size (default: num-threads + 1 for workers, all cores for the ps)")
+
+    parser.add_argument('--fused-lstm', action='store_true',
+                        help="Run the LSTMs as fused block ops (checkpoints are compatible either way)")
+    parser.add_argument('--intrinsic', default='feature', choices=sorted(INTRINSIC_REWARDS),
+                        help="Intrinsic reward: feature (conv feature selectivity, 32 goals) or "
+                             "pixel (pixel changes in a 6x6 grid of patches, 37 goals)")
+    parser.add_argument('--beta', default=0.75, type=float,
+                        help="Weight of the extrinsic reward in the actor's reward; the intrinsic one gets 1 - beta")
+    parser.add_argument('--intrinsic-scale', default=0.05, type=float, help="Scale of the intrinsic reward")
+    parser.add_argument('--learning-rate', default=1e-4, type=float, help="Learning rate of both networks")
+    parser.add_argument('--entropy-bonus', default=0.01, type=float, help="Weight of the policy entropy in both losses")
+    parser.add_argument('--meta-cached-features', action='store_true',
+                        help="Train the meta-controller on the hidden features cached while acting, "
+                             "without its gradient reaching the shared conv layers")
+    parser.add_argument('--image-summary-every', default=0, type=int,
+                        help="Write image summaries every this many actor updates (0: use --image-summary-secs)")
+    parser.add_argument('--image-summary-secs', default=600, type=float,
+                        help="Seconds between image summaries (0 and --image-summary-every 0: no image summaries)")
+    parser.add_argument('--image-summary-max', default=3, type=int, help="Frames per image summary")
+    parser.add_argument('--image-summary-size', default=42, type=int,
+                        help="Side of the summarized frames in pixels (0: keep the observation size)")
+    parser.add_argument('--event-report-secs', default=600, type=float,
+                        help="Task 0: seconds between reports of the growth of the event files (0: never)")
+    parser.add_argument('--events-max-mb', default=0, type=float,
+                        help="Start a new event file when the current one reaches this size (0: no limit)")
+    parser.add_argument('--events-max-hours', default=0, type=float,
+                        help="Start a new event file when the current one is this old (0: no limit)")
+    parser.add_argument('--events-retention', default='',
+                        help="After every new event file, merge the closed ones into one, keeping the older points "
+                             "at a lower resolution: age:seconds pairs, e.g. 6h:60,2d:600 (one point per tag and "
+                             "minute after 6 hours, per 10 minutes after 2 days)")
+    parser.add_argument('--quantized-acting', action='store_true',
+                        help="Act with 8 bit quantized weights and activations (training stays float32)")
+    parser.add_argument('--inference', default=None, metavar='SOCKET',
+                        help="Act for the meta-controller through the inference server at this socket, which "
+                             "batches the act steps of all workers of the host")
+    parser.add_argument('--inference-actor', action='store_true',
+                        help="With --inference, act for the actor through the server too")
+    parser.add_argument('--graph-cache', default=None,
+                        help="Directory of exported worker graphs: import the graph from there if it was "
+                             "built before, otherwise build and export it")
+
+    parser.add_argument('--optimizer', default='adam', choices=['adam', 'shared-adam', 'shared-rmsprop'],
+                        help="adam: per-actor Adam statistics; shared-*: one set of statistics per global variable")
+
+    # Single-host shared-memory backend
+    parser.add_argument('--backend', default='ps', choices=['ps', 'shm'],
+                        help="ps: parameter server over gRPC; shm: single-host shared-memory parameter store")
+    parser.add_argument('--shm-path', default=None,
+                        help="Shared-memory segment for --backend shm (default: derived from --log-dir)")
+    parser.add_argument('--shm-locks', action='store_true',
+                        help="Hold a per-tensor lock while applying updates to the shared-memory store")
+
+    parser.add_argument('--grad-compression', default='none', choices=['none', 'fp16', 'topk', 'int8'],
+                        help="Compression of the gradients pushed to the parameter server")
+    parser.add_argument('--topk-ratio', default=0.01, type=float,
+                        help="Fraction of each gradient tensor sent with --grad-compression topk")
+
+    # Rollout lengths
+    parser.add_argument('--meta-steps', default=20, type=int,
+                        help="Meta-controller steps per meta-controller update")
+    parser.add_argument('--actor-rollouts', default=5, type=int,
+                        help="Actor rollouts (and actor updates) per meta-controller step")
+    parser.add_argument('--local-steps', default=20, type=int,
+                        help="Environment steps per actor rollout")
+    parser.add_argument('--adaptive-rollout', action='store_true',
+                        help="Choose the actor rollout length from measured env/inference/update latencies")
+    parser.add_argument('--frames-per-update', default=20, type=int,
+                        help="Adaptive rollout: minimum number of frames per actor update")
+    parser.add_argument('--ps-updates-per-sec', default=0, type=float,
+                        help="Adaptive rollout: cluster-wide budget of actor updates per second (0 for no budget)")
+    parser.add_argument('--max-local-steps', default=100, type=int,
+                        help="Adaptive rollout: upper bound on the actor rollout length")
 
     args = parser.parse_args()
-    spec = cluster_spec(args.num_workers, 1)
+    if args.cluster_spec is not None:
+        spec = json.loads(args.cluster_spec)
+    else:
+        spec = cluster_spec(args.num_workers, 1, args.port)
     cluster = tf.train.ClusterSpec(spec).as_cluster_def()
 
     def shutdown(signal, frame):
@@ -169,15 +683,37 @@ Setting up Tensorflow for data parallel work
     signal.signal(signal.SIGINT, shutdown)
     signal.signal(signal.SIGTERM, shutdown)
 
-    if args.job_name == "worker":
-        server = tf.train.Server(cluster, job_name="worker", task_index=args.task,
-                                 config=tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=2))
-        run(args, server)
-    else:
-        server = tf.train.Server(cluster, job_name="ps", task_index=args.task,
-                                 config=tf.ConfigProto(device_filters=["/job:ps"]))
-        while True:
-            time.sleep(1000)
+    # started before TensorFlow does, so that its process is not forked from a threaded one
+    visualiser = None
+    if (args.visualise or args.video_dir) and (args.eval or args.job_name == "worker"):
+        name = "eval-{}".format(args.eval_index) if args.eval else "w-{}".format(args.task)
+        visualiser = Visualiser(args.video_dir, name, args.visualise_every).start()
+
+    try:
+        if args.eval:
+            run_eval(args, visualiser)
+        elif args.backend == 'shm':
+            if args.job_name == "worker":
+                run(args, None, visualiser)
+            else:
+                logger.info("The shm backend has no parameter server; nothing to do.")
+        elif args.job_name == "worker":
+            server = tf.train.Server(cluster, job_name="worker", task_index=args.task,
+                                     config=worker_thread_config(args))
+            run(args, server, visualiser)
+        else:
+            server = tf.train.Server(cluster, job_name="ps", task_index=args.task,
+                                     config=tf.ConfigProto(device_filters=["/job:ps"],
+                                                           intra_op_parallelism_threads=args.intra_op_threads or 0,
+                                                           inter_op_parallelism_threads=args.inter_op_threads or 0))
+            if args.metrics_secs:
+                # the memory and cpu use of the ps
+                MetricsServer(socket_path(args.log_dir, 'ps'), 'ps', [], args.metrics_secs).start()
+            while True:
+                time.sleep(1000)
+    finally:
+        if visualiser is not None:
+            visualiser.close()
 
 if __name__ == "__main__":
     tf.app.run()